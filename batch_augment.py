@@ -0,0 +1,108 @@
+"""Data augmentation on whole batches of normalized images.
+
+Every op works on the whole batch at once, with per-image random parameters, so the cost is
+a handful of ops per batch instead of per image. The random numbers are stateless, derived
+from a seed and the batch number, so a seeded run sees the same augmentation every time.
+The ops are plain TensorFlow ops: they run in the tf.data pipeline on the CPU, and can be
+called from a training step placed on the GPU as well.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import random
+
+import tensorflow as tf
+
+class BatchAugmenter(object):
+	"""Class for brightness/contrast jitter, small translations and horizontal flips.
+
+	A flipped image of a turn to the left becomes a turn to the right, so the labels of
+	the classes whose names end with 'left' and 'right' are swapped with the flip.
+
+	The sample usage of this class is like:
+
+	'''
+	augmenter = BatchAugmenter(['move_forward', 'turn_left', 'turn_right'], seed=1)
+	ds = ds.batch(32).map(normalize)
+	ds = tf.data.Dataset.zip((ds, tf.data.experimental.Counter()))
+	ds = ds.map(lambda batch, step: augmenter(batch[0], batch[1], step))
+	'''
+	"""
+
+	def __init__(self, label_names, brightness=0.1, contrast=0.2, max_shift=8, flip=True, seed=None):
+		"""Inits BatchAugmenter.
+
+		Args:
+			label_names: Class names in label order.
+			brightness: Maximum brightness change, in the [0,1] range of the pixels.
+			contrast: Maximum relative contrast change.
+			max_shift: Maximum translation in pixels, in both directions.
+			flip: Whether to flip half of the images horizontally.
+			seed: Seed of the random parameters, None for a different augmentation every run.
+		"""
+		self._brightness = brightness
+		self._contrast = contrast
+		self._max_shift = max_shift
+		self._seed = random.randrange(2 ** 31) if seed is None else seed
+
+		# Label of each label once flipped.
+		flipped_labels = list(range(len(label_names)))
+		left = [i for i, name in enumerate(label_names) if name.endswith('left')]
+		right = [i for i, name in enumerate(label_names) if name.endswith('right')]
+		self._flip = flip and len(left) == 1 and len(right) == 1
+		if self._flip:
+			flipped_labels[left[0]], flipped_labels[right[0]] = right[0], left[0]
+		self._flipped_labels = tf.constant(flipped_labels, dtype=tf.int32)
+
+	def _uniform(self, op, step, shape, low, high):
+		"""Get stateless uniform random numbers, different for every op and batch."""
+		seed = tf.stack([tf.constant(self._seed + op, dtype=tf.int64), tf.cast(step, tf.int64)])
+		return tf.random.stateless_uniform(shape, seed=seed, minval=low, maxval=high)
+
+	def __call__(self, images, labels, step, soft_targets=None):
+		"""Augment a batch.
+
+		Args:
+			images: Float32 images in [0,1] range, (n, h, w, 3).
+			labels: Int32 labels, (n,).
+			step: Number of the batch, the random parameters depend on it.
+			soft_targets: Optional per-class targets, (n, class_count), e.g. teacher predictions.
+				The left and right columns are swapped with the flips too.
+
+		Returns:
+			The augmented images and their labels, and the soft targets if any.
+		"""
+		count = tf.shape(images)[0]
+		height, width = images.shape[1], images.shape[2]
+
+		# Contrast around the mean of each image, then brightness.
+		if self._contrast:
+			factor = self._uniform(0, step, [count, 1, 1, 1], 1 - self._contrast, 1 + self._contrast)
+			mean = tf.reduce_mean(images, axis=[1, 2, 3], keepdims=True)
+			images = (images - mean) * factor + mean
+		if self._brightness:
+			images += self._uniform(1, step, [count, 1, 1, 1], -self._brightness, self._brightness)
+
+		# Translate by cropping shifted boxes out of the padded batch, one op for all the images.
+		if self._max_shift:
+			shift = self._max_shift
+			padded = tf.pad(images, [[0, 0], [shift, shift], [shift, shift], [0, 0]], mode='SYMMETRIC')
+			offsets = self._uniform(2, step, [count, 2], 0, 2 * shift + 1)
+			offsets = tf.floor(offsets) / tf.constant([height + 2 * shift - 1, width + 2 * shift - 1], dtype=tf.float32)
+			size = tf.constant([(height - 1) / (height + 2 * shift - 1), (width - 1) / (width + 2 * shift - 1)],
+							   dtype=tf.float32)
+			boxes = tf.concat([offsets, offsets + size], axis=1)
+			images = tf.image.crop_and_resize(padded, boxes, tf.range(count), [height, width])
+
+		# Flip half of the images, and swap the left and right labels with them.
+		if self._flip:
+			flip = self._uniform(3, step, [count], 0, 1) < 0.5
+			images = tf.where(tf.reshape(flip, [-1, 1, 1, 1]), tf.reverse(images, axis=[2]), images)
+			labels = tf.where(flip, tf.gather(self._flipped_labels, labels), labels)
+			if soft_targets is not None:
+				soft_targets = tf.where(tf.reshape(flip, [-1, 1]),
+										tf.gather(soft_targets, self._flipped_labels, axis=1), soft_targets)
+
+		if soft_targets is None:
+			return tf.clip_by_value(images, 0, 1), labels
+		return tf.clip_by_value(images, 0, 1), labels, soft_targets
@@ -0,0 +1,70 @@
+"""Compare the images/sec of ImageDataset reading loose files, TFRecord shards and NumPy memmaps.
+
+Pack the dataset first, then run it from the repository root:
+
+	python dataset_packer.py --dataset ./dataset --output ./dataset_packed
+	python -m benchmarks.bench_dataset --dataset ./dataset --packed ./dataset_packed
+
+Each backend is timed on a sample of --images images, then on an epoch of the training
+dataset of create, with the natural and with balanced class proportions: these go through
+the per-record split and class filters of the packed shards. The training dataset fills its
+shuffle buffer with the whole split, so its passes read a whole epoch whatever --images.
+The 'numpy' backend builds its arrays on the first run, outside of the timed passes.
+The first pass of each backend reads from disk unless the files are in the page cache
+already, run `sync; echo 3 | sudo tee /proc/sys/vm/drop_caches` before for cold numbers.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import argparse
+import time
+
+def parse_args():
+	"""Parse the command line arguments."""
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--dataset', default='./dataset', help='Folder of class folders with labelled images.')
+	parser.add_argument('--packed', default='./dataset_packed', help='Folder written by dataset_packer.py.')
+	parser.add_argument('--images', type=int, default=20000, help='Images read per pass.')
+	parser.add_argument('--batch-size', type=int, default=128, help='Batch size.')
+	parser.add_argument('--passes', type=int, default=2, help='Passes per backend.')
+	return parser.parse_args()
+
+def time_pass(ds):
+	"""Read a dataset of batches once.
+
+	Returns:
+		(images read, seconds).
+	"""
+	count = 0
+	start = time.perf_counter()
+	for batch in ds:
+		images = batch[0] if isinstance(batch, tuple) else batch
+		count += int(images.shape[0])
+	return count, time.perf_counter() - start
+
+def main():
+	"""Run the benchmark."""
+	args = parse_args()
+	os.environ['CUDA_VISIBLE_DEVICES'] = '-1'  # Only the input pipeline is measured.
+
+	import tensorflow as tf
+	import image_dataset
+
+	print('%-10s %-9s %6s %9s %9s %11s' % ('backend', 'source', 'pass', 'images', 'seconds', 'images/s'))
+	for backend, path in (('files', args.dataset), ('tfrecord', args.packed), ('numpy', args.dataset)):
+		dataset = image_dataset.ImageDataset(img_path=path, img_size=(120, 160), backend=backend)
+		for source in ('sample', 'train', 'balanced'):
+			if source == 'sample':
+				# Decoded and resized, as in training, but without the cache.
+				ds = dataset.sample_images(args.images).batch(args.batch_size).prefetch(tf.data.experimental.AUTOTUNE)
+			else:
+				dataset.create(train_set_ratio=0.8, val_set_ratio=0.2, batch_size=args.batch_size, cache_mode=None,
+							   class_proportions='balanced' if source == 'balanced' else None)
+				ds = dataset.train_ds.take(max(1, dataset.train_size // args.batch_size))
+			for i in range(args.passes):
+				count, seconds = time_pass(ds)
+				print('%-10s %-9s %6d %9d %9.2f %11.1f' % (backend, source, i + 1, count, seconds, count / seconds))
+
+if __name__ == '__main__':
+	main()
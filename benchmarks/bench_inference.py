@@ -0,0 +1,91 @@
+"""Compare the InferenceEngine with the original per-frame model.predict path on CPU.
+
+Run it from the repository root:
+
+	python -m benchmarks.bench_inference --model best_model.h5 --frames 200
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import argparse
+import time
+
+import numpy as np
+
+def parse_args():
+	"""Parse the command line arguments."""
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--model', default='best_model.h5', help='Model saved by train.py.')
+	parser.add_argument('--frames', type=int, default=200, help='Frames timed per path.')
+	parser.add_argument('--warmup', type=int, default=10, help='Untimed frames per path.')
+	parser.add_argument('--batch-size', type=int, default=8, help='Batch size of the batched engine run.')
+	parser.add_argument('--gpu', action='store_true', help='Allow TensorFlow to use the GPU.')
+	return parser.parse_args()
+
+def time_calls(fn, frames, calls, warmup):
+	"""Time fn over a list of frames.
+
+	Returns:
+		Per-call latencies in milliseconds.
+	"""
+	for i in range(warmup):
+		fn(frames[i % len(frames)])
+
+	latencies = []
+	for i in range(calls):
+		start = time.perf_counter()
+		fn(frames[i % len(frames)])
+		latencies.append((time.perf_counter() - start) * 1000)
+	return np.array(latencies)
+
+def report(name, latencies, frames_per_call=1):
+	"""Print the latency percentiles and throughput of one path."""
+	print('%-28s p50 %7.2f ms  p95 %7.2f ms  p99 %7.2f ms  %8.1f fps' % (
+		name, np.percentile(latencies, 50), np.percentile(latencies, 95),
+		np.percentile(latencies, 99), frames_per_call * 1000 / latencies.mean()))
+
+def main():
+	"""Run the benchmark."""
+	args = parse_args()
+	if not args.gpu:
+		os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+	import tensorflow as tf
+	from tensorflow import keras
+
+	import inference_engine
+
+	# Frames of the size pilot_client.py captures, as decoded by OpenCV.
+	rng = np.random.RandomState(0)
+	frames = [rng.randint(0, 256, size=(320, 480, 3), dtype=np.uint8) for _ in range(16)]
+
+	model = keras.models.load_model(args.model)
+	img_height, img_width = model.input_shape[1:3]
+
+	def predict_original(image):
+		"""The per-frame path pilot_serv.py used before InferenceEngine."""
+		image = tf.image.resize(images=image, size=[img_height, img_width])
+		image /= 255.0
+		return np.argmax(model.predict(tf.expand_dims(image, axis=0)))
+
+	engine = inference_engine.InferenceEngine(args.model, max_batch_size=args.batch_size)
+
+	def predict_engine(image):
+		return np.argmax(engine.predict([image])[0])
+
+	batches = [frames[i:i + args.batch_size] for i in range(0, len(frames) - args.batch_size + 1, args.batch_size)]
+
+	def predict_engine_batch(images):
+		return np.argmax(engine.predict(images), axis=1)
+
+	print('TensorFlow %s, devices: %s' % (tf.version.VERSION,
+		', '.join(d.name for d in tf.config.experimental.list_logical_devices())))
+	report('model.predict per frame', time_calls(predict_original, frames, args.frames, args.warmup))
+	report('InferenceEngine batch 1', time_calls(predict_engine, frames, args.frames, args.warmup))
+	report('InferenceEngine batch %d' % args.batch_size,
+		   time_calls(predict_engine_batch, batches, max(1, args.frames // args.batch_size), args.warmup),
+		   frames_per_call=args.batch_size)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,120 @@
+"""Compare the original frame receive path of pilot_serv.py with the pooled recv_into path.
+
+A sender thread streams length-prefixed frames over a local socket pair. The receiver
+reads them either the original way (read, BytesIO, bytearray, np.asarray) or with
+recv_into into a BufferPool and np.frombuffer on a memoryview. It reports frames/s,
+MB/s and the memory allocated while receiving a frame, measured with tracemalloc.
+Run it from the repository root:
+
+	python -m benchmarks.bench_receive --frames 5000 --size 30000
+"""
+
+import argparse
+import io
+import socket
+import struct
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+import buffer_pool
+
+def parse_args():
+	"""Parse the command line arguments."""
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--frames', type=int, default=5000, help='Frames sent per path.')
+	parser.add_argument('--size', type=int, default=30000, help='Bytes per frame, about a 480x320 JPEG.')
+	return parser.parse_args()
+
+def send_frames(sock, frames, size):
+	"""Send a number of length-prefixed frames of size bytes."""
+	payload = bytes(bytearray(range(256)) * (size // 256 + 1))[:size]
+	header = struct.pack('<L', size)
+	for _ in range(frames):
+		sock.sendall(header)
+		sock.sendall(payload)
+	sock.sendall(struct.pack('<L', 0))
+
+def receive_original(sock):
+	"""The receive path of pilot_serv.py before the buffer pool."""
+	connection = sock.makefile('rb')
+	while True:
+		image_len = struct.unpack('<L', connection.read(struct.calcsize('<L')))[0]
+		if not image_len:
+			break
+		image_stream = io.BytesIO()
+		image_stream.write(connection.read(image_len))
+		image_stream.seek(0)
+		img_array = np.asarray(bytearray(image_stream.read()), dtype=np.uint8)
+		yield img_array
+
+def recv_into(sock, view):
+	"""Fill a memoryview from a blocking socket."""
+	received = 0
+	while received < len(view):
+		count = sock.recv_into(view[received:])
+		if not count:
+			raise EOFError('Connection closed by peer')
+		received += count
+
+def receive_pooled(sock):
+	"""The receive path of AsyncFrameStream, on a blocking socket."""
+	pool = buffer_pool.BufferPool()
+	header = bytearray(4)
+	header_view = memoryview(header)
+	while True:
+		recv_into(sock, header_view)
+		image_len = struct.unpack_from('<L', header)[0]
+		if not image_len:
+			break
+		buffer = pool.acquire(image_len)
+		image_data = memoryview(buffer)[:image_len]
+		recv_into(sock, image_data)
+		yield np.frombuffer(image_data, dtype=np.uint8)
+		pool.release(buffer)
+
+def stream(receive, frames, size, on_frame):
+	"""Stream frames through one receive path, calling on_frame for each received frame."""
+	sender_sock, receiver_sock = socket.socketpair()
+	sender = threading.Thread(target=send_frames, args=(sender_sock, frames, size))
+	sender.start()
+	try:
+		for img_array in receive(receiver_sock):
+			on_frame(img_array)
+	finally:
+		sender.join()
+		sender_sock.close()
+		receiver_sock.close()
+
+def run(name, receive, frames, size):
+	"""Measure the throughput and the per-frame allocations of one receive path."""
+	# Throughput, without tracing.
+	checksum = []
+	start = time.perf_counter()
+	stream(receive, frames, size, lambda img_array: checksum.append(img_array[-1]))
+	elapsed = time.perf_counter() - start
+
+	# Allocations: peak of the memory traced while each frame was received.
+	peaks = []
+	def on_frame(img_array):
+		peaks.append(tracemalloc.get_traced_memory()[1])
+		tracemalloc.clear_traces()  # Also resets the peak.
+
+	tracemalloc.start()
+	stream(receive, min(frames, 500), size, on_frame)
+	tracemalloc.stop()
+	steady = peaks[len(peaks) // 10:]  # Skip the warm-up frames, which fill the pool.
+
+	print('%-10s %10.1f frames/s %8.1f MB/s   median peak alloc per frame %8d bytes' % (
+		name, frames / elapsed, frames * size / elapsed / 1e6, int(np.median(steady))))
+
+def main():
+	"""Run the benchmark."""
+	args = parse_args()
+	run('original', receive_original, args.frames, args.size)
+	run('pooled', receive_pooled, args.frames, args.size)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,91 @@
+"""Measure the scaling efficiency of distributed training with train.py on one Linux box.
+
+Mirrored runs split the CPU into logical devices, multi-worker runs launch local worker
+processes talking over localhost, so no GPU or second host is needed. The batch size of
+each replica stays the same (weak scaling): the efficiency is the speedup over one replica
+divided by the number of replicas. All replicas share the same cores here, so the numbers
+show the cost of the distribution (gradient reduction, input sharding) rather than a speedup.
+Run it from the repository root:
+
+	python -m benchmarks.bench_scaling --devices 1,2,4 --workers 2,4
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import argparse
+import json
+import subprocess
+import sys
+
+def parse_args():
+	"""Parse the command line arguments."""
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--devices', default='1,2,4', help='Logical CPU devices of the mirrored runs.')
+	parser.add_argument('--workers', default='2', help='Local workers of the multi-worker runs, empty for none.')
+	parser.add_argument('--batch-size', type=int, default=32, help='Batch size of each replica.')
+	parser.add_argument('--epochs', type=int, default=3, help='Epochs per run, the first one is not counted.')
+	parser.add_argument('--steps', type=int, default=20, help='Steps per epoch.')
+	parser.add_argument('--port', type=int, default=23456, help='First port of the local workers.')
+	return parser.parse_args()
+
+def train_command(args, strategy, cpu_devices=0):
+	"""Get the command line of a benchmark run of train.py."""
+	command = [sys.executable, 'train.py', '--benchmark', '--strategy', strategy,
+			   '--batch-size', str(args.batch_size), '--epochs', str(args.epochs),
+			   '--steps-per-epoch', str(args.steps)]
+	if cpu_devices:
+		command += ['--cpu-devices', str(cpu_devices)]
+	return command
+
+def parse_throughput(output):
+	"""Get the result printed by train.py --benchmark."""
+	for line in output.splitlines():
+		if line.startswith('THROUGHPUT '):
+			return json.loads(line[len('THROUGHPUT '):])
+	raise RuntimeError('No throughput in the output of train.py:\n%s' % output[-2000:])
+
+def run_mirrored(args, devices):
+	"""Train with a mirrored strategy on logical CPU devices."""
+	env = dict(os.environ, CUDA_VISIBLE_DEVICES='-1')
+	output = subprocess.check_output(train_command(args, 'mirrored', devices), env=env,
+									 stderr=subprocess.STDOUT, universal_newlines=True)
+	return parse_throughput(output)
+
+def run_workers(args, count):
+	"""Train with a multi-worker strategy on local worker processes, one CPU device each."""
+	cluster = {'worker': ['localhost:%d' % (args.port + i) for i in range(count)]}
+	workers = []
+	for index in range(count):
+		env = dict(os.environ, CUDA_VISIBLE_DEVICES='-1',
+				   TF_CONFIG=json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': index}}))
+		workers.append(subprocess.Popen(train_command(args, 'multiworker'), env=env, stdout=subprocess.PIPE,
+										stderr=subprocess.STDOUT, universal_newlines=True))
+
+	outputs = [worker.communicate()[0] for worker in workers]
+	for worker, output in zip(workers, outputs):
+		if worker.returncode:
+			raise RuntimeError('A worker failed:\n%s' % output[-2000:])
+	return parse_throughput(outputs[0])  # The chief prints the result.
+
+def main():
+	"""Run the benchmark."""
+	args = parse_args()
+
+	results = [run_mirrored(args, int(devices)) for devices in args.devices.split(',') if devices]
+	results += [run_workers(args, int(count)) for count in args.workers.split(',') if count]
+
+	# One replica is the reference, the mirrored run on one device if there is one.
+	base = next((result for result in results if result['replicas'] == 1), results[0])
+	base_rate = base['images_per_sec'] / base['replicas']
+
+	print('%-12s %8s %8s %12s %11s %8s %10s' % (
+		'strategy', 'replicas', 'workers', 'global batch', 'images/s', 'speedup', 'efficiency'))
+	for result in results:
+		speedup = result['images_per_sec'] / base_rate
+		print('%-12s %8d %8d %12d %11.1f %8.2f %9.0f%%' % (
+			result['strategy'], result['replicas'], result['workers'], result['global_batch_size'],
+			result['images_per_sec'], speedup, 100 * speedup / result['replicas']))
+
+if __name__ == '__main__':
+	main()
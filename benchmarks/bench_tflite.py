@@ -0,0 +1,90 @@
+"""Compare the accuracy and latency of the int8 TFLite model with the keras model on CPU.
+
+Run it from the repository root, after train.py (or tflite_export.py) wrote both models:
+
+	python -m benchmarks.bench_tflite --model best_model.h5 --tflite best_model_int8.tflite
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import argparse
+import glob
+import random
+import time
+
+import numpy as np
+import cv2
+
+def parse_args():
+	"""Parse the command line arguments."""
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--model', default='best_model.h5', help='Keras model saved by train.py.')
+	parser.add_argument('--tflite', default='best_model_int8.tflite', help='Model written by tflite_export.py.')
+	parser.add_argument('--dataset', default='./dataset', help='Folder of class folders with labelled images.')
+	parser.add_argument('--samples', type=int, default=1000, help='Images to evaluate on.')
+	parser.add_argument('--latency-frames', type=int, default=200, help='Frames timed per model.')
+	parser.add_argument('--threads', default='1,4', help='Interpreter thread counts to try.')
+	return parser.parse_args()
+
+def load_samples(path, count, img_size):
+	"""Load a random sample of labelled images as uint8 RGB arrays of img_size (h, w)."""
+	label_names = sorted(item for item in os.listdir(path) if os.path.isdir(os.path.join(path, item)))
+	paths = sorted(glob.glob(os.path.join(path, '*', '*')))
+	random.Random(0).shuffle(paths)
+
+	images, labels = [], []
+	for image_path in paths[:count]:
+		image = cv2.imread(image_path)
+		if image is None:
+			continue
+		image = cv2.resize(image, (img_size[1], img_size[0]), interpolation=cv2.INTER_LINEAR)
+		images.append(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+		labels.append(label_names.index(os.path.basename(os.path.dirname(image_path))))
+	return images, np.array(labels)
+
+def time_frames(predict, images, frames):
+	"""Get the per-frame latencies in milliseconds of a single-image predict function."""
+	for image in images[:10]:  # Warm up.
+		predict(image)
+	latencies = []
+	for i in range(frames):
+		start = time.perf_counter()
+		predict(images[i % len(images)])
+		latencies.append((time.perf_counter() - start) * 1000)
+	return np.array(latencies)
+
+def main():
+	"""Run the benchmark."""
+	args = parse_args()
+	os.environ['CUDA_VISIBLE_DEVICES'] = '-1'  # x86 CPU only.
+
+	import inference_engine
+	import tflite_pilot
+
+	engine = inference_engine.InferenceEngine(args.model)
+	images, labels = load_samples(args.dataset, args.samples, engine.img_size)
+	if not images:
+		raise SystemExit('No images under %s' % args.dataset)
+
+	keras_classes = np.array([np.argmax(engine.predict([image], bgr=False)[0]) for image in images])
+	keras_latency = time_frames(lambda image: engine.predict([image], bgr=False), images, args.latency_frames)
+
+	print('Evaluated on %d images' % len(images))
+	print('%-22s %9s %9s %9s %9s %9s' % ('model', 'size MB', 'accuracy', 'agree', 'p50 ms', 'p95 ms'))
+	print('%-22s %9.2f %9.4f %9.4f %9.2f %9.2f' % (
+		'keras float32', os.path.getsize(args.model) / 1e6, np.mean(keras_classes == labels), 1.0,
+		np.percentile(keras_latency, 50), np.percentile(keras_latency, 95)))
+
+	for threads in [int(t) for t in args.threads.split(',')]:
+		pilot = tflite_pilot.TFLitePilot(args.tflite, num_threads=threads)
+		classes = np.array([pilot.predict_class(image) for image in images])
+		latency = time_frames(pilot.predict_class, images, args.latency_frames)
+		print('%-22s %9.2f %9.4f %9.4f %9.2f %9.2f' % (
+			'tflite int8, %d thread%s' % (threads, 's' if threads > 1 else ''),
+			os.path.getsize(args.tflite) / 1e6, np.mean(classes == labels),
+			np.mean(classes == keras_classes),
+			np.percentile(latency, 50), np.percentile(latency, 95)))
+
+if __name__ == '__main__':
+	main()
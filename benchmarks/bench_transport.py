@@ -0,0 +1,114 @@
+"""Compare the JPEG and raw frame formats of the pipelined protocol.
+
+For each format it measures the bytes per frame, the CPU time the server needs to turn
+them into a model-sized image, and the resulting per-frame latency for a few link speeds.
+Run it from the repository root:
+
+	python -m benchmarks.bench_transport --images ./dataset --links 10,20,50,100
+"""
+
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+import cv2
+
+import frame_protocol
+
+# Frame size captured by pilot_client.py in JPEG mode, and the input size of the model.
+CAPTURE_SIZE = (480, 320)
+RAW_SIZE = (160, 120)
+
+def parse_args():
+	"""Parse the command line arguments."""
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--images', default='./dataset', help='Folder of class folders with JPEG frames.')
+	parser.add_argument('--frames', type=int, default=200, help='Frames measured per format.')
+	parser.add_argument('--quality', type=int, default=85, help='JPEG quality, picamera uses 85.')
+	parser.add_argument('--links', default='10,20,50,100', help='Link speeds in Mbit/s.')
+	return parser.parse_args()
+
+def load_frames(path, count):
+	"""Load frames from the dataset, scaled to the capture size.
+
+	Falls back to synthetic track-like frames when the dataset is missing.
+	"""
+	paths = sorted(glob.glob(os.path.join(path, '*', '*')))[:count]
+	frames = [cv2.imread(p) for p in paths]
+	frames = [cv2.resize(frame, CAPTURE_SIZE) for frame in frames if frame is not None]
+	if frames:
+		return frames
+
+	print('No images under %s, using synthetic frames' % path)
+	rng = np.random.RandomState(0)
+	frames = []
+	for _ in range(count):
+		frame = np.full((CAPTURE_SIZE[1], CAPTURE_SIZE[0], 3), 180, dtype=np.uint8)
+		x = rng.randint(100, 380)
+		cv2.line(frame, (x, CAPTURE_SIZE[1]), (x + rng.randint(-150, 150), 0), (20, 20, 20), 25)
+		frame += rng.randint(0, 12, size=frame.shape, dtype=np.uint8)  # Sensor noise.
+		frames.append(frame)
+	return frames
+
+def to_raw(frame, frame_format):
+	"""Emulate the camera's GPU resizer: a padded raw frame of RAW_SIZE."""
+	width, height = RAW_SIZE
+	padded_width, padded_height = frame_protocol.raw_padded_size(width, height)
+	padded = np.zeros((padded_height, padded_width, 3), dtype=np.uint8)
+	padded[:height, :width] = cv2.cvtColor(cv2.resize(frame, RAW_SIZE, interpolation=cv2.INTER_AREA),
+										   cv2.COLOR_BGR2RGB)
+	if frame_format == frame_protocol.FORMAT_RGB:
+		return padded.tobytes()
+	return cv2.cvtColor(padded, cv2.COLOR_RGB2YUV_I420).tobytes()
+
+def server_prepare(frame_format, data):
+	"""What the server does before preprocessing: a model-sized image array."""
+	width, height = RAW_SIZE
+	img_array = np.frombuffer(data, dtype=np.uint8)
+	if frame_format == frame_protocol.FORMAT_JPEG:
+		return cv2.resize(cv2.imdecode(img_array, cv2.IMREAD_COLOR), RAW_SIZE)
+	padded_width, padded_height = frame_protocol.raw_padded_size(width, height)
+	if frame_format == frame_protocol.FORMAT_RGB:
+		return img_array.reshape(padded_height, padded_width, 3)[:height, :width]
+	return cv2.cvtColor(img_array.reshape(padded_height * 3 // 2, padded_width),
+						cv2.COLOR_YUV2RGB_I420)[:height, :width]
+
+def main():
+	"""Run the benchmark."""
+	args = parse_args()
+	links = [float(link) for link in args.links.split(',')]
+	frames = load_frames(args.images, args.frames)
+
+	print('%-6s %10s %12s %12s' % ('format', 'bytes', 'encode ms', 'server ms') +
+		  ''.join(' %9s' % ('%g Mb/s' % link) for link in links))
+
+	for name, frame_format in sorted(frame_protocol.FORMAT_NAMES.items(), key=lambda item: item[1]):
+		sizes, encode_times, server_times = [], [], []
+		for frame in frames:
+			start = time.perf_counter()
+			if frame_format == frame_protocol.FORMAT_JPEG:
+				data = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, args.quality])[1].tobytes()
+			else:
+				data = to_raw(frame, frame_format)
+			encode_times.append(time.perf_counter() - start)
+
+			start = time.perf_counter()
+			server_prepare(frame_format, data)
+			server_times.append(time.perf_counter() - start)
+			sizes.append(len(data))
+
+		size = np.mean(sizes)
+		server_ms = np.median(server_times) * 1000
+
+		# Per-frame latency on the wire plus on the server. The Pi encodes JPEG and resizes raw
+		# frames on its GPU, so the encode column is only the CPU cost of doing the same here.
+		latencies = [size * 8 / (link * 1e6) * 1000 + server_ms for link in links]
+		print('%-6s %10d %12.2f %12.2f' % (name, size, np.median(encode_times) * 1000, server_ms) +
+			  ''.join(' %9.2f' % latency for latency in latencies))
+
+	print('Link columns: transfer + server time per frame in ms (lower is better).')
+
+if __name__ == '__main__':
+	main()
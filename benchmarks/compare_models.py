@@ -0,0 +1,145 @@
+"""Compare trained models of models.py on single-frame CPU latency, parameters and validation accuracy.
+
+Train each model with its own output first, e.g.
+
+	python train.py --model nvidia --output models/nvidia.h5
+	python train.py --model tiny --output models/tiny.h5
+
+then run it from the repository root:
+
+	python -m benchmarks.compare_models models/*.h5 --csv models/comparison.csv
+
+The accuracy is measured on a random sample, with a fixed seed, of the validation split of
+train.py (the same hash split of the manifest). There are two deployment targets: the
+server runs the keras model (inference_engine.py), the Pi runs the int8 TFLite copy next
+to it on one thread (tflite_pilot.py). A '*' marks the Pareto-optimal models of a target:
+no other model is both faster and at least as accurate. Models without a TFLite copy are
+only compared for the server.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import argparse
+import csv
+import random
+
+import numpy as np
+import cv2
+
+# Share of the hash split buckets that train.py trains on, the rest is its validation split.
+TRAIN_SET_RATIO = 0.8
+
+def parse_args():
+	"""Parse the command line arguments."""
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('models', nargs='+', help='Keras models saved by train.py.')
+	parser.add_argument('--dataset', default='./dataset', help='Folder of class folders with labelled images.')
+	parser.add_argument('--samples', type=int, default=1000, help='Validation images to evaluate on, 0 for all.')
+	parser.add_argument('--latency-frames', type=int, default=200, help='Frames timed per model.')
+	parser.add_argument('--tflite-threads', type=int, default=1, help='Interpreter threads, like on the Pi.')
+	parser.add_argument('--csv', help='Also write the table to this CSV file.')
+	return parser.parse_args()
+
+def load_val_samples(path, img_size, count):
+	"""Load a random sample of the validation images as uint8 RGB arrays of img_size (h, w), and their labels.
+
+	The manifest lists the images in capture order, so the sample is shuffled with a fixed seed
+	instead of being a run of consecutive frames, like load_samples of bench_tflite.py.
+	"""
+	import dataset_manifest
+
+	label_names, rows = dataset_manifest.update_manifest(path)
+	rows = [row for row in rows if dataset_manifest.split_bucket(row['path']) >= TRAIN_SET_RATIO]
+	random.Random(0).shuffle(rows)
+	if count:
+		rows = rows[:count]
+
+	images, labels = [], []
+	for row in rows:
+		image = cv2.imread(os.path.join(path, row['path']))
+		if image is None:
+			continue
+		image = cv2.resize(image, (img_size[1], img_size[0]), interpolation=cv2.INTER_LINEAR)
+		images.append(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+		labels.append(label_names.index(row['label']))
+	return images, np.array(labels)
+
+def measure(model_path, samples, args):
+	"""Measure a keras model, and its TFLite copy if there is one."""
+	import inference_engine
+	import tflite_pilot
+	from benchmarks.bench_tflite import time_frames
+
+	engine = inference_engine.InferenceEngine(model_path)
+	if engine.img_size not in samples:
+		samples[engine.img_size] = load_val_samples(args.dataset, engine.img_size, args.samples)
+	images, labels = samples[engine.img_size]
+
+	classes = np.array([np.argmax(engine.predict([image], bgr=False)[0]) for image in images])
+	latency = time_frames(lambda image: engine.predict([image], bgr=False), images, args.latency_frames)
+	result = {
+		'model': model_path,
+		'input': '%dx%d' % (engine.img_size[1], engine.img_size[0]),
+		'params': engine.param_count,
+		'accuracy': np.mean(classes == labels),
+		'latency_ms': np.percentile(latency, 50),
+		'tflite_accuracy': None,
+		'tflite_latency_ms': None,
+	}
+
+	tflite_path = os.path.splitext(model_path)[0] + '_int8.tflite'
+	if os.path.exists(tflite_path):
+		pilot = tflite_pilot.TFLitePilot(tflite_path, num_threads=args.tflite_threads)
+		classes = np.array([pilot.predict_class(image) for image in images])
+		latency = time_frames(pilot.predict_class, images, args.latency_frames)
+		result['tflite_accuracy'] = np.mean(classes == labels)
+		result['tflite_latency_ms'] = np.percentile(latency, 50)
+	return result
+
+def pareto_optimal(results, latency_key, accuracy_key):
+	"""Get the indexes of the results no other result beats on both latency and accuracy."""
+	points = [(i, result[latency_key], result[accuracy_key]) for i, result in enumerate(results)
+			  if result[latency_key] is not None]
+	optimal = set()
+	for i, latency, accuracy in points:
+		if not any(other_latency <= latency and other_accuracy >= accuracy
+				   and (other_latency < latency or other_accuracy > accuracy)
+				   for _, other_latency, other_accuracy in points):
+			optimal.add(i)
+	return optimal
+
+def main():
+	"""Run the comparison."""
+	# CPU only, like the deployment targets. Set before TensorFlow gets imported, by measure.
+	os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+	args = parse_args()
+
+	samples = {}  # img_size -> (images, labels), shared by the models of the same input size.
+	results = [measure(model_path, samples, args) for model_path in args.models]
+	server_optimal = pareto_optimal(results, 'latency_ms', 'accuracy')
+	pi_optimal = pareto_optimal(results, 'tflite_latency_ms', 'tflite_accuracy')
+
+	def optional(value, format):
+		return '-' if value is None else format % value
+
+	print('%-28s %8s %10s %9s %9s %11s %11s' % (
+		'model', 'input', 'params', 'accuracy', 'p50 ms', 'int8 acc', 'int8 p50 ms'))
+	for i, result in enumerate(results):
+		print('%-28s %8s %10d %9.4f %8.2f%s %11s %10s%s' % (
+			result['model'], result['input'], result['params'], result['accuracy'], result['latency_ms'],
+			'*' if i in server_optimal else ' ',
+			optional(result['tflite_accuracy'], '%.4f'), optional(result['tflite_latency_ms'], '%.2f'),
+			'*' if i in pi_optimal else ' '))
+	print('* Pareto-optimal: server (keras), Pi (int8 TFLite, %d thread%s)' % (
+		args.tflite_threads, 's' if args.tflite_threads > 1 else ''))
+
+	if args.csv:
+		with open(args.csv, 'w', newline='') as f:
+			writer = csv.DictWriter(f, fieldnames=list(results[0]) + ['server_pareto', 'pi_pareto'])
+			writer.writeheader()
+			for i, result in enumerate(results):
+				writer.writerow(dict(result, server_pareto=int(i in server_optimal), pi_pareto=int(i in pi_optimal)))
+
+if __name__ == '__main__':
+	main()
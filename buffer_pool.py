@@ -0,0 +1,55 @@
+"""Pool of reusable receive buffers, so frames are read without per-frame allocations."""
+
+import collections
+
+class BufferPool(object):
+	"""Class for a pool of byte buffers.
+
+	Buffers are handed out with acquire and given back with release once nothing refers
+	to their content anymore. After a warm-up the pool holds one buffer per frame in flight,
+	and acquiring a buffer no longer allocates memory.
+
+	acquire and release may be called from different threads.
+
+	The sample usage of this class is like:
+
+	'''
+	pool = BufferPool()
+	buffer = pool.acquire(image_len)
+	sock.recv_into(memoryview(buffer)[:image_len])
+	...
+	pool.release(buffer)
+	'''
+	"""
+
+	def __init__(self, min_size=64 * 1024):
+		"""Inits BufferPool.
+
+		Args:
+			min_size: Smallest buffer allocated, so buffers fit most frames of the stream.
+		"""
+		self._min_size = min_size
+		self._free = collections.deque()  # Buffers ready for reuse, append/pop are thread-safe.
+		self._allocated = 0  # Buffers allocated so far.
+
+	@property
+	def allocated(self):
+		"""Get the number of buffers allocated so far."""
+		return self._allocated
+
+	def acquire(self, size):
+		"""Get a buffer of at least size bytes."""
+		try:
+			buffer = self._free.pop()
+		except IndexError:
+			buffer = None
+
+		if buffer is None or len(buffer) < size:
+			# Grow to the biggest frame seen, so the pool settles quickly.
+			buffer = bytearray(max(size, self._min_size, len(buffer) if buffer else 0))
+			self._allocated += 1
+		return buffer
+
+	def release(self, buffer):
+		"""Give a buffer back to the pool."""
+		self._free.append(buffer)
@@ -9,6 +9,52 @@ LEFT_FR_BIAS = 1  # Speed difference between two left wheels.
 RIGHT_FR_BIAS = 1  # Speed difference between two right wheels.
 LEFT_RIGHT_BIAS = 0.2  # Speed difference between left and right wheels.
 
+# Directions of a wheel, a stopped wheel has both direction pins high.
+CLOCKWISE = 'c'
+ANTICLOCKWISE = 'a'
+STOP = 's'
+
+# Levels of (dir_pin_1, dir_pin_2) for each direction.
+DIR_LEVELS = {
+	CLOCKWISE: (GPIO.HIGH, GPIO.LOW),
+	ANTICLOCKWISE: (GPIO.LOW, GPIO.HIGH),
+	STOP: (GPIO.HIGH, GPIO.HIGH),
+}
+
+def forward_command(speed):
+	"""Get the Car.apply command to move forward at a PWM duty cycle."""
+	# You should modify the bias of 4 wheels depending on your hardware.
+	return ((ANTICLOCKWISE, speed + LEFT_FR_BIAS + LEFT_RIGHT_BIAS), (CLOCKWISE, speed + RIGHT_FR_BIAS),
+			(ANTICLOCKWISE, speed + LEFT_RIGHT_BIAS), (CLOCKWISE, speed))
+
+def reverse_command(speed):
+	"""Get the Car.apply command to move reverse at a PWM duty cycle."""
+	return ((CLOCKWISE, speed + LEFT_FR_BIAS + LEFT_RIGHT_BIAS), (ANTICLOCKWISE, speed + RIGHT_FR_BIAS),
+			(CLOCKWISE, speed + LEFT_RIGHT_BIAS), (ANTICLOCKWISE, speed))
+
+def turn_left_command(speed):
+	"""Get the Car.apply command to turn left at a PWM duty cycle."""
+	return ((ANTICLOCKWISE, 1 + LEFT_FR_BIAS + LEFT_RIGHT_BIAS), (CLOCKWISE, speed + RIGHT_FR_BIAS),
+			(ANTICLOCKWISE, 1 + LEFT_RIGHT_BIAS), (CLOCKWISE, speed))
+
+def turn_right_command(speed):
+	"""Get the Car.apply command to turn right at a PWM duty cycle."""
+	return ((ANTICLOCKWISE, speed + LEFT_FR_BIAS + LEFT_RIGHT_BIAS), (CLOCKWISE, 1 + RIGHT_FR_BIAS),
+			(ANTICLOCKWISE, speed + LEFT_RIGHT_BIAS), (CLOCKWISE, 1))
+
+def rotate_left_command(speed):
+	"""Get the Car.apply command to rotate left at a PWM duty cycle."""
+	return ((CLOCKWISE, speed + LEFT_FR_BIAS + LEFT_RIGHT_BIAS), (CLOCKWISE, speed + RIGHT_FR_BIAS),
+			(CLOCKWISE, speed + 1 + LEFT_RIGHT_BIAS), (CLOCKWISE, speed))
+
+def rotate_right_command(speed):
+	"""Get the Car.apply command to rotate right at a PWM duty cycle."""
+	return ((ANTICLOCKWISE, speed + LEFT_FR_BIAS + LEFT_RIGHT_BIAS), (ANTICLOCKWISE, speed + RIGHT_FR_BIAS),
+			(ANTICLOCKWISE, speed + 1 + LEFT_RIGHT_BIAS), (ANTICLOCKWISE, speed))
+
+# Command stopping the 4 wheels, their duty cycles are left as they are.
+STOP_COMMAND = ((STOP, None),) * 4
+
 class Wheel:
 	"""Class for wheel.
 	
@@ -24,7 +70,8 @@ class Wheel:
 
 		self._last_dir = 's'  # Last rotation direction of this wheel. 's' indicates stop.
 		self._last_dc_val = 0  # Last duty cycle value.
-		self._current_dc_val = 0  # Current duty cycle value.
+		self._pin_levels = [None, None]  # Last levels written to the direction pins, unknown at first.
+		self._gpio_ops = 0  # GPIO writes and duty cycle changes issued.
 
 		GPIO.setmode(GPIO.BOARD)
 
@@ -37,21 +84,44 @@ class Wheel:
 		self._motor_pwm = GPIO.PWM(self._pwm_pin, self._pwm_freq)  # pwm_freq: Hz
 		self._motor_pwm.start(0)  # Set duty cycle to 0.
 
+	@property
+	def gpio_ops(self):
+		"""Get the number of GPIO writes and duty cycle changes issued."""
+		return self._gpio_ops
+
+	def apply(self, direction, speed=None):
+		"""Set the direction and speed, writing only the pins and duty cycle that change.
+
+		Args:
+			direction: CLOCKWISE, ANTICLOCKWISE or STOP.
+			speed: PWM duty cycle, None to keep the current one.
+
+		Returns:
+			The number of GPIO operations issued.
+		"""
+		ops = 0
+		for i, (pin, level) in enumerate(zip((self._dir_pin_1, self._dir_pin_2), DIR_LEVELS[direction])):
+			if self._pin_levels[i] != level:
+				GPIO.output(pin, level)
+				self._pin_levels[i] = level
+				ops += 1
+		self._last_dir = direction
+
+		if speed is not None and speed != self._last_dc_val:
+			self._motor_pwm.ChangeDutyCycle(speed)  # 0.0 - 100.0
+			self._last_dc_val = speed
+			ops += 1
+
+		self._gpio_ops += ops
+		return ops
+
 	def clockwise_rotate(self, speed):
 		"""Control the wheel to turn clockwise.
 
 		Args:
 			speed: PWM duty cycle.
 		"""
-		if self._last_dir != 'c':  # "c" indicates that the last rotation of this wheel was clockwise.
-			GPIO.output(self._dir_pin_1, GPIO.HIGH)
-			GPIO.output(self._dir_pin_2, GPIO.LOW)
-			self._last_dir = 'c'
-
-		self._current_dc_val = speed
-		if self._current_dc_val != self._last_dc_val:
-			self._motor_pwm.ChangeDutyCycle(speed)  # 0.0 - 100.0
-			self._last_dc_val = self._current_dc_val
+		self.apply(CLOCKWISE, speed)
 
 	def anticlockwise_rotate(self, speed):
 		"""Control the wheel to turn anticlockwise.
@@ -59,21 +129,11 @@ class Wheel:
 		Args:
 			speed: PWM duty cycle.
 		"""
-		if self._last_dir != 'a':  # "a" indicates that the last rotation of this wheel was anticlockwise.
-			GPIO.output(self._dir_pin_1, GPIO.LOW)
-			GPIO.output(self._dir_pin_2, GPIO.HIGH)
-			self._last_dir = 'a'
-
-		self._current_dc_val = speed
-		if self._current_dc_val != self._last_dc_val:
-			self._motor_pwm.ChangeDutyCycle(speed)  # 0.0 - 100.0
-			self._last_dc_val = self._current_dc_val
+		self.apply(ANTICLOCKWISE, speed)
 
 	def stop(self):
 		"""Stop the wheel from turning."""
-		GPIO.output(self._dir_pin_1, GPIO.HIGH)
-		GPIO.output(self._dir_pin_2, GPIO.HIGH)
-		self._last_dir = 's'
+		self.apply(STOP)
 		# self._motor_pwm.ChangeDutyCycle(0)
 
 
@@ -95,7 +155,7 @@ class Car:
 	my_car = Car(front_left_wheel, front_right_wheel,
 					rear_left_wheel, rear_right_wheel)
 
-	my_car.move_forward(4)
+	my_car.move_forward(4)  # Or my_car.apply(forward_command(4)).
 	print('forward')
 	time.sleep(4)
 	my_car.rotate_left(4)
@@ -107,6 +167,9 @@ class Car:
 
 	GPIO.cleanup()
 	'''
+
+	Every move applies a command, the target state of the 4 wheels. A command equal to the
+	current state issues no GPIO operation at all, so it can be applied on every frame.
 	"""
 
 	def __init__(self, front_left_wheel, front_right_wheel,
@@ -116,6 +179,36 @@ class Car:
 		self._front_right_wheel = front_right_wheel
 		self._rear_left_wheel = rear_left_wheel
 		self._rear_right_wheel = rear_right_wheel
+		self._wheels = (front_left_wheel, front_right_wheel, rear_left_wheel, rear_right_wheel)
+		self._command = None  # Last command applied, None when unknown.
+		self._gpio_ops = 0
+
+	@property
+	def gpio_ops(self):
+		"""Get the number of GPIO writes and duty cycle changes issued by apply."""
+		return self._gpio_ops
+
+	def apply(self, command):
+		"""Drive the 4 wheels to a target state, issuing only the GPIO operations that change it.
+
+		Don't drive the wheels directly in between, the car would not notice.
+
+		Args:
+			command: (direction, duty cycle) of the front left, front right, rear left and rear
+				right wheels, e.g. forward_command(4). The direction is CLOCKWISE, ANTICLOCKWISE
+				or STOP, a None duty cycle keeps the current one.
+
+		Returns:
+			The number of GPIO operations issued, 0 if the car was in that state already.
+		"""
+		if command == self._command:
+			return 0
+		ops = 0
+		for wheel, (direction, speed) in zip(self._wheels, command):
+			ops += wheel.apply(direction, speed)
+		self._command = command
+		self._gpio_ops += ops
+		return ops
 
 	def move_forward(self, speed):
 		"""Control the car to move forward.
@@ -123,11 +216,7 @@ class Car:
 		Args:
 			speed: PWM duty cycle.
 		"""
-		# You should modify the bias of 4 wheels depending on your hardware.
-		self._front_left_wheel.anticlockwise_rotate(speed + LEFT_FR_BIAS + LEFT_RIGHT_BIAS)
-		self._front_right_wheel.clockwise_rotate(speed + RIGHT_FR_BIAS)
-		self._rear_left_wheel.anticlockwise_rotate(speed + LEFT_RIGHT_BIAS)
-		self._rear_right_wheel.clockwise_rotate(speed)
+		self.apply(forward_command(speed))
 
 	def move_reverse(self, speed):
 		"""Control the car to move reverse.
@@ -135,11 +224,7 @@ class Car:
 		Args:
 			speed: PWM duty cycle.
 		"""
-		# You should modify the bias of 4 wheels depending on your hardware.
-		self._front_left_wheel.clockwise_rotate(speed + LEFT_FR_BIAS + LEFT_RIGHT_BIAS)
-		self._front_right_wheel.anticlockwise_rotate(speed + RIGHT_FR_BIAS)
-		self._rear_left_wheel.clockwise_rotate(speed + LEFT_RIGHT_BIAS)
-		self._rear_right_wheel.anticlockwise_rotate(speed)
+		self.apply(reverse_command(speed))
 
 	def turn_left(self, speed):
 		"""Control the car to turn left.
@@ -147,11 +232,7 @@ class Car:
 		Args:
 			speed: PWM duty cycle.
 		"""
-		# You should modify the bias of 4 wheels depending on your hardware.
-		self._front_left_wheel.anticlockwise_rotate(1 + LEFT_FR_BIAS + LEFT_RIGHT_BIAS)
-		self._front_right_wheel.clockwise_rotate(speed + RIGHT_FR_BIAS)
-		self._rear_left_wheel.anticlockwise_rotate(1 + LEFT_RIGHT_BIAS)
-		self._rear_right_wheel.clockwise_rotate(speed)
+		self.apply(turn_left_command(speed))
 
 	def turn_right(self, speed):
 		"""Control the car to turn right.
@@ -159,11 +240,7 @@ class Car:
 		Args:
 			speed: PWM duty cycle.
 		"""
-		# You should modify the bias of 4 wheels depending on your hardware.
-		self._front_left_wheel.anticlockwise_rotate(speed + LEFT_FR_BIAS + LEFT_RIGHT_BIAS)
-		self._front_right_wheel.clockwise_rotate(1 + RIGHT_FR_BIAS)
-		self._rear_left_wheel.anticlockwise_rotate(speed + LEFT_RIGHT_BIAS)
-		self._rear_right_wheel.clockwise_rotate(1)
+		self.apply(turn_right_command(speed))
 
 	def rotate_left(self, speed):
 		"""Control the car to rotate left.
@@ -171,11 +248,7 @@ class Car:
 		Args:
 			speed: PWM duty cycle.
 		"""
-		# You should modify the bias of 4 wheels depending on your hardware.
-		self._front_left_wheel.clockwise_rotate(speed + LEFT_FR_BIAS + LEFT_RIGHT_BIAS)
-		self._front_right_wheel.clockwise_rotate(speed + RIGHT_FR_BIAS)
-		self._rear_left_wheel.clockwise_rotate(speed + 1 + LEFT_RIGHT_BIAS)
-		self._rear_right_wheel.clockwise_rotate(speed)
+		self.apply(rotate_left_command(speed))
 
 	def rotate_right(self, speed):
 		"""Control the car to roate right.
@@ -183,15 +256,8 @@ class Car:
 		Args:
 			speed: PWM duty cycle.
 		"""
-		# You should modify the bias of 4 wheels depending on your hardware.
-		self._front_left_wheel.anticlockwise_rotate(speed + LEFT_FR_BIAS + LEFT_RIGHT_BIAS)
-		self._front_right_wheel.anticlockwise_rotate(speed + RIGHT_FR_BIAS)
-		self._rear_left_wheel.anticlockwise_rotate(speed + 1 + LEFT_RIGHT_BIAS)
-		self._rear_right_wheel.anticlockwise_rotate(speed)
+		self.apply(rotate_right_command(speed))
 
 	def stop(self):
 		"""Stop the car from moving."""
-		self._front_left_wheel.stop()
-		self._front_right_wheel.stop()
-		self._rear_left_wheel.stop()
-		self._rear_right_wheel.stop()
+		self.apply(STOP_COMMAND)
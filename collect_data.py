@@ -4,12 +4,48 @@
 """
 
 import time
+import signal
 import threading
 
 import pygame
 import cv2 as cv
 
 import car
+import frame_dedup
+import image_writer
+import label_timeline
+import preview
+import session_recording
+
+# Set it to True to show no camera preview, so no time is spent drawing it.
+# Quit by closing the keyboard window, with Ctrl+C, SIGTERM or by typing q and Enter.
+HEADLESS = False
+
+# Maximum refresh rate of the camera preview.
+PREVIEW_FPS = 10
+
+# The images are encoded and written by a pool of threads, so slow SD card writes don't stall the capture.
+# Images beyond WRITER_QUEUE waiting ones are dropped (about 2 s at 30 fps).
+WRITER_THREADS = 2
+WRITER_QUEUE   = 64
+
+# Set it to True to append the frames to chunked session files under SESSION_DIR instead of
+# writing one file per frame into the class folders. Export them with dataset_packer.py --sessions.
+RECORD_SESSION = False
+SESSION_DIR    = './sessions'
+
+# Frames nearly identical to the last one saved of their class are skipped, e.g. while the car sits still.
+# Mean absolute difference of their thumbnails in 0-255 levels, 0 saves every frame. See frame_dedup.py.
+DEDUP_THRESHOLD = 3.0
+
+# Milliseconds the keyboard thread waits for an event before checking whether to stop.
+EVENT_WAIT_MS = 500
+
+# Class folder of the frames captured while a key is held, the frames of a stopped car are not saved.
+KEY_LABELS = {'f': 'move_forward', 'l': 'move_left', 'r': 'move_right'}
+
+# Set to stop both the keyboard and the capture thread.
+stop = threading.Event()
 
 def cam_init(dev_nu=0, view_width=320, view_height=240, fps=30):
 	"""Initialize the camera with the parameters.
@@ -79,117 +115,149 @@ def car_init():
 					rear_left_wheel, rear_right_wheel)
 	return my_car
 
-def car_control(keyboard, car):
+def car_control(keyboard, car, timeline):
 	"""Control the movement of the car using keyboard.
 
+	The thread sleeps until a key event comes, instead of polling the event queue.
+
 	Args:
 		keyboard: Keyboard to handle key events.
 		car: Car object to control the movement.
+		timeline: label_timeline.LabelTimeline of the key flags, the frames are classified
+			with the key flag at their capture time.
 	"""
-	# A key flag indicating which key has been pressed.
-	# This key flag will be used to classify the images.
-	global key_flag
-
-	# Start handle the key enents in this infinite loop.
-	while True:
-		for event in keyboard.event.get():
-
-			# Capture key press events.
-			if event.type == keyboard.KEYDOWN:
-
-				# Get the key value.
-				key_input = keyboard.key.get_pressed()
-
-				# When you press the up arrow key, control the car to move forward.
-				if key_input[keyboard.K_UP]:
-					# Sets the PWM value to the car.
-					car.move_forward(4)
-					key_flag = 'f'	# Update the key flag.
-					print('Move forward')
-
-				# When you press the left arrow key, control the car to turn left.
-				elif key_input[keyboard.K_LEFT]:
-					# Sets the PWM value to the car.
-					car.rotate_left(4)
-					key_flag = 'l'	# Update the key flag.
-					print('Ture left')
-
-				# When you press the right arrow key, control the car to turn right.
-				elif key_input[keyboard.K_RIGHT]:
-					# Sets the PWM value to the car.
-					car.rotate_right(4)
-					key_flag = 'r'	# Update the key flag.
-					print('Ture right')
-
-			# Capture key up events.
-			# After releasing the key, control the car to stop moving.
-			elif event.type == keyboard.KEYUP:
-				# Stop the car.
-				car.stop()
-				key_flag = 's'	# Update the key flag.
-				print('Stop')
-
-			# Quit key events loop.
-			elif event.type == keyboard.QUIT:
-				raise SystemExit
-
-def capture_img(camera, path, img_size):
-	"""Capture the image and save it to the corresponding folder based on the key flag.
+	# Only these events wake the thread up, not the mouse moving over the window.
+	keyboard.event.set_blocked(None)
+	keyboard.event.set_allowed([keyboard.KEYDOWN, keyboard.KEYUP, keyboard.QUIT])
+
+	# Start handle the key enents in this loop, until the program is stopped.
+	while not stop.is_set():
+		event = keyboard.event.wait(EVENT_WAIT_MS)
+		event_time = time.monotonic()
+
+		# Capture key press events.
+		if event.type == keyboard.KEYDOWN:
+
+			# Get the key value.
+			key_input = keyboard.key.get_pressed()
+
+			# When you press the up arrow key, control the car to move forward.
+			if key_input[keyboard.K_UP]:
+				# Sets the PWM value to the car.
+				car.move_forward(4)
+				timeline.set('f', event_time)	# Update the key flag.
+				print('Move forward')
+
+			# When you press the left arrow key, control the car to turn left.
+			elif key_input[keyboard.K_LEFT]:
+				# Sets the PWM value to the car.
+				car.rotate_left(4)
+				timeline.set('l', event_time)	# Update the key flag.
+				print('Ture left')
+
+			# When you press the right arrow key, control the car to turn right.
+			elif key_input[keyboard.K_RIGHT]:
+				# Sets the PWM value to the car.
+				car.rotate_right(4)
+				timeline.set('r', event_time)	# Update the key flag.
+				print('Ture right')
+
+		# Capture key up events.
+		# After releasing the key, control the car to stop moving.
+		elif event.type == keyboard.KEYUP:
+			# Stop the car.
+			car.stop()
+			timeline.set('s', event_time)	# Update the key flag.
+			print('Stop')
+
+		# Quit key events loop.
+		elif event.type == keyboard.QUIT:
+			stop.set()
+
+def capture_img(camera, path, img_size, timeline, writer, viewer=None, recording=False, dedup=None):
+	"""Capture the image and save it to the corresponding folder based on the key flag at its capture time.
 
 	Args:
 		camera: The camera object to capture images.
 		path: The image file save path.
 		img_size: The tuple of image size.
+		timeline: label_timeline.LabelTimeline of the key flags.
+		writer: image_writer.AsyncImageWriter saving the images in the background.
+		viewer: Preview showing the frames, None to show nothing.
+		recording: Whether the writer appends to a session_recording.SessionRecorder,
+			keyed by (label, monotonic time), instead of writing files.
+		dedup: frame_dedup.DedupFilter skipping the near-duplicate frames, None to save them all.
 	"""
-	# The key flag used to classify the images.
-	global key_flag
-
-	while True:
-		# Capture frame-by-frame
-		ret, frame = camera.read()
+	while not stop.is_set():
+		# Capture frame-by-frame, the frame is taken from the camera when grab returns.
+		ret = camera.grab()
+		captured = time.monotonic()
+		captured_wall = time.time()
+		if ret:
+			ret, frame = camera.retrieve()
 
 		# If frame is read correctly ret is True
 		if not ret:
 			print("Can't receive frame. Exiting ....")
 			break
 
-		# Preview the image.
-		cv.imshow('image', frame)
+		# Preview the image, at most PREVIEW_FPS times a second on the preview thread.
+		if viewer:
+			viewer.show('image', frame)
 
 		# Core operation on the frame
 		img_resized = cv.resize(frame, img_size)
 
-		# If the key flag at this time is f(forward), save the image to the move_forward folder.
-		if key_flag == 'f':
-			cv.imwrite(path + 'move_forward/' + str(time.time()) + '.jpg', img_resized)
-
-		# If the key flag at this time is l(left), save the image to the turn_left folder.
-		elif key_flag == 'l':
-			cv.imwrite(path + 'move_left/' + str(time.time()) + '.jpg', img_resized)
-
-		# If the key flag at this time is r(right), save the image to the turn_right folder.
-		elif key_flag == 'r':
-			cv.imwrite(path + 'move_right/' + str(time.time()) + '.jpg', img_resized)
-
-		# When you press the 'q' key, quit image capture.
-		if cv.waitKey(1) & 0xff == ord('q'):
-			break
+		# If the key flag at the capture time is f(forward), l(left) or r(right), save the image with its class.
+		label = KEY_LABELS.get(timeline.label_at(captured))
+		if label is None:
+			continue
+		new, reference = dedup.check(img_resized, label) if dedup else (True, None)
+		if not new:
+			continue
+		if recording:
+			queued = writer.write((label, captured), img_resized)
+		else:
+			queued = writer.write(path + label + '/' + str(captured_wall) + '.jpg', img_resized)
+
+		# A frame dropped by the writer must not become the reference of the next ones.
+		if dedup and queued:
+			dedup.commit(label, reference)
 
 	# When everything done, release the capture
 	camera.release()
+	stop.set()
 
 if __name__ == '__main__':
 	# Initialize the key flag to s(stop).
-	key_flag = 's'
+	timeline = label_timeline.LabelTimeline('s')
 
 	# Initialize camera, keyboaard and the car.
 	camera   = cam_init()
 	keyboard = keyboard_init()
 	my_car   = car_init()
 
+	# Quit from the preview window ('q' key), the terminal or with a signal.
+	viewer = None
+	if not HEADLESS:
+		viewer = preview.Preview(max_fps=PREVIEW_FPS, on_quit=stop.set)
+		viewer.start()
+	preview.watch_stdin(stop.set)
+	signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+	signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+
+	recorder = None
+	if RECORD_SESSION:
+		recorder = session_recording.SessionRecorder(SESSION_DIR, sorted(KEY_LABELS.values()))
+		print('Recording the session to %s' % recorder.path)
+	writer = image_writer.AsyncImageWriter(threads=WRITER_THREADS, max_queue=WRITER_QUEUE,
+										   sink=recorder.append if recorder else None)
+	writer.start()
+	dedup = frame_dedup.DedupFilter(DEDUP_THRESHOLD)
+
 	# Create 2 threads to handle keypress and image capture tasks in parallel.
-	controller = threading.Thread(target=car_control, args=(keyboard, my_car,))
-	capturer   = threading.Thread(target=capture_img, args=(camera, './dataset/', (160, 120),))
+	controller = threading.Thread(target=car_control, args=(keyboard, my_car, timeline,))
+	capturer   = threading.Thread(target=capture_img, args=(camera, './dataset/', (160, 120), timeline, writer, viewer, bool(recorder), dedup,))
 
 	# Start the car control thread.
 	controller.start()
@@ -197,6 +265,17 @@ if __name__ == '__main__':
 	# Start the image capture thread.
 	capturer.start()
 
-	# Block the main thread until the child thread exits.
+	# Block the main thread until the program is stopped, the signals are handled in between.
+	while not stop.wait(0.5):
+		writer.maybe_report()
+
+	# Wait for the child threads to exit, then write the images still queued.
 	controller.join()
 	capturer.join()
+	my_car.stop()
+	writer.close()
+	print(dedup.report())
+	if recorder:
+		recorder.close()
+	if viewer:
+		viewer.close()
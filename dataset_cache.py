@@ -0,0 +1,150 @@
+"""Content-addressed cache chunks for tf.data pipelines.
+
+A dataset is cached in chunks of a few hundred images, each one in files named after a
+fingerprint of what it holds (the files, their sizes and mtimes, the image size and the
+preprocessing version). A changed input gets a new name, so a stale cache is never read,
+and two trainings in the same directory share the chunks they have in common.
+A chunk is complete once tf.data wrote its .index file, so an interrupted first epoch
+only loses the chunks it was writing. Old chunks are removed least recently used first.
+"""
+
+import os
+import errno
+import fcntl
+import glob
+import hashlib
+import json
+
+def fingerprint(value):
+	"""Get a hex digest of a JSON-serializable value."""
+	return hashlib.sha1(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()
+
+def file_signature(path):
+	"""Get (absolute path, size, mtime) of a file, which changes with its content."""
+	stat = os.stat(path)
+	return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+class ChunkCache(object):
+	"""Class for a directory of tf.data cache chunks.
+
+	A process building a chunk holds an flock on its .lock file until it exits, so
+	another process wanting the same incomplete chunk doesn't write it at the same time.
+
+	The sample usage of this class is like:
+
+	'''
+	cache = ChunkCache('./cache', max_bytes=20 * 1024 ** 3)
+	key = fingerprint([file_signature(path) for path in chunk_paths] + [img_size])
+	ds = load_chunk(chunk_paths).cache(filename=cache.prefix(key))
+	cache.cleanup(keep=[key])
+	'''
+	"""
+
+	def __init__(self, root='./cache', max_bytes=20 * 1024 ** 3):
+		"""Inits ChunkCache.
+
+		Args:
+			root: Directory of the cache files.
+			max_bytes: Size the cache is trimmed to by cleanup.
+		"""
+		self._root = root
+		self._max_bytes = max_bytes
+		self._locks = {}  # Key -> open lock file of the chunks this process builds.
+		if not os.path.isdir(root):
+			os.makedirs(root)
+
+	def _prefix(self, key):
+		"""Get the path prefix of the files of a chunk."""
+		return os.path.join(self._root, key)
+
+	def is_complete(self, key):
+		"""Whether a chunk was completely written."""
+		return os.path.exists(self._prefix(key) + '.index')
+
+	def _try_lock(self, key):
+		"""Lock a chunk for this process.
+
+		Returns:
+			The open lock file, None if another process holds the lock.
+		"""
+		lock = open(self._prefix(key) + '.lock', 'w')
+		try:
+			fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except (IOError, OSError) as e:
+			lock.close()
+			if e.errno in (errno.EAGAIN, errno.EACCES):
+				return None
+			raise
+		return lock
+
+	def _remove_files(self, key):
+		"""Remove the data files of a chunk, e.g. left by an interrupted build."""
+		for path in glob.glob(self._prefix(key) + '*'):
+			if not path.endswith('.lock'):
+				os.remove(path)
+
+	def prefix(self, key):
+		"""Get the filename to give to Dataset.cache for a chunk.
+
+		Marks a complete chunk as recently used. An incomplete chunk is locked for this
+		process and the files of an interrupted build are removed.
+
+		Args:
+			key: Fingerprint of the chunk.
+
+		Returns:
+			The filename, or '' (cache in memory, for the current iteration only) if another
+			process is building the chunk.
+		"""
+		prefix = self._prefix(key)
+		if self.is_complete(key):
+			os.utime(prefix + '.index', None)
+			return prefix
+
+		if key not in self._locks:
+			lock = self._try_lock(key)
+			if lock is None:
+				return ''
+			self._locks[key] = lock
+			self._remove_files(key)
+		return prefix
+
+	def cleanup(self, keep=()):
+		"""Remove the least recently used chunks until the cache fits max_bytes.
+
+		Args:
+			keep: Keys of the chunks in use, never removed.
+		"""
+		sizes, last_use = {}, {}
+		for path in glob.glob(os.path.join(self._root, '*')):
+			key = os.path.basename(path).split('.')[0].split('_')[0]
+			try:
+				stat = os.stat(path)
+			except OSError:
+				continue
+			sizes[key] = sizes.get(key, 0) + stat.st_size
+			if path.endswith('.index') or key not in last_use:
+				last_use[key] = stat.st_mtime
+
+		keep = set(keep) | set(self._locks)
+		total = sum(sizes.values())
+		for key in sorted(last_use, key=last_use.get):
+			if total <= self._max_bytes:
+				break
+			if key in keep:
+				continue
+
+			# Skip the chunks another process is building.
+			lock = self._try_lock(key)
+			if lock is None:
+				continue
+			self._remove_files(key)
+			os.remove(self._prefix(key) + '.lock')
+			lock.close()
+			total -= sizes[key]
+
+	def release(self):
+		"""Release the locks of the chunks built by this process."""
+		for lock in self._locks.values():
+			lock.close()
+		self._locks = {}
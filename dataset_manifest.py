@@ -0,0 +1,100 @@
+"""Persisted index of the images of the dataset folder, updated incrementally.
+
+manifest.csv, in the dataset folder, holds one row per image: its path relative to the
+dataset folder, its label (class folder), size, mtime and capture timestamp. update_manifest
+lists the class folders with os.scandir and only stats the new files, so a rescan of a big
+dataset costs a directory listing. The training/validation split comes from a hash of each
+path, so it is the same on every run and a new collection session only adds rows.
+"""
+
+import os
+import csv
+import zlib
+
+# Name of the manifest in the dataset folder.
+MANIFEST_NAME = 'manifest.csv'
+
+FIELDS = ['path', 'label', 'size', 'mtime_ns', 'timestamp']
+
+def capture_timestamp(path, mtime=None):
+	"""Get the capture time of an image in seconds.
+
+	collect_data.py names the images after their capture time, e.g. 1573975293.9194663.jpg,
+	the modification time is used for the others.
+	"""
+	try:
+		return float(os.path.splitext(os.path.basename(path))[0])
+	except ValueError:
+		return os.path.getmtime(path) if mtime is None else mtime
+
+def split_bucket(path):
+	"""Get a stable number in [0, 1) of a relative image path, deciding its split."""
+	return (zlib.crc32(path.encode('utf-8')) & 0xffffffff) / 2.0 ** 32
+
+def read_manifest(img_path):
+	"""Read the manifest of a dataset folder.
+
+	Returns:
+		A dict of relative path -> row, empty if there is no manifest yet.
+	"""
+	manifest_path = os.path.join(img_path, MANIFEST_NAME)
+	if not os.path.exists(manifest_path):
+		return {}
+
+	rows = {}
+	with open(manifest_path, newline='') as f:
+		for row in csv.DictReader(f):
+			rows[row['path']] = {'path': row['path'], 'label': row['label'], 'size': int(row['size']),
+								 'mtime_ns': int(row['mtime_ns']), 'timestamp': float(row['timestamp'])}
+	return rows
+
+def write_manifest(img_path, rows):
+	"""Replace the manifest of a dataset folder, atomically."""
+	manifest_path = os.path.join(img_path, MANIFEST_NAME)
+	with open(manifest_path + '.tmp', 'w', newline='') as f:
+		writer = csv.DictWriter(f, fieldnames=FIELDS)
+		writer.writeheader()
+		for row in rows:
+			writer.writerow(dict(row, timestamp=repr(row['timestamp'])))
+	os.replace(manifest_path + '.tmp', manifest_path)
+
+def update_manifest(img_path, verify=False):
+	"""Scan the class folders and bring the manifest up to date.
+
+	Args:
+		img_path: Folder of class folders.
+		verify: Whether to stat the known files too, to notice images changed in place
+			(collect_data.py never does that).
+
+	Returns:
+		(class names, rows sorted by capture timestamp).
+	"""
+	old_rows = read_manifest(img_path)
+	label_names = sorted(entry.name for entry in os.scandir(img_path) if entry.is_dir())
+
+	rows = []
+	changed = False
+	for label in label_names:
+		with os.scandir(os.path.join(img_path, label)) as entries:
+			for entry in entries:
+				if not entry.is_file():
+					continue
+
+				path = label + '/' + entry.name
+				row = old_rows.get(path)
+				if row is None or verify:
+					stat = entry.stat()
+					if row is None or row['size'] != stat.st_size or row['mtime_ns'] != stat.st_mtime_ns:
+						row = {'path': path, 'label': label, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+							   'timestamp': capture_timestamp(entry.path, stat.st_mtime)}
+						changed = True
+				rows.append(row)
+
+	# Some files were removed.
+	if len(rows) != len(old_rows):
+		changed = True
+
+	rows.sort(key=lambda row: (row['timestamp'], row['path']))
+	if changed:
+		write_manifest(img_path, rows)
+	return label_names, rows
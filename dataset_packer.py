@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+"""Pack the class folders of the dataset into sharded TFRecord files.
+
+Reading hundreds of thousands of small JPEGs costs an open and a stat per image, which
+dominates an epoch, especially off the Pi's SD card. The shards hold the encoded images as
+they are (no re-encode), with their label, capture timestamp and original path, and
+index.json lists the shards and class names for ImageDataset(backend='tfrecord').
+The images are shuffled across the shards, so every shard holds a mix of all classes.
+The training/validation split is the hash split of dataset_manifest.py, applied to each
+record: every record stores its split bucket, and the index counts the records of each
+shard by split bucket, so the split sizes are known without reading the shards.
+The sessions recorded by collect_data.py (see session_recording.py) are packed the same way.
+
+Usage:
+	python dataset_packer.py --dataset ./dataset --output ./dataset_packed --shard-size 2000
+	python dataset_packer.py --sessions ./sessions --output ./dataset_packed
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import argparse
+import functools
+import json
+import random
+
+import tensorflow as tf
+
+import dataset_manifest
+import session_recording
+
+# Name of the index file written next to the shards.
+INDEX_NAME = 'index.json'
+
+# Resolution of the split buckets counted in the index, the split ratios are rounded to it.
+SPLIT_BUCKETS = 1000
+
+# Features of a packed image.
+FEATURES = {
+	'image': tf.io.FixedLenFeature([], tf.string),  # Encoded image, as read from the file.
+	'label': tf.io.FixedLenFeature([], tf.int64),
+	'timestamp': tf.io.FixedLenFeature([], tf.int64),  # Capture time in microseconds.
+	'path': tf.io.FixedLenFeature([], tf.string),
+	'split_bucket': tf.io.FixedLenFeature([], tf.int64),  # split_bucket_index of the path.
+}
+
+def read_index(path):
+	"""Read the index of a packed dataset.
+
+	Returns:
+		A dict with 'label_names', 'img_count', 'split_buckets' (SPLIT_BUCKETS of the packing) and
+		'shards', a list of {'file', 'count', 'class_counts', 'bucket_counts'}. bucket_counts maps
+		a split bucket (see split_bucket_index) to the class counts of the records of the shard in it.
+	"""
+	with open(os.path.join(path, INDEX_NAME)) as f:
+		return json.load(f)
+
+def split_bucket_index(path):
+	"""Get the split bucket of a record path, in [0, SPLIT_BUCKETS)."""
+	return int(dataset_manifest.split_bucket(path) * SPLIT_BUCKETS)
+
+def write_shards(items, label_names, output_path, shard_size=2000, seed=0):
+	"""Write images to shuffled TFRecord shards and their index.
+
+	Args:
+		items: A list of {'path', 'label' (index), 'timestamp' (seconds), 'read' (function getting the image data)}.
+		label_names: Class names in label order.
+		output_path: Folder to write the shards and the index to.
+		shard_size: Approximate number of images per shard.
+		seed: Seed of the shuffle spreading the images over the shards.
+
+	Returns:
+		The index written to output_path.
+	"""
+	items = sorted(items, key=lambda item: item['path'])
+	random.Random(seed).shuffle(items)
+
+	if not os.path.isdir(output_path):
+		os.makedirs(output_path)
+
+	shard_count = max(1, (len(items) + shard_size - 1) // shard_size)
+	shards = []
+	for shard in range(shard_count):
+		name = 'shard-%05d-of-%05d.tfrecord' % (shard, shard_count)
+		shard_items = items[shard::shard_count]
+		class_counts = [0] * len(label_names)
+		bucket_counts = {}
+
+		with tf.io.TFRecordWriter(os.path.join(output_path, name)) as writer:
+			for item in shard_items:
+				class_counts[item['label']] += 1
+				bucket = split_bucket_index(item['path'])
+				bucket_counts.setdefault(str(bucket), [0] * len(label_names))[item['label']] += 1
+				example = tf.train.Example(features=tf.train.Features(feature={
+					'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[item['read']()])),
+					'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[item['label']])),
+					'timestamp': tf.train.Feature(int64_list=tf.train.Int64List(
+						value=[int(item['timestamp'] * 1e6)])),
+					'path': tf.train.Feature(bytes_list=tf.train.BytesList(value=[item['path'].encode('utf-8')])),
+					'split_bucket': tf.train.Feature(int64_list=tf.train.Int64List(value=[bucket])),
+				}))
+				writer.write(example.SerializeToString())
+
+		shards.append({'file': name, 'count': len(shard_items), 'class_counts': class_counts,
+					   'bucket_counts': bucket_counts})
+
+	index = {'label_names': label_names, 'img_count': len(items), 'split_buckets': SPLIT_BUCKETS, 'shards': shards}
+	with open(os.path.join(output_path, INDEX_NAME), 'w') as f:
+		json.dump(index, f, indent=1)
+	return index
+
+def read_file(path):
+	"""Get the content of a file."""
+	with open(path, 'rb') as f:
+		return f.read()
+
+def pack_dataset(img_path, output_path, shard_size=2000, seed=0):
+	"""Pack a folder of class folders into TFRecord shards.
+
+	Args:
+		img_path: Folder of class folders, e.g. ./dataset.
+		output_path: Folder to write the shards and the index to.
+		shard_size: Approximate number of images per shard.
+		seed: Seed of the shuffle spreading the images over the shards.
+
+	Returns:
+		The index written to output_path.
+	"""
+	# The manifest knows the labels and capture timestamps, and is updated incrementally.
+	label_names, rows = dataset_manifest.update_manifest(img_path)
+	label_to_index = dict((name, index) for index, name in enumerate(label_names))
+
+	items = [{'path': row['path'], 'label': label_to_index[row['label']], 'timestamp': row['timestamp'],
+			  'read': functools.partial(read_file, os.path.join(img_path, row['path']))} for row in rows]
+	return write_shards(items, label_names, output_path, shard_size, seed)
+
+def pack_sessions(session_root, output_path, shard_size=2000, seed=0):
+	"""Pack the recorded sessions under a folder into TFRecord shards.
+
+	Args:
+		session_root: Folder of the sessions, e.g. ./sessions.
+		output_path: Folder to write the shards and the index to.
+		shard_size: Approximate number of images per shard.
+		seed: Seed of the shuffle spreading the images over the shards.
+
+	Returns:
+		The index written to output_path.
+	"""
+	sessions = [session_recording.SessionReader(path) for path in session_recording.find_sessions(session_root)]
+	label_names = sorted(set(name for session in sessions for name in session.label_names))
+	label_to_index = dict((name, index) for index, name in enumerate(label_names))
+
+	# The images are read from the chunks while writing the shards, a record path names the chunk and offset.
+	items = []
+	for session in sessions:
+		session_name = os.path.basename(session.path)
+		for chunk_path, position, length, timestamp, label in session.records():
+			items.append({'path': '%s/%s@%d' % (session_name, os.path.basename(chunk_path), position),
+						  'label': label_to_index[session.label_names[label]], 'timestamp': timestamp,
+						  'read': functools.partial(session.read, chunk_path, position, length)})
+	try:
+		return write_shards(items, label_names, output_path, shard_size, seed)
+	finally:
+		for session in sessions:
+			session.close()
+
+def parse_args():
+	"""Parse the command line arguments."""
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--dataset', default='./dataset', help='Folder of class folders with labelled images.')
+	parser.add_argument('--sessions', help='Folder of sessions recorded by collect_data.py, packed instead of --dataset.')
+	parser.add_argument('--output', default='./dataset_packed', help='Folder to write the shards to.')
+	parser.add_argument('--shard-size', type=int, default=2000, help='Approximate number of images per shard.')
+	parser.add_argument('--seed', type=int, default=0, help='Seed of the shuffle over the shards.')
+	return parser.parse_args()
+
+if __name__ == '__main__':
+	args = parse_args()
+	if args.sessions:
+		index = pack_sessions(args.sessions, args.output, shard_size=args.shard_size, seed=args.seed)
+	else:
+		index = pack_dataset(args.dataset, args.output, shard_size=args.shard_size, seed=args.seed)
+	print('Packed %d images of %d classes into %d shards under %s' % (
+		index['img_count'], len(index['label_names']), len(index['shards']), args.output))
@@ -0,0 +1,117 @@
+"""Collect frames from many clients into micro-batches for one forward pass each."""
+
+import asyncio
+import concurrent.futures
+import time
+
+class DynamicBatcher(object):
+	"""Class for cross-client dynamic batching.
+
+	Frames submitted by all the connected cars are queued, and a single batching loop
+	takes up to max_batch_size of them, waiting at most max_wait_ms after the first one,
+	and runs them through the model in one call. The model runs on a worker thread,
+	so the event loop keeps receiving frames (which form the next batch) meanwhile.
+
+	The sample usage of this class is like:
+
+	'''
+	batcher = DynamicBatcher(predict_batch, max_batch_size=8, max_wait_ms=5)
+	asyncio.ensure_future(batcher.run())
+
+	# In a client handler coroutine:
+	key = await batcher.submit(image)
+	'''
+	"""
+
+	def __init__(self, predict_fn, max_batch_size, max_wait_ms, timer=None):
+		"""Inits DynamicBatcher.
+
+		Args:
+			predict_fn: Function taking a list of images and returning one result per image.
+			max_batch_size: Maximum number of frames in one forward pass.
+			max_wait_ms: Maximum time to wait for more frames once the first one is queued.
+			timer: Optional StageTimer, records the time frames wait in the queue as 'queue'.
+		"""
+		self._predict_fn = predict_fn
+		self._timer = timer
+		self._max_batch_size = max_batch_size
+		self._max_wait = max_wait_ms / 1000.0
+		self._queue = asyncio.Queue()
+
+		# A single worker, so forward passes never compete for the GPU.
+		self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+		self._batch_count = 0  # Forward passes done.
+		self._frame_count = 0  # Frames predicted.
+
+	@property
+	def batch_count(self):
+		"""Get the number of forward passes done."""
+		return self._batch_count
+
+	@property
+	def frame_count(self):
+		"""Get the number of frames predicted."""
+		return self._frame_count
+
+	def submit(self, image):
+		"""Queue an image for prediction.
+
+		Returns:
+			A future resolved with the prediction of this image.
+		"""
+		future = asyncio.get_event_loop().create_future()
+		self._queue.put_nowait((image, future, time.perf_counter()))
+		return future
+
+	async def _next_batch(self):
+		"""Wait for the next batch of queued frames."""
+		loop = asyncio.get_event_loop()
+		batch = [await self._queue.get()]
+		deadline = loop.time() + self._max_wait
+
+		while len(batch) < self._max_batch_size:
+			# Take what is already queued without waiting.
+			if not self._queue.empty():
+				batch.append(self._queue.get_nowait())
+				continue
+
+			timeout = deadline - loop.time()
+			if timeout <= 0:
+				break
+			try:
+				batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+			except asyncio.TimeoutError:
+				break
+		return batch
+
+	async def run(self):
+		"""Batching loop, runs until cancelled."""
+		loop = asyncio.get_event_loop()
+		try:
+			while True:
+				batch = await self._next_batch()
+				images = [image for image, _, _ in batch]
+
+				if self._timer:
+					now = time.perf_counter()
+					for _, _, queued in batch:
+						self._timer.record('queue', now - queued)
+
+				try:
+					results = await loop.run_in_executor(self._executor, self._predict_fn, images)
+				except Exception as e:
+					for _, future, _ in batch:
+						if not future.done():
+							future.set_exception(e)
+					continue
+
+				self._batch_count += 1
+				self._frame_count += len(batch)
+
+				# Route each result back to the client waiting for it.
+				for (_, future, _), result in zip(batch, results):
+					if not future.done():
+						future.set_result(result)
+		finally:
+			self._executor.shutdown(wait=False)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+"""Skip near-duplicate frames, while collecting (collect_data.py) or in an existing dataset.
+
+A frame is a near duplicate when its grayscale thumbnail differs from the one of the last
+kept frame of the same class by less than a threshold, the mean absolute difference in
+0-255 pixel levels. Comparing with the last kept frame, not the previous one, keeps a slow
+drift from being pruned frame by frame. The thumbnail is a 16x12 area downsample, so
+the sensor noise averages out and a check costs a few microseconds.
+
+Usage, a dry run first, then moving the duplicates out of the dataset:
+	python frame_dedup.py --dataset ./dataset --threshold 3
+	python frame_dedup.py --dataset ./dataset --threshold 3 --move-to ./dataset_duplicates
+"""
+
+import os
+import argparse
+import shutil
+
+import numpy as np
+import cv2 as cv
+
+import dataset_manifest
+
+# Size (w, h) of the thumbnails compared.
+THUMBNAIL_SIZE = (16, 12)
+
+# Default threshold, in mean absolute difference of 0-255 pixel levels.
+DEFAULT_THRESHOLD = 3.0
+
+# Frames further apart than this many seconds are never duplicates (offline pass).
+MAX_RUN_GAP = 1.0
+
+def thumbnail(image):
+	"""Get the grayscale thumbnail of a BGR image, as float32."""
+	gray = cv.cvtColor(image, cv.COLOR_BGR2GRAY) if image.ndim == 3 else image
+	return cv.resize(gray, THUMBNAIL_SIZE, interpolation=cv.INTER_AREA).astype(np.float32)
+
+class DedupFilter(object):
+	"""Class for deciding which frames of a stream to keep.
+
+	The sample usage of this class is like:
+
+	'''
+	dedup = DedupFilter(threshold=3.0)
+	for frame, label in frames:
+		if dedup.keep(frame, label):
+			save(frame, label)
+	print(dedup.report())
+
+	# When saving may fail, only a saved frame becomes the reference of its class:
+	new, reference = dedup.check(frame, label)
+	if new and try_save(frame, label):
+		dedup.commit(label, reference)
+	'''
+	"""
+
+	def __init__(self, threshold=DEFAULT_THRESHOLD):
+		"""Inits DedupFilter.
+
+		Args:
+			threshold: Mean absolute thumbnail difference below which a frame is a duplicate,
+				0 keeps every frame.
+		"""
+		self._threshold = threshold
+		self._last = {}  # Label -> thumbnail of the last kept frame.
+		self._kept = {}
+		self._skipped = {}
+
+	@property
+	def kept(self):
+		"""Get the number of frames kept."""
+		return sum(self._kept.values())
+
+	@property
+	def skipped(self):
+		"""Get the number of duplicates skipped."""
+		return sum(self._skipped.values())
+
+	def reset(self, label=None):
+		"""Forget the last kept frame of a label, or of all of them, e.g. after a gap in time."""
+		if label is None:
+			self._last.clear()
+		else:
+			self._last.pop(label, None)
+
+	def check(self, image, label=None):
+		"""Check whether a frame is new, without making it the reference of its class.
+
+		Args:
+			image: BGR image.
+			label: Class of the frame, frames are only compared within a class.
+
+		Returns:
+			(False, None) if the frame nearly duplicates the last one kept of its class,
+			else (True, reference to give to commit once the frame is saved).
+		"""
+		if self._threshold <= 0:
+			return True, None
+		current = thumbnail(image)
+		last = self._last.get(label)
+		if last is not None and np.mean(np.abs(current - last)) < self._threshold:
+			self._skipped[label] = self._skipped.get(label, 0) + 1
+			return False, None
+		return True, current
+
+	def commit(self, label, reference):
+		"""Count a new frame as kept, and make it the one the next frames of its class are compared with.
+
+		Args:
+			label: Class of the frame.
+			reference: Reference returned by check.
+		"""
+		if reference is not None:
+			self._last[label] = reference
+		self._kept[label] = self._kept.get(label, 0) + 1
+
+	def keep(self, image, label=None):
+		"""Decide whether to keep a frame, and keep it as the reference of its class if so.
+
+		Args:
+			image: BGR image.
+			label: Class of the frame, frames are only compared within a class.
+
+		Returns:
+			False if the frame nearly duplicates the last one kept of its class.
+		"""
+		new, reference = self.check(image, label)
+		if new:
+			self.commit(label, reference)
+		return new
+
+	def report(self):
+		"""Get a summary of the frames kept and skipped, per class."""
+		total = self.kept + self.skipped
+		lines = ['Duplicates skipped: %d of %d frames (%.1f%%)' % (
+			self.skipped, total, 100.0 * self.skipped / max(total, 1))]
+		for label in sorted(set(self._kept) | set(self._skipped), key=str):
+			kept, skipped = self._kept.get(label, 0), self._skipped.get(label, 0)
+			lines.append('  %-14s kept %7d, skipped %7d (%.1f%%)' % (
+				label, kept, skipped, 100.0 * skipped / max(kept + skipped, 1)))
+		return '\n'.join(lines)
+
+def find_duplicates(img_path, threshold=DEFAULT_THRESHOLD):
+	"""Find the near-duplicate images of a folder of class folders.
+
+	The images of each class are compared in capture order, a gap of MAX_RUN_GAP starts a new run.
+
+	Returns:
+		(DedupFilter with the counts, manifest rows of the duplicates).
+	"""
+	label_names, rows = dataset_manifest.update_manifest(img_path)
+	dedup = DedupFilter(threshold)
+	last_time = {}
+	duplicates = []
+	for row in rows:
+		label = row['label']
+		if row['timestamp'] - last_time.get(label, float('-inf')) > MAX_RUN_GAP:
+			dedup.reset(label)
+		last_time[label] = row['timestamp']
+
+		image = cv.imread(os.path.join(img_path, row['path']))
+		if image is None:
+			continue
+		if not dedup.keep(image, label):
+			duplicates.append(row)
+	return dedup, duplicates
+
+def parse_args():
+	"""Parse the command line arguments."""
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--dataset', default='./dataset', help='Folder of class folders with labelled images.')
+	parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+						help='Mean absolute thumbnail difference (0-255) below which an image is a duplicate.')
+	parser.add_argument('--move-to', help='Move the duplicates to this folder, keeping their class folders.')
+	parser.add_argument('--delete', action='store_true', help='Delete the duplicates.')
+	return parser.parse_args()
+
+if __name__ == '__main__':
+	args = parse_args()
+	dedup, duplicates = find_duplicates(args.dataset, args.threshold)
+	print(dedup.report())
+	print('%.1f MB in duplicates' % (sum(row['size'] for row in duplicates) / 1e6))
+
+	if args.move_to or args.delete:
+		for row in duplicates:
+			path = os.path.join(args.dataset, row['path'])
+			if args.move_to:
+				target = os.path.join(args.move_to, row['path'])
+				if not os.path.isdir(os.path.dirname(target)):
+					os.makedirs(os.path.dirname(target))
+				shutil.move(path, target)
+			else:
+				os.remove(path)
+		# Drop the pruned images from the manifest.
+		dataset_manifest.update_manifest(args.dataset)
+		print('%s %d duplicates' % ('Moved' if args.move_to else 'Deleted', len(duplicates)))
+	else:
+		print('Dry run, use --move-to or --delete to prune them')
@@ -0,0 +1,250 @@
+"""Wire protocol between pilot_client.py and pilot_serv.py.
+
+Two modes are supported on the same port:
+
+Lock-step mode (the original protocol):
+	client -> server: <L image length> + JPEG data. A length of zero ends the stream.
+	server -> client: one ASCII digit holding the predicted class.
+
+Pipelined mode, selected by the client sending HELLO_MAGIC as its first <L word:
+	client -> server: <B frame format><H width><H height> once, right after HELLO_MAGIC.
+	client -> server: <L image length><L sequence number><d capture timestamp> + image data.
+	                  A length of zero ends the stream.
+	server -> client: <L sequence number><B predicted class>.
+
+The frame format of the pipelined mode is JPEG, or raw RGB/YUV420 frames already
+downscaled by the camera's GPU resizer. Raw frames skip the JPEG encode on the Pi and the
+decode on the server, for more bytes on the wire. Raw frames are laid out the way picamera
+writes them: rows padded to a multiple of 32 pixels, and the height to a multiple of 16.
+
+In pipelined mode the client keeps several frames in flight, so the camera, the network
+and the GPU all work at the same time instead of waiting for each other.
+
+AsyncFrameStream is the server side, on a socket of an asyncio loop. The blocking helpers
+below are the client side.
+"""
+
+import asyncio
+import struct
+import time
+
+# Length prefix of the lock-step protocol.
+LENGTH_FORMAT = '<L'
+LENGTH_SIZE = struct.calcsize(LENGTH_FORMAT)
+
+# First word sent by a pipelined client. A lock-step client sends an image length here,
+# and a JPEG will never be this big, so the server can tell the two modes apart.
+HELLO_MAGIC = 0x45504950  # b'PIPE' in little endian.
+
+# Frame format, width and height sent after HELLO_MAGIC.
+HELLO_FORMAT = '<BHH'
+HELLO_SIZE = struct.calcsize(HELLO_FORMAT)
+
+# Frame formats of the pipelined mode.
+FORMAT_JPEG = 0  # JPEG of any size, width and height are ignored.
+FORMAT_RGB  = 1  # Packed RGB, 3 bytes per pixel.
+FORMAT_YUV  = 2  # Planar YUV420 (I420), 1.5 bytes per pixel.
+
+# Frame format names as used by picamera.
+FORMAT_NAMES = {'jpeg': FORMAT_JPEG, 'rgb': FORMAT_RGB, 'yuv': FORMAT_YUV}
+
+# Image length, sequence number and capture timestamp of a pipelined frame.
+FRAME_HEADER_FORMAT = '<LLd'
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER_FORMAT)
+
+# Sequence number and predicted class of a pipelined reply.
+REPLY_FORMAT = '<LB'
+REPLY_SIZE = struct.calcsize(REPLY_FORMAT)
+
+def read_exactly(connection, size):
+	"""Read exactly size bytes from a file-like connection.
+
+	Raises:
+		EOFError: The peer closed the connection in the middle of a message.
+	"""
+	data = connection.read(size)
+	if len(data) != size:
+		raise EOFError('Connection closed by peer')
+	return data
+
+def raw_padded_size(width, height):
+	"""Get the size of a raw frame as picamera lays it out in memory.
+
+	Returns:
+		The width rounded up to a multiple of 32 and the height rounded up to a multiple of 16.
+	"""
+	return (width + 31) // 32 * 32, (height + 15) // 16 * 16
+
+def raw_frame_len(frame_format, width, height):
+	"""Get the number of bytes of a raw frame, padding included."""
+	padded_width, padded_height = raw_padded_size(width, height)
+	if frame_format == FORMAT_RGB:
+		return padded_width * padded_height * 3
+	if frame_format == FORMAT_YUV:
+		return padded_width * padded_height * 3 // 2
+	raise ValueError('Frame format %d is not raw' % frame_format)
+
+def write_hello(connection, frame_format=FORMAT_JPEG, width=0, height=0):
+	"""Ask the server to use the pipelined protocol.
+
+	Args:
+		connection: File-like object of the socket.
+		frame_format: FORMAT_JPEG, FORMAT_RGB or FORMAT_YUV.
+		width: Width of raw frames, without padding.
+		height: Height of raw frames, without padding.
+	"""
+	connection.write(struct.pack(LENGTH_FORMAT, HELLO_MAGIC))
+	connection.write(struct.pack(HELLO_FORMAT, frame_format, width, height))
+
+def write_frame(connection, seq, timestamp, data):
+	"""Send one pipelined frame.
+
+	Args:
+		connection: File-like object of the socket.
+		seq: Sequence number of the frame.
+		timestamp: Capture time of the frame, from time.time().
+		data: Encoded image data.
+	"""
+	connection.write(struct.pack(FRAME_HEADER_FORMAT, len(data), seq, timestamp))
+	connection.write(data)
+	connection.flush()
+
+def write_end(connection, pipelined):
+	"""Tell the server that no more frames will come."""
+	if pipelined:
+		connection.write(struct.pack(FRAME_HEADER_FORMAT, 0, 0, 0.0))
+	else:
+		connection.write(struct.pack(LENGTH_FORMAT, 0))
+	connection.flush()
+
+def read_reply(connection):
+	"""Read one pipelined reply.
+
+	Returns:
+		The sequence number and the predicted class.
+	"""
+	return struct.unpack(REPLY_FORMAT, read_exactly(connection, REPLY_SIZE))
+
+class AsyncFrameStream(object):
+	"""Server side of the protocol on a non-blocking socket of an asyncio event loop.
+
+	It detects the mode the client talks in, and hides the difference between the two
+	modes from the prediction loop. One event loop serves many clients.
+	Frames are received with sock_recv_into straight into buffers of a BufferPool, and
+	handed out as memoryviews of those buffers, so no per-frame copy or allocation is made.
+	A frame's buffer must be given back with release once its data is no longer used.
+	"""
+
+	def __init__(self, sock, pool, timer=None):
+		"""Inits AsyncFrameStream with an accepted connection.
+
+		Args:
+			sock: Non-blocking socket of the connection.
+			pool: BufferPool the frames are received into.
+			timer: Optional StageTimer, records the time to read an image once its
+				header arrived as 'receive'.
+		"""
+		self._sock = sock
+		self._pool = pool
+		self._timer = timer
+		self._loop = asyncio.get_event_loop()
+		self._count = 0  # Frames read so far, used as sequence number in lock-step mode.
+		self._pipelined = False
+		self._pending_len = None  # Length already read.
+		self._frame_format, self._width, self._height = FORMAT_JPEG, 0, 0  # Lock-step clients always send JPEG.
+
+		# Reused for every header and reply.
+		self._header = bytearray(max(LENGTH_SIZE, HELLO_SIZE, FRAME_HEADER_SIZE))
+		self._header_view = memoryview(self._header)
+		self._reply = bytearray(REPLY_SIZE)
+
+	@property
+	def pipelined(self):
+		"""Whether the client uses the pipelined protocol."""
+		return self._pipelined
+
+	@property
+	def frame_format(self):
+		"""Get the frame format, with the width and height of raw frames."""
+		return self._frame_format, self._width, self._height
+
+	async def _recv_into(self, view):
+		"""Fill a memoryview with data from the socket.
+
+		Raises:
+			EOFError: The client closed the connection in the middle of a message.
+		"""
+		received = 0
+		while received < len(view):
+			count = await self._loop.sock_recv_into(self._sock, view[received:])
+			if not count:
+				raise EOFError('Connection closed by peer')
+			received += count
+
+	async def _read_header(self, header_format, size):
+		"""Read and unpack a fixed size header into the reused header buffer."""
+		await self._recv_into(self._header_view[:size])
+		return struct.unpack_from(header_format, self._header)
+
+	async def start(self):
+		"""Read the first word of the stream to detect the protocol mode.
+
+		Raises:
+			EOFError: The client closed the connection before sending anything.
+			ValueError: The hello names an unknown frame format, or raw frames without a size.
+		"""
+		first_word = (await self._read_header(LENGTH_FORMAT, LENGTH_SIZE))[0]
+		self._pipelined = first_word == HELLO_MAGIC
+		self._pending_len = None if self._pipelined else first_word
+
+		if self._pipelined:
+			self._frame_format, self._width, self._height = await self._read_header(HELLO_FORMAT, HELLO_SIZE)
+			if self._frame_format not in (FORMAT_JPEG, FORMAT_RGB, FORMAT_YUV):
+				raise ValueError('Unknown frame format %d' % self._frame_format)
+			if self._frame_format != FORMAT_JPEG and not (self._width and self._height):
+				raise ValueError('Raw frames of %dx%d' % (self._width, self._height))
+
+	async def read_frame(self):
+		"""Read the next frame.
+
+		Returns:
+			A tuple of (sequence number, capture timestamp, image data), or None when
+			the client ends the stream. The timestamp is None in lock-step mode. The image
+			data is a memoryview of a pooled buffer, give it back with release.
+		"""
+		if self._pipelined:
+			image_len, seq, timestamp = await self._read_header(FRAME_HEADER_FORMAT, FRAME_HEADER_SIZE)
+		else:
+			if self._pending_len is not None:
+				image_len, self._pending_len = self._pending_len, None
+			else:
+				image_len = (await self._read_header(LENGTH_FORMAT, LENGTH_SIZE))[0]
+			seq, timestamp = self._count, None
+
+		if not image_len:
+			return None
+
+		self._count += 1
+		start = time.perf_counter()
+		buffer = self._pool.acquire(image_len)
+		image_data = memoryview(buffer)[:image_len]
+		try:
+			await self._recv_into(image_data)
+		except BaseException:
+			self.release(image_data)
+			raise
+		if self._timer:
+			self._timer.record('receive', time.perf_counter() - start)
+		return seq, timestamp, image_data
+
+	def release(self, image_data):
+		"""Give the buffer of a frame returned by read_frame back to the pool."""
+		self._pool.release(image_data.obj)
+
+	async def write_prediction(self, seq, key):
+		"""Send the predicted class of frame seq back to the client."""
+		if self._pipelined:
+			struct.pack_into(REPLY_FORMAT, self._reply, 0, seq, key)
+			await self._loop.sock_sendall(self._sock, self._reply)
+		else:
+			await self._loop.sock_sendall(self._sock, str(key).encode('utf-8'))
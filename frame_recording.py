@@ -0,0 +1,125 @@
+"""Recording format for the frame stream pilot_client.py sends.
+
+A recording is a header followed by the frames, each stored the way they travel on the
+wire plus their capture time:
+
+	header: <4s magic b'ACFR'><B version><B frame format><H width><H height>
+	frame:  <L image length><d capture time, seconds since the first frame> + image data
+
+The frame format, width and height are the ones of frame_protocol, so recordings of raw
+frames can be replayed too. Recordings are written by pilot_serv.py (see RECORD_DIR) and
+replayed by load_gen.py.
+"""
+
+import struct
+
+import frame_protocol
+
+MAGIC = b'ACFR'
+VERSION = 1
+
+HEADER_FORMAT = '<4sBBHH'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+FRAME_FORMAT = '<Ld'
+FRAME_SIZE = struct.calcsize(FRAME_FORMAT)
+
+class RecordingWriter(object):
+	"""Class for writing a recording.
+
+	The sample usage of this class is like:
+
+	'''
+	with RecordingWriter('car.frames') as recording:
+		recording.write(jpeg_data, time.time())
+	'''
+	"""
+
+	def __init__(self, path, frame_format=frame_protocol.FORMAT_JPEG, width=0, height=0):
+		"""Inits RecordingWriter, creating the file.
+
+		Args:
+			path: Path of the recording.
+			frame_format: Frame format of frame_protocol.
+			width: Width of raw frames, without padding.
+			height: Height of raw frames, without padding.
+		"""
+		self._file = open(path, 'wb')
+		self._file.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, frame_format, width, height))
+		self._first_timestamp = None
+		self._count = 0
+
+	@property
+	def count(self):
+		"""Get the number of frames written."""
+		return self._count
+
+	def write(self, data, timestamp):
+		"""Append a frame.
+
+		Args:
+			data: Image data, any object supporting the buffer protocol.
+			timestamp: Capture time of the frame in seconds.
+		"""
+		if self._first_timestamp is None:
+			self._first_timestamp = timestamp
+		self._file.write(struct.pack(FRAME_FORMAT, len(data), timestamp - self._first_timestamp))
+		self._file.write(data)
+		self._count += 1
+
+	def close(self):
+		"""Close the recording."""
+		self._file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+class RecordingReader(object):
+	"""Class for reading a recording.
+
+	The sample usage of this class is like:
+
+	'''
+	recording = RecordingReader('car.frames')
+	for timestamp, data in recording:
+		...
+	'''
+	"""
+
+	def __init__(self, path):
+		"""Inits RecordingReader, reading the header.
+
+		Raises:
+			ValueError: The file is not a recording.
+		"""
+		self._path = path
+		with open(path, 'rb') as f:
+			header = f.read(HEADER_SIZE)
+		if len(header) != HEADER_SIZE:
+			raise ValueError('%s is not a frame recording' % path)
+
+		magic, version, self._frame_format, self._width, self._height = struct.unpack(HEADER_FORMAT, header)
+		if magic != MAGIC or version != VERSION:
+			raise ValueError('%s is not a frame recording of version %d' % (path, VERSION))
+
+	@property
+	def frame_format(self):
+		"""Get the frame format, with the width and height of raw frames."""
+		return self._frame_format, self._width, self._height
+
+	def __iter__(self):
+		"""Yield (capture time, image data) of every frame. A truncated last frame is skipped."""
+		with open(self._path, 'rb') as f:
+			f.seek(HEADER_SIZE)
+			while True:
+				frame_header = f.read(FRAME_SIZE)
+				if len(frame_header) != FRAME_SIZE:
+					break
+				image_len, timestamp = struct.unpack(FRAME_FORMAT, frame_header)
+				data = f.read(image_len)
+				if len(data) != image_len:
+					break
+				yield timestamp, data
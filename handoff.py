@@ -0,0 +1,88 @@
+"""Handoff between the threads of a pipeline that should always work on the newest data."""
+
+import threading
+
+class LatestSlot(object):
+	"""Class for a single-slot "latest value" handoff.
+
+	The producer never waits: put overwrites the value that hasn't been taken yet, and counts
+	it as dropped. The consumer takes the newest value, waiting for one if the slot is empty.
+	A slow stage therefore drops old data instead of stalling the stages before it.
+
+	The sample usage of this class is like:
+
+	'''
+	frames = LatestSlot()
+
+	# Capture thread:
+	frames.put(frame)
+
+	# Consumer thread:
+	while True:
+		frame = frames.get(timeout=0.5)
+		if frame is None:
+			if frames.closed:
+				break
+			continue
+		process(frame)
+
+	# On exit:
+	frames.close()
+	'''
+	"""
+
+	def __init__(self):
+		"""Inits an empty LatestSlot."""
+		self._item = None
+		self._lock = threading.Lock()  # Only held to swap the item and flag, never while waiting.
+		self._ready = threading.Event()  # Set while the slot holds an item or is closed.
+		self._closed = False
+		self._put_count = 0
+		self._dropped = 0
+
+	@property
+	def closed(self):
+		"""Whether the slot is closed."""
+		return self._closed
+
+	@property
+	def put_count(self):
+		"""Get the number of values put in the slot."""
+		return self._put_count
+
+	@property
+	def dropped(self):
+		"""Get the number of values overwritten before being taken."""
+		return self._dropped
+
+	def put(self, item):
+		"""Store a value, replacing the one not taken yet."""
+		with self._lock:
+			if self._item is not None:
+				self._dropped += 1
+			self._item = item
+			self._put_count += 1
+			self._ready.set()
+
+	def get(self, timeout=None):
+		"""Take the newest value.
+
+		Args:
+			timeout: Seconds to wait for a value, None to wait until one comes.
+
+		Returns:
+			The value, or None if the wait timed out or the slot is closed.
+		"""
+		if not self._ready.wait(timeout):
+			return None
+		with self._lock:
+			item, self._item = self._item, None
+			if not self._closed:
+				self._ready.clear()
+		return item
+
+	def close(self):
+		"""Wake up the consumer for good, get returns None from now on once empty."""
+		with self._lock:
+			self._closed = True
+			self._ready.set()
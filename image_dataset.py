@@ -5,12 +5,42 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import tensorflow as tf
 
-import pathlib
+import os
+import json
+import time
 import random
+import numpy as np
 import matplotlib.pyplot as plt
 
+import dataset_cache
+import dataset_manifest
+import dataset_packer
+
 AUTOTUNE = tf.data.experimental.AUTOTUNE
 
+# Number of shards (or cache chunks) read at the same time.
+SHARD_READERS = 8
+
+# Read buffer of each shard in bytes, big sequential reads instead of one per image.
+SHARD_READ_BUFFER = 8 * 1024 * 1024
+
+# Directory of the cache chunks of the decoded and resized images, and its size limit.
+# Chunks are named after their content, see dataset_cache.py.
+CACHE_DIR       = './cache'
+CACHE_MAX_BYTES = 20 * 1024 ** 3
+
+# Images per cache chunk of the 'files' backend (the 'tfrecord' backend caches one chunk per shard).
+CACHE_CHUNK_SIZE = 1000
+
+# Version of _preprocess_image, bump it when the preprocessing changes to invalidate the caches.
+PREPROCESS_VERSION = 1
+
+# Images decoded at once while the 'numpy' backend builds its arrays.
+NUMPY_BUILD_BATCH = 256
+
+# Seed of the random sample of sample_images, the same on every run.
+SAMPLE_SEED = 0
+
 class ImageDataset(object):
 	"""Class for image dataset.
 
@@ -19,10 +49,16 @@ class ImageDataset(object):
 	2. To be batched.
 	3. Batches to be available as soon as possible.
 
+	Images are read from the class folders ('files' backend), or from the shards written by
+	dataset_packer.py ('tfrecord' backend), which avoids opening every tiny image file.
+	The 'numpy' backend decodes the class folders once into memory-mapped .npy arrays, and
+	gathers the batches from them, with no decode at all on the next runs.
+
 	The sample usage of this class is like:
 
 	'''
 	dataset = ImageDataset(img_path='./dataset', img_size=(120, 160)) # img_size: (h, w)
+	# Or: ImageDataset(img_path='./dataset_packed', img_size=(120, 160), backend='tfrecord')
 	dataset.create(train_set_ratio=0.8, val_set_ratio=0.2, batch_size=32)
 
 	print('Image count: ', dataset.img_count)
@@ -43,21 +79,322 @@ class ImageDataset(object):
 	'''
 	"""
 
-	def __init__(self, img_path, img_size):
-		"""Inits ImageDataset with image path and size."""
-		data_root = pathlib.Path(img_path)
+	def __init__(self, img_path, img_size, backend='files'):
+		"""Inits ImageDataset with image path and size.
+
+		Args:
+			img_path: Folder of class folders for the 'files' and 'numpy' backends,
+				folder written by dataset_packer.py for the 'tfrecord' backend.
+			img_size: Image size (h, w) the images are resized to.
+			backend: 'files', 'tfrecord' or 'numpy'.
+		"""
 		self._img_size = img_size  # [IMG_HEIGHT, IMG_WIDTH]
+		self._img_path = img_path
+		self._backend = backend
+
+		if backend == 'tfrecord':
+			self._init_tfrecord()
+		elif backend == 'files':
+			self._init_files()
+		elif backend == 'numpy':
+			self._init_files()
+			self._init_numpy()
+		else:
+			raise ValueError('Unknown dataset backend %s' % backend)
+
+	def _init_files(self):
+		"""Find the images and their labels in the manifest of the class folders, updating it first."""
+		label_names, rows = dataset_manifest.update_manifest(self._img_path)  # ['move_forward', 'turn_left', 'turn_right'], rows in capture order
+		label_to_index = dict((name, index) for index, name in enumerate(label_names))  # {'turn_left': 1, 'turn_right': 2, 'move_forward': 0}
 
-		self._all_image_paths = list(data_root.glob('*/*'))  # a list of [PosixPath('dataset/turn_right/1573975293.9194663.png'), ...]
-		self._all_image_paths = [str(path) for path in self._all_image_paths]  # a list of ['dataset/turn_right/1573974760.0789077.png', ...]
-		random.shuffle(self._all_image_paths)  # Shuffle images.
+		self._all_image_paths = [os.path.join(self._img_path, row['path']) for row in rows]  # a list of ['dataset/turn_right/1573974760.0789077.png', ...]
+		self._all_image_labels = [label_to_index[row['label']] for row in rows]
 
-		label_names = sorted(item.name for item in data_root.glob('*/') if item.is_dir())  # ['move_forward', 'turn_left', 'turn_right']
-		label_to_index = dict((name, index) for index, name in enumerate(label_names))  # {'turn_left': 1, 'turn_right': 2, 'move_forward': 0}
-		self._all_image_labels = [label_to_index[pathlib.Path(path).parent.name] for path in self._all_image_paths]
+		# Where each image goes in the split, and what changes with its content (for the cache keys).
+		self._split_buckets = [dataset_manifest.split_bucket(row['path']) for row in rows]
+		self._signatures = dict((path, (os.path.abspath(path), row['size'], row['mtime_ns']))
+								for path, row in zip(self._all_image_paths, rows))
 
 		self._img_count = len(self._all_image_paths)  # image count.
 		self._class_count = len(label_names)  # class count.
+		self._label_names = label_names
+
+	def _init_tfrecord(self):
+		"""Read the shard list and the class names from the index of the packed dataset."""
+		index = dataset_packer.read_index(self._img_path)
+		self._shards = index['shards']  # Already shuffled by the packer, a list of {'file', 'count'}.
+		self._img_count = index['img_count']
+		self._class_count = len(index['label_names'])
+		self._label_names = index['label_names']
+
+		# Every record is parsed with its split bucket.
+		if index.get('split_buckets') != dataset_packer.SPLIT_BUCKETS:
+			raise ValueError('The records have no split buckets, pack the dataset again with dataset_packer.py')
+
+	def _init_numpy(self):
+		"""Map the arrays of the decoded images, building them first if the images changed.
+
+		The arrays are named after a fingerprint of the images, in the chunk cache, so
+		processes training on the same images share them and their page cache.
+		"""
+		cache = dataset_cache.ChunkCache(CACHE_DIR, max_bytes=CACHE_MAX_BYTES)
+		key = dataset_cache.fingerprint(['numpy', PREPROCESS_VERSION, list(self._img_size), self._label_names,
+										 [self._signatures[path] for path in self._all_image_paths]])
+		self._numpy_key = key
+
+		prefix = self._wait_prefix(cache, key)
+		if not cache.is_complete(key):
+			self._build_numpy(prefix)
+			cache.release()
+		cache.cleanup(keep=[key])
+
+		self._images = np.load(prefix + '.images.npy', mmap_mode='r')
+		self._labels = np.load(prefix + '.labels.npy', mmap_mode='r')
+
+	def _wait_prefix(self, cache, key):
+		"""Get the prefix of a cache key, waiting while another process builds it."""
+		prefix = cache.prefix(key)
+		while not prefix:
+			time.sleep(1)
+			prefix = cache.prefix(key)
+		return prefix
+
+	def _build_numpy(self, prefix):
+		"""Decode all the images into the .npy arrays of a cache prefix, in the order of the paths."""
+		images = np.lib.format.open_memmap(prefix + '.images.npy', mode='w+', dtype=np.uint8,
+										   shape=(self._img_count,) + tuple(self._img_size) + (3,))
+		np.save(prefix + '.labels.npy', np.array(self._all_image_labels, dtype=np.int32))
+
+		ds = tf.data.Dataset.from_tensor_slices(self._all_image_paths)
+		ds = ds.map(self._load_and_preprocess_image, num_parallel_calls=AUTOTUNE).batch(NUMPY_BUILD_BATCH)
+		start = 0
+		for batch in ds:
+			images[start:start+len(batch)] = batch.numpy()
+			start += len(batch)
+		images.flush()
+		del images
+
+		# Written last, it marks the arrays as complete.
+		with open(prefix + '.index', 'w') as f:
+			json.dump({'img_count': self._img_count, 'img_size': list(self._img_size)}, f)
+
+	def _gather_batches(self, rows, batch_size, soft_targets=None):
+		"""Serve batches of rows of the arrays, by fancy-indexing the memmap.
+
+		Args:
+			rows: A dataset of row numbers.
+			batch_size: Batch size.
+			soft_targets: Optional array of per-image targets in row order, see create.
+
+		Returns:
+			A dataset of batches of (uint8 images, labels), or (uint8 images, labels, soft targets).
+		"""
+		images, labels = self._images, self._labels
+
+		def gather(index):
+			index = np.sort(index)  # Read the pages of the memmap in order.
+			if soft_targets is None:
+				return images[index], labels[index]
+			return images[index], labels[index], np.asarray(soft_targets[index], dtype=np.float32)
+
+		ds = rows.batch(batch_size)
+
+		def gather_batch(index):
+			if soft_targets is None:
+				batch = tf.numpy_function(gather, [index], [tf.uint8, tf.int32])
+			else:
+				batch = tf.numpy_function(gather, [index], [tf.uint8, tf.int32, tf.float32])
+				batch[2].set_shape((None, soft_targets.shape[1]))
+			batch[0].set_shape((None,) + tuple(self._img_size) + (3,))
+			batch[1].set_shape((None,))
+			return tuple(batch)
+		return ds.map(gather_batch, num_parallel_calls=AUTOTUNE)
+
+	def predict_all(self, model, model_key):
+		"""Get the outputs of a model for every image, e.g. the soft predictions of a teacher.
+
+		They are computed once and kept in the chunk cache next to the arrays, named after
+		the images and model_key, so the next runs read them back ('numpy' backend only).
+
+		Args:
+			model: Keras model taking the normalized images of img_size.
+			model_key: Anything changing with the model, e.g. dataset_cache.file_signature of its file.
+
+		Returns:
+			A float32 array (img_count, outputs) in row order, memory-mapped.
+		"""
+		if self._backend != 'numpy':
+			raise ValueError('predict_all needs the numpy backend')
+
+		cache = dataset_cache.ChunkCache(CACHE_DIR, max_bytes=CACHE_MAX_BYTES)
+		key = dataset_cache.fingerprint(['outputs', self._numpy_key, model_key])
+		prefix = self._wait_prefix(cache, key)
+		if not cache.is_complete(key):
+			outputs = np.lib.format.open_memmap(prefix + '.outputs.npy', mode='w+', dtype=np.float32,
+												shape=(self._img_count, model.output_shape[-1]))
+			rows = tf.data.Dataset.range(self._img_count)
+			ds = self._gather_batches(rows, NUMPY_BUILD_BATCH).map(self._normalize, num_parallel_calls=AUTOTUNE)
+			start = 0
+			for images, labels in ds:
+				outputs[start:start+len(images)] = model.predict_on_batch(images)
+				start += len(images)
+			outputs.flush()
+			del outputs
+
+			# Written last, it marks the outputs as complete.
+			with open(prefix + '.index', 'w') as f:
+				json.dump({'img_count': self._img_count}, f)
+			cache.release()
+		cache.cleanup(keep=[self._numpy_key, key])
+
+		return np.load(prefix + '.outputs.npy', mmap_mode='r')
+
+	def _read_shards(self, shards, shuffle):
+		"""Stream the images and labels of some shards.
+
+		Several shards are read at the same time with large buffered reads, and the records
+		are decoded in parallel.
+
+		Args:
+			shards: A list of {'file', 'count'} of the index.
+			shuffle: Whether to read the shards in a new random order every epoch.
+
+		Returns:
+			A dataset of (uint8 image, label).
+		"""
+		files = tf.data.Dataset.from_tensor_slices(
+			tf.constant([os.path.join(self._img_path, shard['file']) for shard in shards], dtype=tf.string))
+		if shuffle:
+			files = files.shuffle(buffer_size=max(1, len(shards)), reshuffle_each_iteration=True)
+
+		records = files.interleave(lambda file: tf.data.TFRecordDataset(file, buffer_size=SHARD_READ_BUFFER),
+								   cycle_length=max(1, min(SHARD_READERS, len(shards))),
+								   num_parallel_calls=AUTOTUNE)
+		return records.map(self._parse_example, num_parallel_calls=AUTOTUNE)
+
+	def _chunk_key(self, chunk, cache_mode, label=None, split=None):
+		"""Get the fingerprint of a cache chunk, which changes with anything changing its content.
+
+		Args:
+			chunk: A list of shards ('tfrecord' backend) or (path, label) ('files' backend).
+			cache_mode: 'uint8' or 'float32'.
+			label: Label the images of the chunk are filtered by, None for all of them.
+			split: Range of split buckets the images of the chunk are filtered by, None for all of them.
+		"""
+		if self._backend == 'tfrecord':
+			signatures = [dataset_cache.file_signature(os.path.join(self._img_path, shard['file'])) for shard in chunk]
+		else:
+			signatures = [self._signatures[path] for path, image_label in chunk]
+		key = [PREPROCESS_VERSION, cache_mode, list(self._img_size), self._label_names, label, signatures]
+		if split is not None:
+			key.append(list(split))
+		return dataset_cache.fingerprint(key)
+
+	def _record_filter(self, label, split):
+		"""Get a predicate on parsed records (see _parse_record), before decoding them.
+
+		Args:
+			label: Keep the records of this label, None for all of them.
+			split: Keep the records whose split bucket is in this [start, end) range, None for all of them.
+		"""
+		def keep(img_raw, record_label, bucket):
+			result = tf.constant(True)
+			if label is not None:
+				result = tf.logical_and(result, tf.equal(record_label, label))
+			if split is not None:
+				result = tf.logical_and(result, tf.logical_and(bucket >= split[0], bucket < split[1]))
+			return result
+		return keep
+
+	def _load_chunks(self, chunks, cache_mode, shuffle, label=None, split=None):
+		"""Load the images and labels of some chunks, each chunk with its own cache.
+
+		Several chunks are read at the same time, a complete chunk from its cache file.
+
+		Args:
+			chunks: A list of chunks, lists of shards ('tfrecord' backend) or (path, label) ('files' backend).
+			cache_mode: 'uint8', 'float32' (normalized images) or None.
+			shuffle: Whether to read the chunks in a new random order every epoch.
+			label: Only load the images of this label, before decoding them ('tfrecord' backend only).
+			split: Only load the images of this range of split buckets ('tfrecord' backend only).
+
+		Returns:
+			A dataset of (image, label).
+		"""
+		if cache_mode is None:
+			prefixes = [''] * len(chunks)
+		else:
+			keys = [self._chunk_key(chunk, cache_mode, label, split) for chunk in chunks]
+			prefixes = [self._cache.prefix(key) for key in keys]
+			self._cache_keys.extend(keys)
+
+		# Bounds of each chunk in the flat lists of sources.
+		ends = []
+		for chunk in chunks:
+			ends.append((ends[-1] if ends else 0) + len(chunk))
+		starts = [end - len(chunk) for end, chunk in zip(ends, chunks)]
+
+		if self._backend == 'tfrecord':
+			files = tf.constant([os.path.join(self._img_path, shard['file']) for chunk in chunks for shard in chunk],
+								dtype=tf.string)
+
+			def load(start, end):
+				records = tf.data.Dataset.from_tensor_slices(files[start:end]).flat_map(
+					lambda file: tf.data.TFRecordDataset(file, buffer_size=SHARD_READ_BUFFER))
+				if label is None and split is None:
+					return records.map(self._parse_example, num_parallel_calls=AUTOTUNE)
+
+				# Parsed once, filtered on the parsed label and bucket, and only the records kept are decoded.
+				records = records.map(self._parse_record, num_parallel_calls=AUTOTUNE)
+				records = records.filter(self._record_filter(label, split))
+				return records.map(self._decode_record, num_parallel_calls=AUTOTUNE)
+		else:
+			paths  = tf.constant([path for chunk in chunks for path, label in chunk], dtype=tf.string)
+			labels = tf.constant([label for chunk in chunks for path, label in chunk], dtype=tf.int32)
+
+			def load(start, end):
+				ds = tf.data.Dataset.from_tensor_slices((paths[start:end], labels[start:end]))
+				return ds.map(self._load_and_preprocess_from_path_label, num_parallel_calls=AUTOTUNE)
+
+		def load_chunk(start, end, prefix):
+			ds = load(start, end)
+			if cache_mode == 'float32':
+				ds = ds.map(self._normalize, num_parallel_calls=AUTOTUNE)
+			if cache_mode is not None:
+				ds = ds.cache(filename=prefix)
+			return ds
+
+		ds = tf.data.Dataset.from_tensor_slices((tf.constant(starts, dtype=tf.int64), tf.constant(ends, dtype=tf.int64),
+												 tf.constant(prefixes, dtype=tf.string)))
+		if shuffle:
+			ds = ds.shuffle(buffer_size=max(1, len(chunks)), reshuffle_each_iteration=True)
+		return ds.interleave(load_chunk, cycle_length=max(1, min(SHARD_READERS, len(chunks))),
+							 num_parallel_calls=AUTOTUNE)
+
+	def _parse_record(self, serialized):
+		"""Parse a packed image, without decoding it.
+
+		Returns:
+			Encoded image, the label and the split bucket.
+		"""
+		features = tf.io.parse_single_example(serialized, dataset_packer.FEATURES)
+		return features['image'], tf.cast(features['label'], tf.int32), features['split_bucket']
+
+	def _decode_record(self, img_raw, label, bucket):
+		"""Decode a parsed packed image.
+
+		Returns:
+			Image precessed and the label.
+		"""
+		return self._preprocess_image(img_raw), label
+
+	def _parse_example(self, serialized):
+		"""Parse and decode a packed image.
+
+		Returns:
+			Image precessed and the label.
+		"""
+		return self._decode_record(*self._parse_record(serialized))
 
 	@property
 	def img_count(self):
@@ -70,17 +407,29 @@ class ImageDataset(object):
 		return self._class_count
 
 	def _preprocess_image(self, img_raw):
-		"""Decode image and perform data augmentation.
-		
+		"""Decode and resize image.
+
+		The pixels are kept as uint8, a quarter of the size of float32 in the cache
+		and in the shuffle buffer. See _normalize.
+
 		Returns:
-			A normalized image.
+			A uint8 image of img_size.
 		"""
 		img_tensor = tf.image.decode_jpeg(contents=img_raw, channels=3)  # Can be used for plt.imshow(img_tensor)
 		img = tf.image.resize(images=img_tensor, size=self._img_size)
 
-		# Should do some data augmentation here
-		img /= 255.0  # Normalize to [0,1] range
-		return img
+		# The data augmentation is done on whole batches, see batch_augment.py.
+		return tf.cast(tf.clip_by_value(tf.round(img), 0, 255), tf.uint8)
+
+	def _normalize(self, img, label, soft_target=None):
+		"""Normalize images to [0,1] range, a single image or a whole batch.
+
+		Returns:
+			Float32 images and the label, and the soft target if any.
+		"""
+		if soft_target is None:
+			return tf.cast(img, tf.float32) / 255.0, label
+		return tf.cast(img, tf.float32) / 255.0, label, soft_target
 
 	def _load_and_preprocess_image(self, path):
 		"""Load images from path.
@@ -99,49 +448,283 @@ class ImageDataset(object):
 		"""
 		return self._load_and_preprocess_image(path), label
 
-	def create(self, train_set_ratio, val_set_ratio, batch_size):
-		"""Create the dataset.
+	@property
+	def label_names(self):
+		"""Get the class names in label order."""
+		return self._label_names
+
+	def _augment(self, ds, augmenter):
+		"""Augment the batches of a dataset, numbering them for the stateless random parameters."""
+		ds = tf.data.Dataset.zip((ds, tf.data.experimental.Counter()))
+		return ds.map(lambda batch, step: augmenter(batch[0], batch[1], step, *batch[2:]), num_parallel_calls=AUTOTUNE)
+
+	def _pack_targets(self, images, labels, soft_targets):
+		"""Put the labels and the soft targets of a batch in one (n, 1 + outputs) array, as keras wants one y."""
+		return images, tf.concat([tf.cast(labels[:, tf.newaxis], tf.float32), soft_targets], axis=1)
+
+	def _class_weights(self, class_proportions):
+		"""Get the sampling weight of each class of the training set.
 
 		Args:
-			train_set_ratio: Percentage of training dataset.
-			val_set_ratio: Pwecentage of validation dataset.
-			batch_size: Batch size.
+			class_proportions: 'balanced' for equal proportions, or a list of proportions in label order.
+
+		Returns:
+			A list of weights summing to 1, 0 for the classes without training images.
 		"""
-		# Creates a Dataset whose elements are slices of the given tensors.
-		ds = tf.data.Dataset.from_tensor_slices((self._all_image_paths, self._all_image_labels))
+		if class_proportions == 'balanced':
+			class_proportions = [1.0] * self._class_count
+		if len(class_proportions) != self._class_count:
+			raise ValueError('Expected %d class proportions, got %d' % (self._class_count, len(class_proportions)))
 
-		# Convert the image path to image data.
-		image_label_ds = ds.map(self._load_and_preprocess_from_path_label)
+		weights = [float(proportion) if count else 0.0
+				   for proportion, count in zip(class_proportions, self._train_class_counts)]
+		total = sum(weights)
+		if not total:
+			raise ValueError('No training images in the classes to sample')
+		return [weight / total for weight in weights]
 
-		# Calculate training and validation images count.
-		self._train_size = int(train_set_ratio*self._img_count)
-		self._val_size   = int(val_set_ratio*self._img_count)
+	def _mix_classes(self, class_ds, class_proportions):
+		"""Mix per-class streams with the target class proportions.
 
-		# Create training and validation dataset.
-		self._train_ds = image_label_ds.take(self._train_size)
-		self._val_ds   = image_label_ds.skip(self._train_size).take(self._val_size)
+		Each stream is reshuffled and repeated on its own, so the rare classes are seen
+		more often instead of the common ones being thrown away.
 
-		# cache calculations between epochs
-		self._train_ds = self._train_ds.cache(filename='./cache.tf-data')
+		Args:
+			class_ds: Function getting the dataset of the training images of a label.
+			class_proportions: See _class_weights.
 
-		# Shuffle and repeat images.
-		self._train_ds = self._train_ds.shuffle(buffer_size=self._train_size, reshuffle_each_iteration=True).repeat()
+		Returns:
+			An endless dataset mixing the classes.
+		"""
+		weights = self._class_weights(class_proportions)
+		streams, stream_weights = [], []
+		for label, weight in enumerate(weights):
+			if weight:
+				count = self._train_class_counts[label]
+				streams.append(class_ds(label).shuffle(buffer_size=count, reshuffle_each_iteration=True).repeat())
+				stream_weights.append(weight)
+		return tf.data.experimental.sample_from_datasets(streams, weights=stream_weights)
+
+	def _set_sharded(self):
+		"""Stop tf.distribute from sharding the datasets again, create did it already."""
+		options = tf.data.Options()
+		options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+		self._train_ds = self._train_ds.with_options(options)
+		self._val_ds   = self._val_ds.with_options(options)
+
+	def create(self, train_set_ratio, val_set_ratio, batch_size, cache_mode='uint8', augmenter=None,
+			   class_proportions=None, num_shards=1, shard_index=0, soft_targets=None):
+		"""Create the dataset.
 
-		# Batch and prefetch for high performance fetch.
-		self._train_ds = self._train_ds.batch(batch_size).prefetch(buffer_size=AUTOTUNE)
+		Args:
+			train_set_ratio: Percentage of training dataset.
+			val_set_ratio: Pwecentage of validation dataset.
+			batch_size: Batch size.
+			cache_mode: 'uint8' caches the resized images and normalizes whole batches,
+				'float32' caches the normalized images (4x bigger), None caches nothing.
+				The caches are chunks under CACHE_DIR, see dataset_cache.py.
+				The 'numpy' backend ignores it, its arrays are a uint8 cache already.
+			augmenter: batch_augment.BatchAugmenter applied to the normalized training batches,
+				None for no augmentation.
+			class_proportions: Proportions of the classes in the training batches, 'balanced'
+				for equal proportions, a list in label order, or None to keep the natural
+				proportions of the data. See train_class_counts.
+			num_shards: Number of workers training together, each one reads its own shard of the data.
+			shard_index: Index of this worker. train_size, val_size and train_class_counts are the
+				ones of its shard.
+			soft_targets: Array (img_count, class_count) of per-image targets in row order, e.g. the
+				predict_all outputs of a teacher model ('numpy' backend only). The y of the batches
+				is then a float32 (n, 1 + class_count) array: the label, then the soft targets.
+		"""
+		if cache_mode not in ('uint8', 'float32', None):
+			raise ValueError('Unknown cache mode %s' % cache_mode)
+		if soft_targets is not None:
+			if self._backend != 'numpy':
+				raise ValueError('Soft targets need the numpy backend')
+			if len(soft_targets) != self._img_count:
+				raise ValueError('Expected soft targets for %d images, got %d' % (self._img_count, len(soft_targets)))
+
+		if self._backend == 'numpy':
+			# Split the rows by the hash of their paths.
+			buckets = np.array(self._split_buckets)
+			train_index = np.flatnonzero(buckets < train_set_ratio)
+			val_index   = np.flatnonzero((buckets >= train_set_ratio) & (buckets < train_set_ratio+val_set_ratio))
+			train_index = train_index[shard_index::num_shards]
+			val_index   = val_index[shard_index::num_shards]
+			self._train_size = len(train_index)
+			self._val_size   = len(val_index)
+			if not self._train_size or (val_set_ratio and not self._val_size):
+				raise ValueError('Empty split: %d training and %d validation images' % (self._train_size, self._val_size))
+
+			train_labels = np.asarray(self._labels)[train_index]
+			self._train_class_counts = np.bincount(train_labels, minlength=self._class_count).tolist()
+
+			if class_proportions is None:
+				train_rows = tf.data.Dataset.from_tensor_slices(train_index.astype(np.int64))
+				train_rows = train_rows.shuffle(buffer_size=max(1, self._train_size), reshuffle_each_iteration=True).repeat()
+			else:
+				train_rows = self._mix_classes(
+					lambda label: tf.data.Dataset.from_tensor_slices(train_index[train_labels == label].astype(np.int64)),
+					class_proportions)
+			val_rows = tf.data.Dataset.from_tensor_slices(val_index.astype(np.int64))
+
+			self._train_ds = self._gather_batches(train_rows, batch_size, soft_targets)
+			self._val_ds   = self._gather_batches(val_rows, batch_size, soft_targets)
+
+			self._train_ds = self._train_ds.map(self._normalize, num_parallel_calls=AUTOTUNE)
+			if augmenter is not None:
+				self._train_ds = self._augment(self._train_ds, augmenter)
+			self._val_ds   = self._val_ds.map(self._normalize, num_parallel_calls=AUTOTUNE)
+			if soft_targets is not None:
+				self._train_ds = self._train_ds.map(self._pack_targets, num_parallel_calls=AUTOTUNE)
+				self._val_ds   = self._val_ds.map(self._pack_targets, num_parallel_calls=AUTOTUNE)
+			self._train_ds = self._train_ds.prefetch(buffer_size=AUTOTUNE)
+			self._val_ds   = self._val_ds.prefetch(buffer_size=AUTOTUNE)
+			if num_shards > 1:
+				self._set_sharded()
+			return
+
+		self._cache = dataset_cache.ChunkCache(CACHE_DIR, max_bytes=CACHE_MAX_BYTES)
+		self._cache_keys = []
+
+		if self._backend == 'tfrecord':
+			# Split each shard by the split bucket stored in each record (the hash of its path, like the
+			# files backend), the records of the other split are skipped before decoding.
+			train_end = int(round(train_set_ratio*dataset_packer.SPLIT_BUCKETS))
+			val_end   = int(round((train_set_ratio+val_set_ratio)*dataset_packer.SPLIT_BUCKETS))
+			train_split, val_split = (0, train_end), (train_end, val_end)
+			shards = self._shards[shard_index::num_shards]
+
+			self._train_class_counts = [0] * self._class_count
+			val_class_counts = [0] * self._class_count
+			for shard in shards:
+				for bucket, counts in shard['bucket_counts'].items():
+					split_counts = (self._train_class_counts if int(bucket) < train_end else
+									val_class_counts if int(bucket) < val_end else None)
+					if split_counts is not None:
+						for label, count in enumerate(counts):
+							split_counts[label] += count
+			self._train_size = sum(self._train_class_counts)
+			self._val_size   = sum(val_class_counts)
+
+			# One cache chunk per shard and split.
+			train_chunks = [[shard] for shard in shards]
+			val_chunks   = [[shard] for shard in shards]
+
+			# The shards mix the classes, the images of other labels are skipped before decoding too.
+			def class_ds(label):
+				return self._load_chunks(train_chunks, cache_mode, shuffle=True, label=label, split=train_split)
+		else:
+			# Split the images by the hash of their paths, the same on every run.
+			# They stay in capture order, so new images only add chunks at the end and the others keep their cache.
+			train_path_labels, val_path_labels = [], []
+			for path, label, bucket in zip(self._all_image_paths, self._all_image_labels, self._split_buckets):
+				if bucket < train_set_ratio:
+					train_path_labels.append((path, label))
+				elif bucket < train_set_ratio+val_set_ratio:
+					val_path_labels.append((path, label))
+			train_path_labels = train_path_labels[shard_index::num_shards]
+			val_path_labels   = val_path_labels[shard_index::num_shards]
+
+			# Calculate training and validation images count.
+			self._train_size = len(train_path_labels)
+			self._val_size   = len(val_path_labels)
+
+			# Create training and validation dataset chunks.
+			self._train_class_counts = [0] * self._class_count
+			for path, label in train_path_labels:
+				self._train_class_counts[label] += 1
+			train_chunks = [train_path_labels[i:i+CACHE_CHUNK_SIZE] for i in range(0, self._train_size, CACHE_CHUNK_SIZE)]
+			val_chunks   = [val_path_labels[i:i+CACHE_CHUNK_SIZE] for i in range(0, self._val_size, CACHE_CHUNK_SIZE)]
+
+			# Chunks holding the images of one label only.
+			def class_ds(label):
+				class_path_labels = [path_label for path_label in train_path_labels if path_label[1] == label]
+				return self._load_chunks([class_path_labels[i:i+CACHE_CHUNK_SIZE]
+										  for i in range(0, len(class_path_labels), CACHE_CHUNK_SIZE)],
+										 cache_mode, shuffle=True)
+
+		# Convert the chunks to image data, and cache calculations between epochs.
+		if not self._train_size or (val_set_ratio and not self._val_size):
+			raise ValueError('Empty split: %d training and %d validation images' % (self._train_size, self._val_size))
+
+		# The 'tfrecord' chunks hold both splits, filtered per record.
+		if self._backend != 'tfrecord':
+			train_split = val_split = None
+
+		if class_proportions is None:
+			self._train_ds = self._load_chunks(train_chunks, cache_mode, shuffle=True, split=train_split)
+
+			# Shuffle and repeat images.
+			self._train_ds = self._train_ds.shuffle(buffer_size=self._train_size, reshuffle_each_iteration=True).repeat()
+		else:
+			# Shuffle and repeat the images of each class, and mix them in the target proportions.
+			# Each class has its own cache chunks, so the streams never write the same cache.
+			self._train_ds = self._mix_classes(class_ds, class_proportions)
+		self._val_ds = self._load_chunks(val_chunks, cache_mode, shuffle=False, split=val_split)
+
+		# Make room for the new chunks, dropping the least recently used ones of other runs.
+		if cache_mode is not None:
+			self._cache.cleanup(keep=self._cache_keys)
+
+		# Batch, then normalize whole batches at once (one op per batch instead of per image).
+		self._train_ds = self._train_ds.batch(batch_size)
+		if cache_mode != 'float32':
+			self._train_ds = self._train_ds.map(self._normalize, num_parallel_calls=AUTOTUNE)
+
+		# Augment whole batches too.
+		if augmenter is not None:
+			self._train_ds = self._augment(self._train_ds, augmenter)
+
+		# Prefetch for high performance fetch.
+		self._train_ds = self._train_ds.prefetch(buffer_size=AUTOTUNE)
 
 		# Validation data don't need to shuffle.
 		self._val_ds = self._val_ds.batch(batch_size)
+		if cache_mode != 'float32':
+			self._val_ds = self._val_ds.map(self._normalize, num_parallel_calls=AUTOTUNE)
 		self._val_ds = self._val_ds.prefetch(buffer_size=AUTOTUNE)
 
+		if num_shards > 1:
+			self._set_sharded()
+
+	def sample_images(self, count):
+		"""Get a sample of preprocessed images, e.g. to calibrate a quantized model.
+
+		Args:
+			count: Number of images in the sample.
+
+		Returns:
+			A dataset of count normalized images, without labels.
+		"""
+		if self._backend == 'tfrecord':
+			# The shards are shuffled mixes of all classes too.
+			ds = self._read_shards(self._shards, shuffle=False).take(count)
+		else:
+			# The images are in capture order, take a random sample of all sessions.
+			sample = sorted(random.Random(SAMPLE_SEED).sample(range(self._img_count), min(count, self._img_count)))
+			if self._backend == 'numpy':
+				ds = self._gather_batches(tf.data.Dataset.from_tensor_slices(np.array(sample, dtype=np.int64)),
+										  NUMPY_BUILD_BATCH).unbatch()
+			else:
+				ds = tf.data.Dataset.from_tensor_slices(([self._all_image_paths[i] for i in sample],
+														 [self._all_image_labels[i] for i in sample]))
+				ds = ds.map(self._load_and_preprocess_from_path_label, num_parallel_calls=AUTOTUNE)
+		return ds.map(lambda image, label: self._normalize(image, label)[0], num_parallel_calls=AUTOTUNE)
+
+	@property
+	def train_class_counts(self):
+		"""Get the image count of each class in the training dataset, in label order."""
+		return self._train_class_counts
+
 	@property
 	def train_size(self):
 		"""Get training data size."""
 		return self._train_size
 
 	@property
-		"""Get validation data size."""
 	def val_size(self):
+		"""Get validation data size."""
 		return self._val_size
 
 	@property
@@ -0,0 +1,186 @@
+"""Background JPEG encoding and writing of the captured images, off the capture thread."""
+
+import time
+import queue
+import threading
+
+import cv2 as cv
+
+class AsyncImageWriter(object):
+	"""Class for a pool of writer threads fed by a bounded queue.
+
+	write never blocks the capture loop: the image is queued, or dropped and counted when
+	the queue is full (the SD card can't keep up). Each writer thread takes the images queued
+	so far in one go, encodes them (OpenCV releases the GIL meanwhile) and writes them.
+	close flushes everything queued before it returns. With a sink, the encoded images go to
+	the sink instead of files, e.g. session_recording.SessionRecorder.append.
+
+	The sample usage of this class is like:
+
+	'''
+	writer = AsyncImageWriter(threads=2, max_queue=64)
+	writer.start()
+
+	while capturing:
+		writer.write('./dataset/move_forward/%s.jpg' % time.time(), image)
+		writer.maybe_report()
+
+	writer.close()
+	'''
+	"""
+
+	def __init__(self, threads=2, max_queue=64, quality=95, batch_size=8, report_interval=5.0, sink=None):
+		"""Inits AsyncImageWriter.
+
+		Args:
+			threads: Number of writer threads.
+			max_queue: Maximum number of images waiting to be written, the next ones are dropped.
+			quality: JPEG quality, 0 to 100 (95 is the default of cv.imwrite).
+			batch_size: Maximum number of images a writer thread takes at once.
+			report_interval: Seconds between two reports of maybe_report.
+			sink: Function taking (key, JPEG data) from the writer threads, instead of writing
+				the image to the file named by the key.
+		"""
+		self._queue = queue.Queue(maxsize=max_queue)
+		self._params = [cv.IMWRITE_JPEG_QUALITY, quality]
+		self._batch_size = batch_size
+		self._report_interval = report_interval
+		self._sink = sink
+		self._threads = [threading.Thread(target=self._run, name='image-writer-%d' % i, daemon=True)
+						 for i in range(threads)]
+
+		self._lock = threading.Lock()
+		self._queued = 0
+		self._written = 0
+		self._dropped = 0
+		self._failed = 0
+		self._start_time = None
+		self._last_report = None
+		self._last_written = 0
+		self._closed = False
+
+	@property
+	def queued(self):
+		"""Get the number of images accepted by write."""
+		return self._queued
+
+	@property
+	def written(self):
+		"""Get the number of images written."""
+		return self._written
+
+	@property
+	def dropped(self):
+		"""Get the number of images dropped because the queue was full."""
+		return self._dropped
+
+	@property
+	def failed(self):
+		"""Get the number of images that couldn't be encoded or written."""
+		return self._failed
+
+	@property
+	def pending(self):
+		"""Get the number of images waiting in the queue."""
+		return self._queue.qsize()
+
+	def start(self):
+		"""Start the writer threads."""
+		self._start_time = self._last_report = time.time()
+		for thread in self._threads:
+			thread.start()
+
+	def write(self, path, image):
+		"""Queue an image to be written, without waiting.
+
+		The image is kept as it is until written, don't reuse its buffer.
+
+		Args:
+			path: File to write, its extension decides the encoding (.jpg),
+				or the key given to the sink, with a JPEG encoding.
+			image: BGR image, as read by OpenCV.
+
+		Returns:
+			Whether the image was queued, False if it was dropped.
+		"""
+		if self._closed:
+			return False
+		try:
+			self._queue.put_nowait((path, image))
+		except queue.Full:
+			with self._lock:
+				self._dropped += 1
+			return False
+		with self._lock:
+			self._queued += 1
+		return True
+
+	def _run(self):
+		"""Write the queued images, until the None sent by close."""
+		while True:
+			batch = [self._queue.get()]
+			while len(batch) < self._batch_size and batch[-1] is not None:
+				try:
+					batch.append(self._queue.get_nowait())
+				except queue.Empty:
+					break
+
+			written = failed = 0
+			for item in batch:
+				if item is None:
+					break
+				path, image = item
+				try:
+					extension = '.jpg' if self._sink else '.' + path.rsplit('.', 1)[-1]
+					ok, data = cv.imencode(extension, image, self._params)
+					if not ok:
+						raise ValueError('Encoding failed')
+					if self._sink:
+						self._sink(path, data)
+					else:
+						with open(path, 'wb') as f:
+							f.write(data)
+					written += 1
+				except (OSError, ValueError, cv.error) as e:
+					print('Failed to write %s: %s' % (path, e))
+					failed += 1
+
+			with self._lock:
+				self._written += written
+				self._failed += failed
+			if batch[-1] is None:
+				return
+
+	def maybe_report(self):
+		"""Report the write rate if report_interval has passed since the last report."""
+		if self._last_report is not None and time.time() - self._last_report >= self._report_interval:
+			self.report()
+
+	def report(self):
+		"""Print the images written per second since the last report, the queue depth and the drops."""
+		now = time.time()
+		with self._lock:
+			elapsed = now - self._last_report
+			written = self._written - self._last_written
+			self._last_report = now
+			self._last_written = self._written
+		print('Images written: %.1f/s over the last %.1f s, %d pending, %d written, %d dropped, %d failed' % (
+			written / max(elapsed, 1e-6), elapsed, self.pending, self._written, self._dropped, self._failed))
+
+	def close(self):
+		"""Write all the queued images, stop the threads and print the sustained write rate."""
+		if self._closed:
+			return
+		self._closed = True
+		if self._start_time is None:
+			return
+
+		# Behind every queued image, one stop marker per thread.
+		for thread in self._threads:
+			self._queue.put(None)
+		for thread in self._threads:
+			thread.join()
+
+		elapsed = time.time() - self._start_time
+		print('Wrote %d images in %.1f s (%.1f/s), %d dropped, %d failed' % (
+			self._written, elapsed, self._written / max(elapsed, 1e-6), self._dropped, self._failed))
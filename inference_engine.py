@@ -0,0 +1,127 @@
+"""Low-overhead inference for the trained model.
+
+model.predict builds a new data pipeline on every call, which costs far more than the
+forward pass of a single frame. InferenceEngine traces the model once with a fixed input
+signature and prepares frames with OpenCV/NumPy in a preallocated input buffer.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import numpy as np
+import cv2
+
+import tensorflow as tf
+from tensorflow import keras
+
+class InferenceEngine(object):
+	"""Class for frame prediction.
+
+	The sample usage of this class is like:
+
+	'''
+	engine = InferenceEngine('best_model.h5', max_batch_size=8)
+
+	image = cv2.imread('frame.jpg')  # BGR image of any size.
+	probabilities = engine.predict([image])  # shape: (1, class_count)
+	key = np.argmax(probabilities[0])
+	'''
+	"""
+
+	def __init__(self, model_path, max_batch_size=1):
+		"""Inits InferenceEngine with the saved keras model.
+
+		Args:
+			model_path: Path of the model saved by train.py, e.g. 'best_model.h5'.
+			max_batch_size: Maximum number of images given to one predict call.
+		"""
+		self._model = keras.models.load_model(model_path)
+		_, self._img_height, self._img_width, channels = self._model.input_shape
+		self._max_batch_size = max_batch_size
+
+		# Buffers reused by every call, so steady-state prediction allocates no image memory.
+		self._resized = np.empty((self._img_height, self._img_width, channels), dtype=np.uint8)
+		self._input = np.empty((max_batch_size, self._img_height, self._img_width, channels), dtype=np.float32)
+
+		# Trace the forward pass once. The batch dimension is left open so any batch
+		# size up to max_batch_size reuses the same graph.
+		self._forward = tf.function(
+			lambda images: self._model(images, training=False),
+			input_signature=[tf.TensorSpec(shape=[None, self._img_height, self._img_width, channels],
+										   dtype=tf.float32)])
+
+		# Warm up, so the first frame doesn't pay for tracing.
+		self._forward(tf.zeros([1, self._img_height, self._img_width, channels]))
+
+	@property
+	def img_size(self):
+		"""Get the image size input to the model, (h, w)."""
+		return self._img_height, self._img_width
+
+	@property
+	def param_count(self):
+		"""Get the number of parameters of the model."""
+		return self._model.count_params()
+
+	@property
+	def max_batch_size(self):
+		"""Get the maximum batch size of one predict call."""
+		return self._max_batch_size
+
+	def _preprocess(self, image, index, bgr):
+		"""Resize and normalize an image into slot index of the input buffer.
+
+		Args:
+			image: uint8 image array of any size.
+			index: Slot of the input buffer.
+			bgr: Whether the image is in OpenCV's BGR order. The model is trained on RGB.
+		"""
+		if image.shape[:2] == (self._img_height, self._img_width):
+			np.copyto(self._resized, image)
+		else:
+			# Same bilinear interpolation as tf.image.resize used in training.
+			cv2.resize(image, (self._img_width, self._img_height), dst=self._resized,
+					   interpolation=cv2.INTER_LINEAR)
+
+		if bgr:
+			cv2.cvtColor(self._resized, cv2.COLOR_BGR2RGB, dst=self._resized)
+
+		# Normalize to [0,1] range, straight into the input buffer.
+		np.multiply(self._resized, 1 / 255.0, out=self._input[index], casting='unsafe')
+
+	def preprocess(self, images, bgr=True):
+		"""Resize and normalize a batch of images into the input buffer.
+
+		Args:
+			images: A list of uint8 images, at most max_batch_size of them.
+			bgr: Whether the images are in OpenCV's BGR order, or a list with one flag
+				per image when RGB and BGR images are mixed in a batch.
+		"""
+		if len(images) > self._max_batch_size:
+			raise ValueError('Got %d images, but max_batch_size is %d' % (len(images), self._max_batch_size))
+
+		if not isinstance(bgr, (list, tuple)):
+			bgr = [bgr] * len(images)
+
+		for index, (image, image_bgr) in enumerate(zip(images, bgr)):
+			self._preprocess(image, index, image_bgr)
+
+	def forward(self, count):
+		"""Run the model on the first count images of the input buffer.
+
+		Returns:
+			A NumPy array of shape (count, class_count) with the class probabilities.
+		"""
+		return self._forward(self._input[:count]).numpy()
+
+	def predict(self, images, bgr=True):
+		"""Predict the class probabilities of a batch of images.
+
+		Args:
+			images: A list of uint8 images, at most max_batch_size of them.
+			bgr: Whether the images are in OpenCV's BGR order, or a list of flags.
+
+		Returns:
+			A NumPy array of shape (len(images), class_count).
+		"""
+		self.preprocess(images, bgr)
+		return self.forward(len(images))
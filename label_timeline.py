@@ -0,0 +1,77 @@
+"""Timeline of the label (key held) over time, so each frame gets the label of its capture time."""
+
+import bisect
+import threading
+import time
+
+class LabelTimeline(object):
+	"""Class for the labels set over time, looked up by timestamp.
+
+	The keyboard thread sets the label when a key goes down or up, the capture thread
+	looks up the label at the capture time of each frame, instead of whatever a shared
+	variable holds when it gets to it. The times are time.monotonic() seconds. Changes
+	older than max_age are forgotten.
+
+	The sample usage of this class is like:
+
+	'''
+	timeline = LabelTimeline('s')
+
+	# Keyboard thread:
+	timeline.set('f')
+
+	# Capture thread:
+	camera.grab()
+	label = timeline.label_at(time.monotonic())
+	'''
+	"""
+
+	def __init__(self, initial_label, max_age=10.0):
+		"""Inits LabelTimeline.
+
+		Args:
+			initial_label: Label before the first change.
+			max_age: Seconds the changes are kept for.
+		"""
+		self._times = [float('-inf')]
+		self._labels = [initial_label]
+		self._max_age = max_age
+		self._lock = threading.Lock()
+
+	def set(self, label, timestamp=None):
+		"""Change the label from a time on.
+
+		Args:
+			label: The new label.
+			timestamp: time.monotonic() of the change, now if None. Earlier than the last
+				change is taken as the time of the last change.
+		"""
+		if timestamp is None:
+			timestamp = time.monotonic()
+		with self._lock:
+			self._times.append(max(timestamp, self._times[-1]))
+			self._labels.append(label)
+
+			# Forget the old changes, keeping the one in effect at the horizon.
+			old = bisect.bisect_right(self._times, timestamp - self._max_age) - 1
+			if old > 0:
+				del self._times[:old]
+				del self._labels[:old]
+
+	def label_at(self, timestamp):
+		"""Get the label in effect at a time.
+
+		Args:
+			timestamp: time.monotonic() seconds, within max_age of the last change.
+
+		Returns:
+			The label of the last change at or before timestamp.
+		"""
+		with self._lock:
+			return self._labels[max(0, bisect.bisect_right(self._times, timestamp) - 1)]
+
+	@property
+	def label(self):
+		"""Get the current label."""
+		with self._lock:
+			return self._labels[-1]
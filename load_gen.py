@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+"""Replay frames against pilot_serv.py from simulated cars and report its throughput.
+
+The frames come from a recording written by pilot_serv.py (RECORD_DIR), or from the JPEGs
+under ./dataset. Each simulated car connects like pilot_client.py, in pipelined or
+lock-step mode, and sends frames as fast as the server answers or at a fixed rate.
+
+Usage:
+	python load_gen.py --dataset ./dataset --clients 4 --duration 30
+	python load_gen.py --recording recordings/car.frames --rate 30 --depth 3
+"""
+
+import argparse
+import asyncio
+import glob
+import os
+import struct
+import time
+
+import frame_protocol
+import frame_recording
+import stage_timer
+
+def parse_args():
+	"""Parse the command line arguments."""
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--host', default='127.0.0.1', help='Address of pilot_serv.py.')
+	parser.add_argument('--port', type=int, default=8000, help='Port of pilot_serv.py.')
+	source = parser.add_mutually_exclusive_group()
+	source.add_argument('--recording', help='Recording to replay.')
+	source.add_argument('--dataset', default='./dataset', help='Folder of class folders with JPEG frames.')
+	parser.add_argument('--clients', type=int, default=1, help='Number of simulated cars.')
+	parser.add_argument('--rate', type=float, default=0,
+						help='Frames per second per car, 0 to send as fast as the server answers.')
+	parser.add_argument('--depth', type=int, default=3,
+						help='Frames in flight per car, 0 for the lock-step protocol.')
+	parser.add_argument('--duration', type=float, default=10, help='Seconds to send frames.')
+	parser.add_argument('--timeout', type=float, default=2,
+						help='Seconds to wait for the last replies before counting them lost.')
+	return parser.parse_args()
+
+def load_frames(args):
+	"""Load the frames to replay.
+
+	Returns:
+		The frame format of frame_protocol and a list of image data.
+	"""
+	if args.recording:
+		recording = frame_recording.RecordingReader(args.recording)
+		frames = [data for _, data in recording]
+		frame_format = recording.frame_format
+	else:
+		frames = []
+		for path in sorted(glob.glob(os.path.join(args.dataset, '*', '*'))):
+			with open(path, 'rb') as f:
+				frames.append(f.read())
+		frame_format = (frame_protocol.FORMAT_JPEG, 0, 0)
+
+	if not frames:
+		raise SystemExit('No frames to replay')
+	return frame_format, frames
+
+class SimulatedCar(object):
+	"""Class for a simulated pilot_client.py."""
+
+	def __init__(self, index, frame_format, frames, args):
+		"""Inits SimulatedCar.
+
+		Args:
+			index: Number of this car, used to start each car at another frame.
+			frame_format: Frame format, width and height of the frames.
+			frames: A list of image data to send in a loop.
+			args: The command line arguments.
+		"""
+		self._frame_format = frame_format
+		self._frames = frames
+		self._next_frame = index * len(frames) // max(1, args.clients)
+		self._args = args
+		self._pipelined = args.depth > 0
+
+		self.rtt = stage_timer.LatencyHistogram()
+		self.sent = 0
+		self.answered = 0
+		self.dropped = 0  # Frames skipped at a fixed rate because the pipeline was full.
+		self.lost = 0  # Frames without reply at the end.
+
+		self._in_flight = {}  # Sequence number -> send time.
+		self._window = asyncio.Semaphore(max(1, args.depth))
+
+	async def _receive(self, reader):
+		"""Read the replies and record the round trip time of each frame."""
+		while True:
+			try:
+				if self._pipelined:
+					seq, _ = struct.unpack(frame_protocol.REPLY_FORMAT,
+										   await reader.readexactly(frame_protocol.REPLY_SIZE))
+				else:
+					await reader.readexactly(1)
+					seq = min(self._in_flight)  # Lock-step replies come in order.
+			except (asyncio.IncompleteReadError, ConnectionError):
+				break
+
+			sent_at = self._in_flight.pop(seq, None)
+			if sent_at is not None:
+				self.rtt.record(time.perf_counter() - sent_at)
+				self.answered += 1
+			self._window.release()
+
+	async def run(self):
+		"""Connect and send frames for the duration of the test."""
+		args = self._args
+		reader, writer = await asyncio.open_connection(args.host, args.port)
+		if self._pipelined:
+			writer.write(struct.pack(frame_protocol.LENGTH_FORMAT, frame_protocol.HELLO_MAGIC))
+			writer.write(struct.pack(frame_protocol.HELLO_FORMAT, *self._frame_format))
+		receiver = asyncio.ensure_future(self._receive(reader))
+
+		loop = asyncio.get_event_loop()
+		start = loop.time()
+		interval = 1.0 / args.rate if args.rate else 0
+		seq = 0
+
+		while loop.time() - start < args.duration and not receiver.done():
+			if interval:
+				# Fixed rate: a frame that finds the pipeline full is dropped, like on the car.
+				await asyncio.sleep(max(0, start + seq * interval - loop.time()))
+				seq += 1
+				if self._window.locked():
+					self.dropped += 1
+					continue
+			else:
+				seq += 1
+			await self._window.acquire()
+
+			data = self._frames[self._next_frame % len(self._frames)]
+			self._next_frame += 1
+			self._in_flight[self.sent] = time.perf_counter()
+			if self._pipelined:
+				writer.write(struct.pack(frame_protocol.FRAME_HEADER_FORMAT, len(data), self.sent, time.time()))
+			else:
+				writer.write(struct.pack(frame_protocol.LENGTH_FORMAT, len(data)))
+			writer.write(data)
+			self.sent += 1
+			await writer.drain()
+
+		# Wait for the frames still in flight, then end the stream.
+		deadline = loop.time() + args.timeout
+		while self._in_flight and loop.time() < deadline and not receiver.done():
+			await asyncio.sleep(0.01)
+		self.lost = len(self._in_flight)
+
+		if self._pipelined:
+			writer.write(struct.pack(frame_protocol.FRAME_HEADER_FORMAT, 0, 0, 0.0))
+		else:
+			writer.write(struct.pack(frame_protocol.LENGTH_FORMAT, 0))
+		await writer.drain()
+		writer.close()
+		receiver.cancel()
+
+def report(cars, elapsed):
+	"""Print the stats of all the simulated cars."""
+	rtt = stage_timer.LatencyHistogram()
+	for car in cars:
+		rtt.merge(car.rtt)
+	answered = sum(car.answered for car in cars)
+
+	print('%-6s %8s %8s %8s %8s %8s %9s %9s %9s' % (
+		'car', 'sent', 'answered', 'dropped', 'lost', 'fps', 'p50 ms', 'p95 ms', 'p99 ms'))
+	for index, car in enumerate(cars):
+		print('%-6d %8d %8d %8d %8d %8.1f %9.2f %9.2f %9.2f' % (
+			index, car.sent, car.answered, car.dropped, car.lost, car.answered / elapsed,
+			car.rtt.percentile(50) * 1000, car.rtt.percentile(95) * 1000, car.rtt.percentile(99) * 1000))
+	print('total  %8d %8d %8d %8d %8.1f %9.2f %9.2f %9.2f' % (
+		sum(car.sent for car in cars), answered, sum(car.dropped for car in cars),
+		sum(car.lost for car in cars), answered / elapsed,
+		rtt.percentile(50) * 1000, rtt.percentile(95) * 1000, rtt.percentile(99) * 1000))
+
+def main():
+	"""Run the load test."""
+	args = parse_args()
+	frame_format, frames = load_frames(args)
+	if frame_format[0] != frame_protocol.FORMAT_JPEG and not args.depth:
+		raise SystemExit('Raw recordings can only be replayed with --depth > 0')
+
+	print('Replaying %d frames with %d car(s) to %s:%d for %g s' % (
+		len(frames), args.clients, args.host, args.port, args.duration))
+
+	loop = asyncio.get_event_loop()
+	cars = [SimulatedCar(index, frame_format, frames, args) for index in range(args.clients)]
+	start = time.time()
+	loop.run_until_complete(asyncio.gather(*[car.run() for car in cars]))
+	loop.close()
+
+	report(cars, min(time.time() - start, args.duration))
+
+if __name__ == '__main__':
+	main()
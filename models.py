@@ -0,0 +1,76 @@
+"""Family of models predicting the direction from a camera frame.
+
+'nvidia' is the original model, based on NVIDIA 2016 <End to end learning for self-driving cars>,
+close to 5M parameters, mostly in its first dense layer. The others trade accuracy for speed:
+'slim' has the same layers with a quarter of the filters, 'separable' uses depthwise-separable
+convolutions and global pooling, 'tiny' is 'separable' on a quarter of the pixels.
+Compare them with benchmarks/compare_models.py.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from tensorflow.keras.models import Sequential
+from tensorflow.keras.layers import (Dense, Conv2D, SeparableConv2D, Flatten, GlobalAveragePooling2D,
+									 BatchNormalization)
+from tensorflow.keras import regularizers
+
+# Input size (h, w) of each model.
+INPUT_SIZES = {
+	'nvidia': (120, 160),
+	'slim': (120, 160),
+	'separable': (120, 160),
+	'tiny': (60, 80),
+}
+
+MODEL_NAMES = sorted(INPUT_SIZES)
+
+def _nvidia(input_shape, class_count, width=1.0):
+	"""The NVIDIA model, with width times its filters and units."""
+	def units(count):
+		return max(8, int(count * width))
+
+	return Sequential([
+		Conv2D(filters=units(24), kernel_size=5, strides=2, padding='same', activation='relu', input_shape=input_shape),
+		Conv2D(filters=units(36), kernel_size=5, strides=2, padding='same', activation='relu', kernel_regularizer=regularizers.l2(0.001)),
+		Conv2D(filters=units(48), kernel_size=5, strides=2, padding='same', activation='relu', kernel_regularizer=regularizers.l2(0.001)),
+		Conv2D(filters=units(64), kernel_size=3, padding='same', activation='relu', kernel_regularizer=regularizers.l2(0.001)),
+		Conv2D(filters=units(64), kernel_size=3, padding='same', activation='relu', kernel_regularizer=regularizers.l2(0.001)),
+		Flatten(),
+		Dense(units=units(250), activation='relu', kernel_regularizer=regularizers.l2(0.001)),
+		Dense(units=class_count, activation='softmax')
+	])
+
+def _separable(input_shape, class_count):
+	"""A full convolution on the pixels, then depthwise-separable ones and global pooling."""
+	return Sequential([
+		Conv2D(filters=16, kernel_size=3, strides=2, padding='same', activation='relu', input_shape=input_shape),
+		SeparableConv2D(filters=32, kernel_size=3, strides=2, padding='same', activation='relu'),
+		BatchNormalization(),
+		SeparableConv2D(filters=48, kernel_size=3, strides=2, padding='same', activation='relu'),
+		BatchNormalization(),
+		SeparableConv2D(filters=64, kernel_size=3, strides=2, padding='same', activation='relu'),
+		BatchNormalization(),
+		SeparableConv2D(filters=64, kernel_size=3, padding='same', activation='relu'),
+		GlobalAveragePooling2D(),
+		Dense(units=class_count, activation='softmax')
+	])
+
+def build_model(name, class_count):
+	"""Build an uncompiled model of the family.
+
+	Args:
+		name: One of MODEL_NAMES.
+		class_count: Number of classes to predict.
+
+	Returns:
+		The keras model, its input size is INPUT_SIZES[name].
+	"""
+	if name not in INPUT_SIZES:
+		raise ValueError('Unknown model %s, expected one of %s' % (name, ', '.join(MODEL_NAMES)))
+
+	input_shape = INPUT_SIZES[name] + (3,)
+	if name == 'nvidia':
+		return _nvidia(input_shape, class_count)
+	if name == 'slim':
+		return _nvidia(input_shape, class_count, width=0.25)
+	return _separable(input_shape, class_count)
@@ -1,17 +1,54 @@
-"""Get the prediction result and control the moving."""
+"""Get the prediction result and control the moving.
+
+Capture, network (or local prediction) and actuation run on their own threads, connected
+by single-slot "latest value" handoffs. A slow stage drops frames instead of stalling the
+others, which matters on the four weak cores of the Pi 3B+.
+"""
 
 import io
 import socket
 import struct
+import threading
 import time
+import numpy as np
 import picamera
 
 import car
+import frame_protocol
+import handoff
+import stage_timer
 
 # IP address and port number of the machine you runs the prediction.
 SERV_ADDR = '192.168.0.103'
 PORT      = 8000
 
+# Number of frames allowed to wait for a prediction at the same time.
+# Set it to 0 to use the original lock-step protocol (send a frame, wait for its prediction).
+PIPELINE_DEPTH = 3
+
+# Predictions of frames captured more than this many seconds ago are thrown away,
+# so the pipeline never makes the car act on an old picture.
+MAX_PREDICTION_AGE = 0.25
+
+# Format of the frames sent to the server (pipelined mode only for raw formats):
+# 'jpeg': 480x320 JPEG encoded by the camera.
+# 'rgb' or 'yuv': raw frames of RAW_SIZE, downscaled by the camera's GPU resizer,
+# no JPEG encode on the Pi and no decode on the server, but more bytes to send.
+FRAME_FORMAT = 'jpeg'
+RAW_SIZE = (160, 120)  # (w, h), the input size of the model.
+
+# Path of the int8 TFLite model exported by tflite_export.py, to predict on the Pi itself
+# without any server. None to send the frames to pilot_serv.py.
+LOCAL_MODEL = None
+LOCAL_THREADS = 4  # Interpreter threads, one per core of the Pi 3B+.
+
+# Seconds between two reports of the per-stage latency, and the CSV file they go to.
+STATS_INTERVAL = 5.0
+STATS_CSV = 'logs/latency/client.csv'
+
+# Collect the latency of every stage of the client.
+timer = stage_timer.StageTimer('client', report_interval=STATS_INTERVAL, csv_path=STATS_CSV)
+
 # Create a car instance for moving control.
 front_left_wheel = car.Wheel(pwm_pin=33, dir_pin_1=35, dir_pin_2=37,
 							 pwm_freq=1500)
@@ -24,64 +61,336 @@ rear_right_wheel = car.Wheel(pwm_pin=15, dir_pin_1=13, dir_pin_2=11,
 my_car = car.Car(front_left_wheel, front_right_wheel,
 				rear_left_wheel, rear_right_wheel)
 
-# Connect a client socket to my_server:8000 (change my_server to the
-# hostname of your server).
-client_socket = socket.socket()
-client_socket.connect((SERV_ADDR, PORT))
+# Car command and name of each predicted class: 0: move forward, 1: rotate left, 2: rotate right.
+COMMANDS = [
+	(car.forward_command(4), 'Move forward'),
+	(car.rotate_left_command(4), 'Turn left'),
+	(car.rotate_right_command(4), 'Turn right'),
+]
 
-# Make a file-like object out of the connection.
-connection = client_socket.makefile('rwb')
+def move(key):
+	"""Control the car according to the prediction.
 
-try:
-	with picamera.PiCamera() as camera:
-		# This is preview window size.
-		camera.resolution = (480, 320)
-		camera.framerate = 30
+	The car only issues GPIO operations when the command changes, so repeating
+	the prediction of the last frame costs next to nothing.
 
-		# Camera warm-up time.
-		time.sleep(2)
-		start = time.time()
-		count = 0
-		stream = io.BytesIO()
+	Args:
+		key: Predicted class, 0: move forward, 1: turn left, 2: turn right.
+	"""
+	start = time.perf_counter()
+
+	if 0 <= key < len(COMMANDS):
+		command, name = COMMANDS[key]
+		if my_car.apply(command):
+			print(name)
+
+	timer.record('actuate', time.perf_counter() - start)
+
+# Set when the client should stop, every stage thread checks it.
+stop = threading.Event()
+
+# Counters of the stages, each one is only written by one thread: the stale replies are counted
+# by the receive thread, the stale predictions it handed over by the actuate thread.
+stats = {'sent': 0, 'stale_received': 0, 'stale_acted': 0, 'acted': 0}
+
+def capture_frames(camera, frame_slot, frame_format, resize):
+	"""Capture stage: keep the newest frame in frame_slot.
 
+	Args:
+		camera: The opened PiCamera.
+		frame_slot: LatestSlot receiving (capture timestamp, image data).
+		frame_format: Format of picamera, 'jpeg', 'rgb' or 'yuv'.
+		resize: Size (w, h) for the GPU resizer, None to keep the camera resolution.
+	"""
+	stream = io.BytesIO()
+	capture_start = time.perf_counter()
+
+	try:
 		# Use the video-port for captures...
-		for foo in camera.capture_continuous(stream, 'jpeg',
-											 use_video_port=True):
-			connection.write(struct.pack('<L', stream.tell()))
-			connection.flush()
-			stream.seek(0)
-			connection.write(stream.read())
-			count += 1
+		for foo in camera.capture_continuous(stream, frame_format,
+											 use_video_port=True, resize=resize):
+			# The JPEG is encoded (or the raw frame downscaled) by the GPU inside
+			# capture_continuous, so the 'capture' stage includes it.
+			timer.record('capture', time.perf_counter() - capture_start)
+
+			# Never waits: a frame not taken yet by the next stage is replaced by this one.
+			frame_slot.put((time.time(), stream.getvalue()))
 
 			# Reset the stream for the next capture
 			stream.seek(0)
 			stream.truncate()
 
+			if stop.is_set():
+				break
+			capture_start = time.perf_counter()
+	finally:
+		stop.set()
+		frame_slot.close()
+
+def send_frames(writer, frame_slot, window, in_flight):
+	"""Sender stage of the pipelined mode: send the newest frame whenever the pipeline has room.
+
+	Args:
+		writer: File-like object to write the frames to.
+		frame_slot: LatestSlot of the captured frames.
+		window: Semaphore bounding the number of frames in flight.
+		in_flight: Dict of the capture timestamps of frames in flight, keyed by sequence number.
+	"""
+	try:
+		while not stop.is_set():
+			# Wait for room first, so the frame taken afterwards is as fresh as possible.
+			if not window.acquire(timeout=0.5):
+				continue
+
+			frame = frame_slot.get(timeout=0.5)
+			if frame is None:
+				window.release()
+				if frame_slot.closed:
+					break
+				continue
+
+			timestamp, data = frame
+			in_flight[stats['sent']] = timestamp
+			with timer.stage('send'):
+				frame_protocol.write_frame(writer, stats['sent'], timestamp, data)
+			stats['sent'] += 1
+	except OSError as e:
+		print('Sending failed: %s' % e)
+	finally:
+		stop.set()
+
+def receive_predictions(reader, window, in_flight, command_slot):
+	"""Receiver stage of the pipelined mode: hand the newest prediction to the actuation stage.
+
+	Args:
+		reader: File-like object to read the replies from.
+		window: Semaphore bounding the number of frames in flight.
+		in_flight: Dict of the capture timestamps of frames in flight, keyed by sequence number.
+		command_slot: LatestSlot receiving (capture timestamp, predicted class).
+	"""
+	newest_seq = -1
+	try:
+		while not stop.is_set():
+			seq, key = frame_protocol.read_reply(reader)
+
+			timestamp = in_flight.pop(seq, None)
+			window.release()  # Free the slot of this frame for the next one.
+
+			# Only hand over answers newer than the last one.
+			if seq <= newest_seq or timestamp is None:
+				stats['stale_received'] += 1
+				continue
+
+			timer.record('round_trip', time.time() - timestamp)
+			newest_seq = seq
+			command_slot.put((timestamp, key))
+	except (EOFError, OSError, ValueError):
+		pass
+	finally:
+		stop.set()
+
+def exchange_frames(writer, reader, frame_slot, command_slot):
+	"""Network stage of the lock-step mode: send the newest frame and wait for its prediction.
+
+	Args:
+		writer: File-like object to write the frames to.
+		reader: File-like object to read the predictions from.
+		frame_slot: LatestSlot of the captured frames.
+		command_slot: LatestSlot receiving (capture timestamp, predicted class).
+	"""
+	try:
+		while not stop.is_set():
+			frame = frame_slot.get(timeout=0.5)
+			if frame is None:
+				if frame_slot.closed:
+					break
+				continue
+
+			timestamp, data = frame
+			with timer.stage('send'):
+				writer.write(struct.pack('<L', len(data)))
+				writer.write(data)
+				writer.flush()
+			stats['sent'] += 1
+
 			# Waiting for prediction.
-			key = connection.read(1).decode('utf-8')
+			with timer.stage('round_trip'):
+				key = int(frame_protocol.read_exactly(reader, 1).decode('utf-8'))
+			command_slot.put((timestamp, key))
+	except (EOFError, OSError) as e:
+		print('Connection failed: %s' % e)
+	finally:
+		stop.set()
+
+def predict_frames(pilot, frame_slot, command_slot):
+	"""Prediction stage of the local mode: run the TFLite model on the newest frame.
+
+	Args:
+		pilot: TFLitePilot of the model.
+		frame_slot: LatestSlot of raw RGB frames of the model input size.
+		command_slot: LatestSlot receiving (capture timestamp, predicted class).
+	"""
+	img_height, img_width = pilot.img_size
+	padded_width, padded_height = frame_protocol.raw_padded_size(img_width, img_height)
+
+	while not stop.is_set():
+		frame = frame_slot.get(timeout=0.5)
+		if frame is None:
+			if frame_slot.closed:
+				break
+			continue
+
+		# View the padded frame as an array and crop the padding.
+		timestamp, data = frame
+		image = np.frombuffer(data, dtype=np.uint8).reshape(padded_height, padded_width, 3)
+		with timer.stage('predict'):
+			key = pilot.predict_class(image[:img_height, :img_width])
+		stats['sent'] += 1
+		command_slot.put((timestamp, key))
+
+def actuate(command_slot):
+	"""Actuation stage: apply the newest prediction to the car.
+
+	Args:
+		command_slot: LatestSlot of (capture timestamp, predicted class).
+	"""
+	try:
+		while not stop.is_set():
+			command = command_slot.get(timeout=0.5)
+			if command is None:
+				continue
+
+			# Never act on an old picture.
+			timestamp, key = command
+			if time.time() - timestamp > MAX_PREDICTION_AGE:
+				stats['stale_acted'] += 1
+				continue
+
+			move(key)
+			stats['acted'] += 1
+	finally:
+		my_car.stop()
+
+def run_pipeline(stages):
+	"""Run the stages on their own threads until one of them stops or Ctrl+C is pressed.
+
+	Args:
+		stages: A list of (name, function, args) of the stage threads.
+	"""
+	threads = [threading.Thread(target=target, args=args, name=name) for name, target, args in stages]
+	for thread in threads:
+		thread.daemon = True  # A stage blocked on the network must not keep the process alive.
+		thread.start()
+
+	try:
+		while not stop.is_set():
+			stop.wait(0.5)
+			timer.maybe_report()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		stop.set()
+		for thread in threads:
+			thread.join(timeout=2)
+
+def open_camera():
+	"""Open and warm up the camera."""
+	camera = picamera.PiCamera()
+	# This is preview window size.
+	camera.resolution = (480, 320)
+	camera.framerate = 30
+
+	# Camera warm-up time.
+	time.sleep(2)
+	return camera
+
+def drive_local():
+	"""Predict on the Pi with the TFLite model and control the car, without a server."""
+	# Imported here, so the remote mode doesn't need a TFLite interpreter installed.
+	import tflite_pilot
+
+	pilot = tflite_pilot.TFLitePilot(LOCAL_MODEL, num_threads=LOCAL_THREADS)
+	img_height, img_width = pilot.img_size
+	frame_slot = handoff.LatestSlot()
+	command_slot = handoff.LatestSlot()
+
+	with open_camera() as camera:
+		start = time.time()
+		try:
+			# Let the GPU resizer produce RGB frames of the model input size.
+			run_pipeline([
+				('capture', capture_frames, (camera, frame_slot, 'rgb', (img_width, img_height))),
+				('predict', predict_frames, (pilot, frame_slot, command_slot)),
+				('actuate', actuate, (command_slot,)),
+			])
+		finally:
+			timer.close()
+			finish = time.time()
+
+	print('Predicted %d images in %d seconds at %.2ffps' % (
+		stats['sent'], finish-start, stats['sent'] / (finish-start)))
+	print('Captured %d, skipped %d old frames, ignored %d stale predictions, acted on %d' % (
+		frame_slot.put_count, frame_slot.dropped, stats['stale_received'] + stats['stale_acted'], stats['acted']))
+	print('Issued %d GPIO operations' % my_car.gpio_ops)
+
+def drive_remote():
+	"""Send the frames to pilot_serv.py and control the car with its predictions."""
+	pipelined = PIPELINE_DEPTH > 0
+	raw = FRAME_FORMAT != 'jpeg'
+	if raw and not pipelined:
+		raise ValueError('Raw frame format %s needs PIPELINE_DEPTH > 0' % FRAME_FORMAT)
+
+	# Connect a client socket to my_server:8000 (change my_server to the
+	# hostname of your server).
+	client_socket = socket.socket()
+	client_socket.connect((SERV_ADDR, PORT))
+
+	# Make file-like objects out of the connection.
+	# Separate reader and writer, because they are used by different threads in pipelined mode.
+	writer = client_socket.makefile('wb')
+	reader = client_socket.makefile('rb')
+
+	frame_slot = handoff.LatestSlot()
+	command_slot = handoff.LatestSlot()
 
-			# If the prediction is '0', control the car moving forward.
-			if key == '0':
-				print("Move forward")
-				my_car.move_forward(4)
+	if pipelined:
+		frame_protocol.write_hello(writer, frame_protocol.FORMAT_NAMES[FRAME_FORMAT], *RAW_SIZE)
+		window = threading.BoundedSemaphore(PIPELINE_DEPTH)
+		in_flight = {}
+		network_stages = [
+			('send', send_frames, (writer, frame_slot, window, in_flight)),
+			('receive', receive_predictions, (reader, window, in_flight, command_slot)),
+		]
+	else:
+		network_stages = [('network', exchange_frames, (writer, reader, frame_slot, command_slot))]
 
-			# If the prediction is "1", the car is controlled to rotate to the left.
-			elif key == '1':
-				my_car.rotate_left(4)
-				print("Turn left")
+	start = time.time()
+	try:
+		with open_camera() as camera:
+			start = time.time()
+			run_pipeline(
+				[('capture', capture_frames, (camera, frame_slot, FRAME_FORMAT, RAW_SIZE if raw else None))] +
+				network_stages +
+				[('actuate', actuate, (command_slot,))])
 
-			# If the prediction is "2", the car is controlled to rotate to the right.
-			elif key == '2':
-				my_car.rotate_right(4)
-				print("Turn right")  
+		# Write a length of zero to the stream to signal we're done
+		frame_protocol.write_end(writer, pipelined)
 
-	# Write a length of zero to the stream to signal we're done
-	connection.write(struct.pack('<L', 0))
+	finally:
+		writer.close()
+		reader.close()
+		client_socket.close()
+		timer.close()
+		finish = time.time()
 
-finally:
-	connection.close()
-	client_socket.close()
-	finish = time.time()
+	print('Sent %d images in %d seconds at %.2ffps' % (
+		stats['sent'], finish-start, stats['sent'] / (finish-start)))
+	print('Captured %d, skipped %d old frames, ignored %d stale predictions, acted on %d' % (
+		frame_slot.put_count, frame_slot.dropped, stats['stale_received'] + stats['stale_acted'], stats['acted']))
+	print('Issued %d GPIO operations' % my_car.gpio_ops)
 
-print('Sent %d images in %d seconds at %.2ffps' % (
-	count, finish-start, count / (finish-start)))
+if __name__ == '__main__':
+	if LOCAL_MODEL:
+		drive_local()
+	else:
+		drive_remote()
@@ -1,81 +1,325 @@
-"""Receive images from raspberry and predict the direction the car should move."""
+"""Receive images from raspberry and predict the direction the car should move.
+
+Many cars can connect at the same time. Frames of all the connected cars are collected
+into micro-batches, so one forward pass serves several cars.
+"""
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import os
-import io
 import time
+import signal
 import socket
-import struct
+import asyncio
 import numpy as np
 import cv2
 
-import tensorflow as tf
-from tensorflow import keras
+import buffer_pool
+import dynamic_batcher
+import frame_protocol
+import frame_recording
+import inference_engine
+import preview
+import stage_timer
 
-# Image size input to the model.
-IMG_HEIGHT = 120
-IMG_WIDTH  = 160
+# Port to listen for the cars on all interfaces.
+PORT = 8000
 
-# Load the model for prediction.
-model = keras.models.load_model('best_model.h5')
+# Maximum number of frames (from all cars) predicted in one forward pass.
+MAX_BATCH_SIZE = 8
 
-# Start a socket listening for connections on 0.0.0.0:8000 (0.0.0.0 means
-# all interfaces).
-server_socket = socket.socket()
-server_socket.bind(('0.0.0.0', 8000))
-server_socket.listen(0)
+# Maximum time in milliseconds a frame waits for others to fill its batch.
+MAX_BATCH_WAIT_MS = 5
 
-# Accept a single connection and make a file-like object out of it.
-connection = server_socket.accept()[0].makefile('rwb')
+# Folder to record the frame stream of every car into, for replay with load_gen.py.
+# None to record nothing.
+RECORD_DIR = None
 
-try:
-	while True:
-		# Read the length of the image as a 32-bit unsigned int. If the
-		# length is zero, quit the loop.
-		image_len = struct.unpack('<L', connection.read(struct.calcsize('<L')))[0]
+# Seconds between two reports of the per-stage latency, and the CSV file they go to.
+STATS_INTERVAL = 5.0
+STATS_CSV = 'logs/latency/server.csv'
 
-		if not image_len:
-			break
+# Set it to True to show no window at all, e.g. on a GPU box without a display.
+# Stop the server with Ctrl+C, SIGTERM or by typing q and Enter.
+HEADLESS = False
+
+# Maximum refresh rate of the preview window of each car.
+PREVIEW_FPS = 10
+
+def decode_frame(frame_format, image_data, pool):
+	"""Turn the image data received from a car into an image array.
+
+	Args:
+		frame_format: Frame format, width and height, as sent by the client.
+		image_data: The bytes of one frame, a memoryview of a pooled buffer.
+		pool: BufferPool for the converted image of YUV frames.
 
-		# Construct a stream to hold the image data and read the image
-		# data from the connection.
-		image_stream = io.BytesIO()
-		image_stream.write(connection.read(image_len))
+	Returns:
+		The image, whether it is in BGR order, and the pooled buffer holding the
+		converted image (None if the image needs no extra buffer).
 
-		# Rewind the stream, open it as an image with OpenCV and do some
-		# processing on it.
-		image_stream.seek(0)
+	Raises:
+		ValueError: The JPEG data can't be decoded, or a raw frame has the wrong length.
+	"""
+	fmt, width, height = frame_format
 
-		# Convert the stream to image array.
-		img_array = np.asarray(bytearray(image_stream.read()), dtype=np.uint8)
+	# View the received bytes as an array, without copying them.
+	img_array = np.frombuffer(image_data, dtype=np.uint8)
 
-		# Decode the image array.
+	# Decode the JPEG data.
+	if fmt == frame_protocol.FORMAT_JPEG:
 		image = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
-		cv2.imshow('image', image)
+		if image is None:
+			raise ValueError('Invalid JPEG frame of %d bytes' % len(image_data))
+		return image, True, None
 
-		# Process the image for prediction.
-		image = tf.image.resize(images=image, size=[IMG_HEIGHT, IMG_WIDTH])
-		image /= 255.0  # Normalize to [0,1] range.
+	expected_len = frame_protocol.raw_frame_len(fmt, width, height)
+	if len(image_data) != expected_len:
+		raise ValueError('Expected raw frames of %d bytes, got %d' % (expected_len, len(image_data)))
 
-		start = time.time()
+	# Raw frames are already small, crop the padding of the view.
+	padded_width, padded_height = frame_protocol.raw_padded_size(width, height)
 
-		# Start prediction.
-		prediction = model.predict(tf.expand_dims(image, axis=0))
+	if fmt == frame_protocol.FORMAT_RGB:
+		return img_array.reshape(padded_height, padded_width, 3)[:height, :width], False, None
 
-		print(time.time() - start)  # Time used by prediction.
+	# Convert YUV into a pooled buffer too.
+	rgb_buffer = pool.acquire(padded_width * padded_height * 3)
+	image = np.frombuffer(rgb_buffer, dtype=np.uint8, count=padded_width * padded_height * 3)
+	image = image.reshape(padded_height, padded_width, 3)
+	cv2.cvtColor(img_array.reshape(padded_height * 3 // 2, padded_width), cv2.COLOR_YUV2RGB_I420, dst=image)
+	return image[:height, :width], False, rgb_buffer
 
-		# Get the best result from the prediction.
-		key = np.argmax(prediction)
+def predict_batch(engine, timer, frames):
+	"""Predict the direction for a batch of decoded images.
 
-		# Sent the result to raspberry for moving control.
-		connection.write(str(key).encode('utf-8'))
-		connection.flush()
+	Args:
+		engine: The InferenceEngine wrapping the model.
+		timer: StageTimer recording the latency of each stage.
+		frames: A list of (image, bgr) from decode_frame, sizes may differ between cars.
+
+	Returns:
+		The predicted class of each image.
+	"""
+	images = [image for image, _ in frames]
+
+	# Process the images for prediction.
+	with timer.stage('resize'):
+		engine.preprocess(images, bgr=[bgr for _, bgr in frames])
+
+	# Start prediction, one call for the whole batch.
+	with timer.stage('predict'):
+		predictions = engine.forward(len(images))
+
+	# Get the best result from the prediction.
+	return np.argmax(predictions, axis=1)
+
+async def send_predictions(frame_stream, pool, replies, timer):
+	"""Send the predictions of a client back in the order its frames came in.
 
-		# When you press the 'q' key, quit prediction.
-		if cv2.waitKey(1) & 0xFF == ord('q'):
+	Args:
+		frame_stream: AsyncFrameStream of the client.
+		pool: BufferPool of the server.
+		replies: Queue of (sequence number, future of the prediction, image data,
+			extra buffer), None to stop.
+		timer: StageTimer recording the latency of each stage.
+	"""
+	while True:
+		item = await replies.get()
+		if item is None:
 			break
 
-finally:
-	connection.close()
-	server_socket.close()
+		seq, future, image_data, rgb_buffer = item
+		try:
+			key = await future
+		finally:
+			# The frame is preprocessed, its buffers can take the next frames.
+			frame_stream.release(image_data)
+			if rgb_buffer is not None:
+				pool.release(rgb_buffer)
+
+		# Sent the result to raspberry for moving control.
+		start = time.perf_counter()
+		await frame_stream.write_prediction(seq, key)
+		timer.record('reply', time.perf_counter() - start)
+
+async def report_stats(timer):
+	"""Report the per-stage latency every STATS_INTERVAL seconds."""
+	while True:
+		await asyncio.sleep(STATS_INTERVAL)
+		timer.report()
+
+async def handle_client(batcher, timer, pool, viewer, sock, peer):
+	"""Receive the frames of one car and queue them for prediction.
+
+	Args:
+		batcher: DynamicBatcher shared by all the cars.
+		timer: StageTimer recording the latency of each stage.
+		pool: BufferPool the frames are received into.
+		viewer: Preview showing the frames, None when headless.
+		sock: Non-blocking socket of the connection.
+		peer: Address of the car.
+	"""
+	frame_stream = frame_protocol.AsyncFrameStream(sock, pool, timer)
+	replies = asyncio.Queue()
+	reply_task = None
+	recording = None
+
+	try:
+		# Detect whether the client talks the lock-step or the pipelined protocol.
+		await frame_stream.start()
+		print('%s client connected from %s, frame format %d (%dx%d)' % (
+			('Pipelined' if frame_stream.pipelined else 'Lock-step', peer) + frame_stream.frame_format))
+
+		if RECORD_DIR:
+			if not os.path.isdir(RECORD_DIR):
+				os.makedirs(RECORD_DIR)
+			recording = frame_recording.RecordingWriter(
+				os.path.join(RECORD_DIR, '%s-%d-%s.frames' % (peer[0], peer[1], time.strftime('%Y%m%d-%H%M%S'))),
+				*frame_stream.frame_format)
+
+		reply_task = asyncio.ensure_future(send_predictions(frame_stream, pool, replies, timer))
+
+		while not reply_task.done():
+			# Read the next frame. None means the client ended the stream.
+			frame = await frame_stream.read_frame()
+
+			if frame is None:
+				break
+
+			seq, timestamp, image_data = frame
+
+			if recording:
+				recording.write(image_data, time.time() if timestamp is None else timestamp)
+
+			# Decode the image data.
+			with timer.stage('decode'):
+				try:
+					image, bgr, rgb_buffer = decode_frame(frame_stream.frame_format, image_data, pool)
+				except ValueError:
+					frame_stream.release(image_data)
+					raise
+			if viewer:
+				viewer.show('image %s:%d' % peer[:2], image, bgr)
+
+			replies.put_nowait((seq, batcher.submit((image, bgr)), image_data, rgb_buffer))
+
+	except (EOFError, ConnectionError):
+		pass
+
+	except ValueError as e:
+		print('Dropping %s, invalid stream: %s' % (peer, e))
+
+	finally:
+		if reply_task is not None:
+			replies.put_nowait(None)
+			try:
+				await reply_task
+			except ConnectionError:
+				pass
+			except Exception as e:
+				print('Replying to %s failed: %r' % (peer, e))
+
+		# The replies left behind by a failed reply task still hold pool buffers. Their
+		# predictions may still read the frames, so wait for them before releasing.
+		while not replies.empty():
+			item = replies.get_nowait()
+			if item is None:
+				continue
+			seq, future, image_data, rgb_buffer = item
+			try:
+				await future
+			except Exception:
+				pass
+			frame_stream.release(image_data)
+			if rgb_buffer is not None:
+				pool.release(rgb_buffer)
+
+		if recording:
+			recording.close()
+		sock.close()
+		print('Client %s disconnected' % (peer,))
+
+async def serve(batcher, timer, pool, viewer):
+	"""Accept the cars and handle each of them in its own task.
+
+	When cancelled, the client tasks are cancelled too, and awaited.
+	"""
+	loop = asyncio.get_event_loop()
+	clients = set()
+
+	# Start a socket listening for connections on 0.0.0.0:8000 (0.0.0.0 means
+	# all interfaces).
+	server_socket = socket.socket()
+	server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	server_socket.bind(('0.0.0.0', PORT))
+	server_socket.listen()
+	server_socket.setblocking(False)
+
+	try:
+		while True:
+			sock, peer = await loop.sock_accept(server_socket)
+			sock.setblocking(False)
+			# Send the tiny replies right away instead of waiting to fill a packet.
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			client = asyncio.ensure_future(handle_client(batcher, timer, pool, viewer, sock, peer))
+			clients.add(client)
+			client.add_done_callback(clients.discard)
+	finally:
+		server_socket.close()
+		for client in list(clients):
+			client.cancel()
+		if clients:
+			await asyncio.wait(list(clients))
+
+if __name__ == '__main__':
+	# Load the model for prediction.
+	engine = inference_engine.InferenceEngine('best_model.h5', max_batch_size=MAX_BATCH_SIZE)
+
+	# Collect the latency of every stage of the server.
+	timer = stage_timer.StageTimer('server', report_interval=STATS_INTERVAL, csv_path=STATS_CSV)
+
+	loop = asyncio.get_event_loop()
+	batcher = dynamic_batcher.DynamicBatcher(lambda images: predict_batch(engine, timer, images),
+											 max_batch_size=MAX_BATCH_SIZE,
+											 max_wait_ms=MAX_BATCH_WAIT_MS,
+											 timer=timer)
+
+	# Frames of all the cars are received into buffers of this pool.
+	pool = buffer_pool.BufferPool()
+
+	# Quit from the preview window, the terminal or with SIGTERM, whichever is available.
+	def quit_server():
+		loop.call_soon_threadsafe(loop.stop)
+
+	viewer = None
+	if not HEADLESS:
+		viewer = preview.Preview(max_fps=PREVIEW_FPS, on_quit=quit_server)
+		viewer.start()
+	preview.watch_stdin(quit_server)
+	loop.add_signal_handler(signal.SIGTERM, loop.stop)
+
+	serve_task = asyncio.ensure_future(serve(batcher, timer, pool, viewer))
+	batch_task = asyncio.ensure_future(batcher.run())
+	stats_task = asyncio.ensure_future(report_stats(timer))
+
+	start = time.time()
+	try:
+		loop.run_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		# Stop the clients first, the batcher still answers the frames they wait for.
+		serve_task.cancel()
+		loop.run_until_complete(asyncio.wait([serve_task]))
+		for task in (batch_task, stats_task):
+			task.cancel()
+		loop.run_until_complete(asyncio.wait([batch_task, stats_task]))
+		loop.close()
+		if viewer:
+			viewer.close()
+		timer.close()
+
+	finish = time.time()
+	print('Predicted %d frames in %d batches at %.2ffps' % (
+		batcher.frame_count, batcher.batch_count, batcher.frame_count / (finish-start)))
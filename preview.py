@@ -0,0 +1,111 @@
+"""Rate-limited preview of frames, and quit handling that needs no window.
+
+cv2.imshow and cv2.waitKey cost milliseconds and need a display, so they don't belong in
+the loop handling every frame. Preview shows the latest frame of each window from a thread
+of its own, at most max_fps times a second. Without a preview (headless), the program is
+stopped with Ctrl+C, SIGTERM or by typing q and Enter, see watch_stdin.
+"""
+
+import sys
+import time
+import threading
+
+import cv2
+
+class Preview(object):
+	"""Class for showing the latest frames in OpenCV windows at a capped rate.
+
+	Frames offered faster than max_fps are ignored right away, so show is cheap to call
+	for every frame. The others are copied, because the caller may reuse their buffer.
+	The windows are drawn by the preview thread, which works with the GTK and Qt backends
+	of OpenCV on Linux.
+
+	The sample usage of this class is like:
+
+	'''
+	preview = Preview(max_fps=10, on_quit=stop.set)
+	preview.start()
+
+	while not stop.is_set():
+		frame = capture()
+		preview.show('image', frame)
+
+	preview.close()
+	'''
+	"""
+
+	def __init__(self, max_fps=10, on_quit=None):
+		"""Inits Preview.
+
+		Args:
+			max_fps: Maximum refresh rate of each window.
+			on_quit: Function called from the preview thread when 'q' is pressed in a window.
+		"""
+		self._interval = 1.0 / max_fps
+		self._on_quit = on_quit
+		self._frames = {}  # Window name -> (image, bgr) not shown yet.
+		self._last_show = {}  # Window name -> time the last frame was accepted.
+		self._lock = threading.Lock()
+		self._stop = threading.Event()
+		self._thread = threading.Thread(target=self._run, name='preview')
+		self._thread.daemon = True
+
+	def start(self):
+		"""Start the preview thread."""
+		self._thread.start()
+
+	def show(self, window, image, bgr=True):
+		"""Offer a frame to a window, it is dropped if the window was refreshed too recently.
+
+		Args:
+			window: Name of the window.
+			image: uint8 image array.
+			bgr: Whether the image is BGR (OpenCV order) or RGB.
+		"""
+		now = time.time()
+		if now - self._last_show.get(window, 0) < self._interval:
+			return
+		self._last_show[window] = now
+		with self._lock:
+			self._frames[window] = (image.copy(), bgr)
+
+	def close(self):
+		"""Stop the preview thread and close the windows."""
+		self._stop.set()
+		if self._thread.is_alive():
+			self._thread.join()
+
+	def _run(self):
+		"""Draw the latest frames until closed."""
+		try:
+			while not self._stop.is_set():
+				with self._lock:
+					frames, self._frames = self._frames, {}
+
+				for window, (image, bgr) in frames.items():
+					cv2.imshow(window, image if bgr else cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+
+				# waitKey also lets the windows process their events.
+				key = cv2.waitKey(max(1, int(self._interval * 1000))) & 0xFF
+				if key == ord('q') and self._on_quit:
+					self._on_quit()
+		finally:
+			cv2.destroyAllWindows()
+
+def watch_stdin(on_quit):
+	"""Call on_quit when q (or quit) is typed on the standard input, from a daemon thread.
+
+	Args:
+		on_quit: Function to call, from the watching thread.
+	"""
+	def watch():
+		for line in sys.stdin:
+			if line.strip().lower() in ('q', 'quit'):
+				on_quit()
+				return
+		# No terminal (e.g. started with < /dev/null): only signals can stop the program.
+
+	thread = threading.Thread(target=watch, name='stdin')
+	thread.daemon = True
+	thread.start()
+	return thread
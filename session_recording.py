@@ -0,0 +1,276 @@
+"""Append-only recording of labelled frames, one folder per data collection session.
+
+Instead of one tiny file per frame, a session appends the encoded frames to chunk files,
+rotated when they reach a size limit, and keeps index.json next to them:
+
+	sessions/20191117-093000/chunk-00000.rec
+	sessions/20191117-093000/chunk-00001.rec
+	sessions/20191117-093000/index.json
+
+	chunk:  <4s magic b'ACSR'><B version> + records
+	record: <L image length><d seconds since the session start (monotonic)><B label> + image data
+
+index.json holds the class names, the wall-clock start time of the session and, for each
+chunk, its frame count, size, frames per class and time range. It is written atomically
+when the session starts, on every rotation and on close, which marks it closed. After a
+crash, SessionReader rebuilds the entries of the chunks still open from their records.
+Export the sessions to TFRecord shards for ImageDataset with dataset_packer.py --sessions.
+"""
+
+import os
+import glob
+import json
+import struct
+import threading
+import time
+
+MAGIC = b'ACSR'
+VERSION = 1
+
+CHUNK_HEADER_FORMAT = '<4sB'
+CHUNK_HEADER_SIZE = struct.calcsize(CHUNK_HEADER_FORMAT)
+
+RECORD_FORMAT = '<LdB'
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+# Name of the index in the session folder.
+INDEX_NAME = 'index.json'
+
+# Chunk files are rotated beyond this size.
+CHUNK_MAX_BYTES = 64 * 1024 * 1024
+
+def chunk_name(number):
+	"""Get the file name of a chunk of a session."""
+	return 'chunk-%05d.rec' % number
+
+class SessionRecorder(object):
+	"""Class for recording a session.
+
+	append may be called from several threads, e.g. as the sink of an
+	image_writer.AsyncImageWriter encoding the frames.
+
+	The sample usage of this class is like:
+
+	'''
+	recorder = SessionRecorder('./sessions', ['move_forward', 'move_left', 'move_right'])
+	recorder.append(('move_left', time.monotonic()), jpeg_data)
+	recorder.close()
+	'''
+	"""
+
+	def __init__(self, root, label_names, chunk_max_bytes=CHUNK_MAX_BYTES):
+		"""Inits SessionRecorder, creating the session folder under root.
+
+		Args:
+			root: Folder of the sessions.
+			label_names: Class names, the records store their index.
+			chunk_max_bytes: Size beyond which a chunk is rotated.
+		"""
+		self._label_to_index = dict((name, index) for index, name in enumerate(label_names))
+		self._chunk_max_bytes = chunk_max_bytes
+		self._lock = threading.Lock()
+
+		# The monotonic clock orders the frames, the wall clock only dates the session.
+		self._start_time = time.time()
+		self._start_monotonic = time.monotonic()
+		self._path = os.path.join(root, time.strftime('%Y%m%d-%H%M%S', time.localtime(self._start_time)))
+		os.makedirs(self._path)
+
+		self._index = {'label_names': list(label_names), 'start_time': self._start_time, 'chunks': [], 'closed': False}
+		self._file = None
+		self._open_chunk()
+
+		# Written up front, so the session can be read even if it is never closed.
+		self._write_index()
+
+	@property
+	def path(self):
+		"""Get the folder of the session."""
+		return self._path
+
+	def _open_chunk(self):
+		"""Start a new chunk file."""
+		chunk = {'file': chunk_name(len(self._index['chunks'])), 'count': 0, 'bytes': CHUNK_HEADER_SIZE,
+				 'class_counts': [0] * len(self._label_to_index), 'first': None, 'last': None}
+		self._index['chunks'].append(chunk)
+		self._file = open(os.path.join(self._path, chunk['file']), 'wb')
+		self._file.write(struct.pack(CHUNK_HEADER_FORMAT, MAGIC, VERSION))
+
+	def _write_index(self):
+		"""Replace the index of the session, atomically."""
+		index_path = os.path.join(self._path, INDEX_NAME)
+		with open(index_path + '.tmp', 'w') as f:
+			json.dump(self._index, f, indent=1)
+		os.replace(index_path + '.tmp', index_path)
+
+	def append(self, key, data):
+		"""Append a frame.
+
+		Args:
+			key: (label name, time.monotonic() of the capture).
+			data: Encoded image, any object supporting the buffer protocol.
+		"""
+		label, timestamp = key
+		label_index = self._label_to_index[label]
+		with self._lock:
+			if self._file is None:
+				raise ValueError('The session is closed')
+
+			chunk = self._index['chunks'][-1]
+			if chunk['count'] and chunk['bytes'] + RECORD_SIZE + len(data) > self._chunk_max_bytes:
+				self._file.close()
+				self._open_chunk()
+				self._write_index()
+				chunk = self._index['chunks'][-1]
+
+			offset = timestamp - self._start_monotonic
+			self._file.write(struct.pack(RECORD_FORMAT, len(data), offset, label_index))
+			self._file.write(data)
+
+			chunk['count'] += 1
+			chunk['bytes'] += RECORD_SIZE + len(data)
+			chunk['class_counts'][label_index] += 1
+			chunk['first'] = offset if chunk['first'] is None else min(chunk['first'], offset)
+			chunk['last'] = offset if chunk['last'] is None else max(chunk['last'], offset)
+
+	def close(self):
+		"""Close the last chunk and write the final index."""
+		with self._lock:
+			if self._file is None:
+				return
+			self._file.close()
+			self._file = None
+			self._index['closed'] = True
+			self._write_index()
+
+class SessionReader(object):
+	"""Class for reading a session.
+
+	The sample usage of this class is like:
+
+	'''
+	session = SessionReader('./sessions/20191117-093000')
+	for timestamp, label, data in session:
+		...
+	session.close()
+	'''
+	"""
+
+	def __init__(self, path):
+		"""Inits SessionReader, reading the index.
+
+		The entries of the chunks a crash left open, or out of the index, are rebuilt from their records.
+
+		Raises:
+			ValueError: The folder is not a session.
+		"""
+		self._path = path
+		self._files = {}  # Chunk path -> open file, for read.
+		index_path = os.path.join(path, INDEX_NAME)
+		if not os.path.exists(index_path):
+			raise ValueError('%s is not a recorded session' % path)
+		with open(index_path) as f:
+			self._index = json.load(f)
+
+		if not self._index.get('closed', True):
+			self._rebuild_index()
+
+	def _rebuild_index(self):
+		"""Replace the entries of the last chunk of the index, and of the chunks after it, by their records."""
+		chunks = self._index['chunks'][:-1]
+		indexed = set(chunk['file'] for chunk in chunks)
+		for chunk_path in self._chunk_paths():
+			name = os.path.basename(chunk_path)
+			if name in indexed:
+				continue
+			chunk = {'file': name, 'count': 0, 'bytes': CHUNK_HEADER_SIZE,
+					 'class_counts': [0] * len(self.label_names), 'first': None, 'last': None}
+			for position, length, offset, label in self._chunk_records(chunk_path):
+				chunk['count'] += 1
+				chunk['bytes'] = position + length
+				chunk['class_counts'][label] += 1
+				chunk['first'] = offset if chunk['first'] is None else min(chunk['first'], offset)
+				chunk['last'] = offset if chunk['last'] is None else max(chunk['last'], offset)
+			chunks.append(chunk)
+		self._index['chunks'] = chunks
+
+	@property
+	def path(self):
+		"""Get the folder of the session."""
+		return self._path
+
+	@property
+	def label_names(self):
+		"""Get the class names of the records."""
+		return self._index['label_names']
+
+	@property
+	def start_time(self):
+		"""Get the wall-clock start time of the session."""
+		return self._index['start_time']
+
+	@property
+	def chunks(self):
+		"""Get the chunks listed by the index, a list of {'file', 'count', 'bytes', 'class_counts', 'first', 'last'}."""
+		return self._index['chunks']
+
+	def _chunk_paths(self):
+		"""Get the chunk files of the session, in order."""
+		return sorted(glob.glob(os.path.join(self._path, 'chunk-*.rec')))
+
+	def _chunk_records(self, chunk_path):
+		"""Yield (data offset, data length, seconds since the session start, label index) of the records of a chunk.
+
+		A chunk cut short by a crash, before its header or within its last record, ends there.
+		"""
+		with open(chunk_path, 'rb') as f:
+			header = f.read(CHUNK_HEADER_SIZE)
+			if len(header) != CHUNK_HEADER_SIZE:
+				return
+			if struct.unpack(CHUNK_HEADER_FORMAT, header) != (MAGIC, VERSION):
+				raise ValueError('%s is not a session chunk of version %d' % (chunk_path, VERSION))
+			size = os.fstat(f.fileno()).st_size
+			position = CHUNK_HEADER_SIZE
+			while True:
+				record_header = f.read(RECORD_SIZE)
+				if len(record_header) != RECORD_SIZE:
+					break
+				length, offset, label = struct.unpack(RECORD_FORMAT, record_header)
+				position += RECORD_SIZE
+				if position + length > size:
+					break
+				yield position, length, offset, label
+				f.seek(length, os.SEEK_CUR)
+				position += length
+
+	def records(self):
+		"""Yield (chunk file, data offset, data length, capture time, label index) of every frame.
+
+		Every chunk file is read, including one missing from the index after a crash.
+		"""
+		for chunk_path in self._chunk_paths():
+			for position, length, offset, label in self._chunk_records(chunk_path):
+				yield chunk_path, position, length, self.start_time + offset, label
+
+	def read(self, chunk_path, position, length):
+		"""Read the image data of a record, through one file per chunk kept open until close."""
+		f = self._files.get(chunk_path)
+		if f is None:
+			f = self._files[chunk_path] = open(chunk_path, 'rb')
+		f.seek(position)
+		return f.read(length)
+
+	def close(self):
+		"""Close the chunk files opened by read."""
+		for f in self._files.values():
+			f.close()
+		self._files.clear()
+
+	def __iter__(self):
+		"""Yield (capture time, label name, image data) of every frame."""
+		for chunk_path, position, length, timestamp, label in self.records():
+			yield timestamp, self.label_names[label], self.read(chunk_path, position, length)
+
+def find_sessions(root):
+	"""Get the session folders under root, oldest first."""
+	return sorted(os.path.dirname(path) for path in glob.glob(os.path.join(root, '*', INDEX_NAME)))
@@ -0,0 +1,199 @@
+"""Per-stage latency statistics for the capture -> predict -> actuate loop.
+
+Each stage feeds an HDR-style histogram (log-linear buckets with a fixed relative error),
+so recording a sample is cheap and percentiles stay accurate from microseconds to seconds.
+The stats are printed periodically and appended to a CSV file, one row per stage.
+"""
+
+import os
+import csv
+import time
+import threading
+import contextlib
+
+class LatencyHistogram(object):
+	"""Class for HDR-style latency histogram.
+
+	Samples are stored in microseconds. Values below 2^sub_bucket_bits are counted exactly,
+	bigger values fall into buckets whose width doubles with every power of two, which keeps
+	the relative error below 2^-(sub_bucket_bits-1).
+	"""
+
+	def __init__(self, sub_bucket_bits=8):
+		"""Inits LatencyHistogram.
+
+		Args:
+			sub_bucket_bits: Precision of the histogram, 8 bits is below 1% relative error.
+		"""
+		self._sub_bucket_bits = sub_bucket_bits
+		self._sub_bucket_count = 1 << sub_bucket_bits
+		self.reset()
+
+	def reset(self):
+		"""Forget all the samples."""
+		self._counts = {}  # Bucket index -> sample count.
+		self._count = 0
+		self._total = 0
+		self._max = 0
+
+	def _index(self, value):
+		"""Get the bucket index of a value in microseconds."""
+		if value < self._sub_bucket_count:
+			return value
+		shift = value.bit_length() - self._sub_bucket_bits
+		return (shift << (self._sub_bucket_bits - 1)) + (value >> shift)
+
+	def _value(self, index):
+		"""Get the middle value of a bucket in microseconds."""
+		if index < self._sub_bucket_count:
+			return index
+		shift = (index >> (self._sub_bucket_bits - 1)) - 1
+		lowest = (index - (shift << (self._sub_bucket_bits - 1))) << shift
+		return lowest + (1 << shift) // 2
+
+	def record(self, seconds):
+		"""Record a latency sample in seconds."""
+		value = max(0, int(seconds * 1e6))
+		index = self._index(value)
+		self._counts[index] = self._counts.get(index, 0) + 1
+		self._count += 1
+		self._total += value
+		self._max = max(self._max, value)
+
+	def merge(self, other):
+		"""Add the samples of another histogram of the same precision."""
+		for index, count in other._counts.items():
+			self._counts[index] = self._counts.get(index, 0) + count
+		self._count += other._count
+		self._total += other._total
+		self._max = max(self._max, other._max)
+
+	@property
+	def count(self):
+		"""Get the number of samples."""
+		return self._count
+
+	@property
+	def mean(self):
+		"""Get the mean latency in seconds."""
+		return self._total / self._count / 1e6 if self._count else 0.0
+
+	@property
+	def max(self):
+		"""Get the maximum latency in seconds."""
+		return self._max / 1e6
+
+	def percentile(self, percent):
+		"""Get the latency in seconds below which percent of the samples fall."""
+		if not self._count:
+			return 0.0
+		rank = max(1, int(round(percent / 100.0 * self._count)))
+		seen = 0
+		for index in sorted(self._counts):
+			seen += self._counts[index]
+			if seen >= rank:
+				return min(self._value(index), self._max) / 1e6
+		return self.max
+
+class StageTimer(object):
+	"""Class for collecting the latency of the stages of a loop.
+
+	The sample usage of this class is like:
+
+	'''
+	timer = StageTimer('client', report_interval=5, csv_path='logs/latency/client.csv')
+
+	while True:
+		with timer.stage('capture'):
+			frame = capture()
+		with timer.stage('send'):
+			send(frame)
+		timer.maybe_report()
+
+	timer.close()
+	'''
+	"""
+
+	CSV_FIELDS = ['time', 'side', 'stage', 'count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms']
+
+	def __init__(self, name, report_interval=5.0, csv_path=None):
+		"""Inits StageTimer.
+
+		Args:
+			name: Name of this side of the loop, e.g. 'client' or 'server'.
+			report_interval: Seconds between two reports.
+			csv_path: CSV file the reports are appended to, None to only print them.
+		"""
+		self._name = name
+		self._report_interval = report_interval
+		self._histograms = {}  # Stage name -> LatencyHistogram, in the order stages first appear.
+		self._lock = threading.Lock()  # Stages may be recorded from several threads.
+		self._last_report = time.time()
+
+		self._csv_file = None
+		if csv_path:
+			csv_dir = os.path.dirname(csv_path)
+			if csv_dir and not os.path.isdir(csv_dir):
+				os.makedirs(csv_dir)
+			new_file = not os.path.exists(csv_path)
+			self._csv_file = open(csv_path, 'a', newline='')
+			self._csv_writer = csv.writer(self._csv_file)
+			if new_file:
+				self._csv_writer.writerow(self.CSV_FIELDS)
+
+	def record(self, stage, seconds):
+		"""Record the latency of one run of a stage."""
+		with self._lock:
+			histogram = self._histograms.get(stage)
+			if histogram is None:
+				histogram = self._histograms[stage] = LatencyHistogram()
+			histogram.record(seconds)
+
+	@contextlib.contextmanager
+	def stage(self, stage):
+		"""Time the body of a with statement as one run of a stage."""
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.record(stage, time.perf_counter() - start)
+
+	def maybe_report(self):
+		"""Report the stats if report_interval has passed since the last report."""
+		if time.time() - self._last_report >= self._report_interval:
+			self.report()
+
+	def report(self):
+		"""Print the stats of every stage since the last report, and start a new interval."""
+		now = time.time()
+		with self._lock:
+			elapsed = now - self._last_report
+			self._last_report = now
+			rows = []
+			for stage, histogram in self._histograms.items():
+				if histogram.count:
+					rows.append([stage, histogram.count, histogram.mean * 1000,
+								 histogram.percentile(50) * 1000, histogram.percentile(95) * 1000,
+								 histogram.percentile(99) * 1000, histogram.max * 1000])
+				histogram.reset()
+
+		if not rows:
+			return
+
+		print('%s latency over the last %.1f s (ms):' % (self._name, elapsed))
+		print('  %-12s %7s %8s %8s %8s %8s %8s' % ('stage', 'count', 'mean', 'p50', 'p95', 'p99', 'max'))
+		for row in rows:
+			print('  %-12s %7d %8.2f %8.2f %8.2f %8.2f %8.2f' % tuple(row))
+
+		if self._csv_file:
+			for row in rows:
+				self._csv_writer.writerow(['%.3f' % now, self._name, row[0], row[1]] +
+										  ['%.3f' % value for value in row[2:]])
+			self._csv_file.flush()
+
+	def close(self):
+		"""Report the last interval and close the CSV file."""
+		self.report()
+		if self._csv_file:
+			self._csv_file.close()
+			self._csv_file = None
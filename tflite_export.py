@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+"""Export the trained model as a full-integer quantized TFLite model for the Raspberry Pi.
+
+Weights and activations are quantized to 8 bits with post-training quantization,
+calibrated on a sample of the dataset. The input is uint8 with a scale of 1/255, so the
+raw camera pixels can be fed without normalization.
+Needs TensorFlow 2.3 or newer for the integer input and output types.
+
+Usage:
+	python tflite_export.py --model best_model.h5 --output best_model_int8.tflite
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+
+import tensorflow as tf
+from tensorflow import keras
+
+import image_dataset
+
+def export_tflite(model, sample_ds, path):
+	"""Convert a keras model to an int8 TFLite model.
+
+	Args:
+		model: The trained keras model.
+		sample_ds: Dataset of normalized images to calibrate the quantization ranges,
+			e.g. ImageDataset.sample_images(200).
+		path: Path of the TFLite file to write.
+	"""
+	def representative_dataset():
+		for image in sample_ds:
+			yield [tf.expand_dims(image, axis=0)]
+
+	converter = tf.lite.TFLiteConverter.from_keras_model(model)
+	converter.optimizations = [tf.lite.Optimize.DEFAULT]
+	converter.representative_dataset = representative_dataset
+
+	# Fail instead of falling back to float kernels, the Pi should run integer ops only.
+	converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+	converter.inference_input_type = tf.uint8
+	converter.inference_output_type = tf.uint8
+
+	with open(path, 'wb') as f:
+		f.write(converter.convert())
+
+def parse_args():
+	"""Parse the command line arguments."""
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--model', default='best_model.h5', help='Model saved by train.py.')
+	parser.add_argument('--output', default='best_model_int8.tflite', help='TFLite file to write.')
+	parser.add_argument('--dataset', default='./dataset', help='Dataset to calibrate on.')
+	parser.add_argument('--samples', type=int, default=200, help='Images to calibrate on.')
+	return parser.parse_args()
+
+if __name__ == '__main__':
+	args = parse_args()
+	model = keras.models.load_model(args.model)
+	img_size = tuple(model.input_shape[1:3])  # (h, w)
+
+	dataset = image_dataset.ImageDataset(img_path=args.dataset, img_size=img_size)
+	export_tflite(model, dataset.sample_images(args.samples), args.output)
+	print('Saved %s, calibrated on %d images' % (args.output, min(args.samples, dataset.img_count)))
@@ -0,0 +1,99 @@
+"""Predict the direction on the Raspberry Pi with the int8 TFLite model.
+
+Uses the small tflite_runtime package when it is installed (the usual case on the Pi),
+otherwise the interpreter bundled with TensorFlow.
+"""
+
+import numpy as np
+
+try:
+	from tflite_runtime.interpreter import Interpreter
+except ImportError:
+	import tensorflow as tf
+	Interpreter = tf.lite.Interpreter
+
+class TFLitePilot(object):
+	"""Class for local prediction with a TFLite model.
+
+	The sample usage of this class is like:
+
+	'''
+	pilot = TFLitePilot('best_model_int8.tflite', num_threads=4)
+	h, w = pilot.img_size
+	key = pilot.predict_class(rgb_image)  # uint8 RGB image of size (h, w).
+	'''
+	"""
+
+	def __init__(self, model_path, num_threads=4):
+		"""Inits TFLitePilot with the model exported by tflite_export.py.
+
+		Args:
+			model_path: Path of the TFLite model.
+			num_threads: Threads used by the interpreter, the Pi 3B+ has 4 cores.
+		"""
+		try:
+			self._interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+		except TypeError:  # Old interpreters have no num_threads argument.
+			self._interpreter = Interpreter(model_path=model_path)
+		self._interpreter.allocate_tensors()
+
+		input_details = self._interpreter.get_input_details()[0]
+		output_details = self._interpreter.get_output_details()[0]
+		self._input_index = input_details['index']
+		self._output_index = output_details['index']
+		self._input_dtype = input_details['dtype']
+		_, self._img_height, self._img_width, _ = input_details['shape']
+
+		# Map [0, 255] pixels to the quantized input. The exported model takes uint8 with
+		# scale 1/255 and zero point 0, so the pixels are fed as they are.
+		input_scale, input_zero_point = input_details['quantization']
+		if self._input_dtype == np.float32:
+			self._input_scale, self._input_zero_point = 1 / 255.0, 0
+		else:
+			self._input_scale, self._input_zero_point = 1 / 255.0 / input_scale, input_zero_point
+		self._identity_input = (self._input_dtype == np.uint8 and
+								abs(self._input_scale - 1) < 1e-3 and self._input_zero_point == 0)
+
+		self._output_scale, self._output_zero_point = output_details['quantization']
+		self._input = np.empty((1, self._img_height, self._img_width, 3), dtype=self._input_dtype)
+
+	@property
+	def img_size(self):
+		"""Get the image size input to the model, (h, w)."""
+		return self._img_height, self._img_width
+
+	def _invoke(self, image):
+		"""Run the model on one image and get its raw output."""
+		if self._identity_input:
+			np.copyto(self._input[0], image)
+		else:
+			quantized = image * self._input_scale + self._input_zero_point
+			if self._input_dtype != np.float32:
+				info = np.iinfo(self._input_dtype)
+				quantized = np.clip(np.round(quantized), info.min, info.max)
+			self._input[0] = quantized
+
+		self._interpreter.set_tensor(self._input_index, self._input)
+		self._interpreter.invoke()
+		return self._interpreter.get_tensor(self._output_index)[0]
+
+	def predict(self, image):
+		"""Predict the class probabilities of one image.
+
+		Args:
+			image: uint8 RGB image of size img_size.
+
+		Returns:
+			A NumPy array of class probabilities.
+		"""
+		output = self._invoke(image)
+		if self._output_scale:
+			return (output.astype(np.float32) - self._output_zero_point) * self._output_scale
+		return output
+
+	def predict_class(self, image):
+		"""Predict the class of one image.
+
+		The quantized output keeps the order of the probabilities, so no dequantization is needed.
+		"""
+		return int(np.argmax(self._invoke(image)))
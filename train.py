@@ -1,24 +1,43 @@
 #!/usr/bin/env python3
 
 """Train the model.
+
+The training runs under a tf.distribute strategy:
+	python train.py                                          # The default single device.
+	python train.py --strategy mirrored                      # All the GPUs of this host.
+	python train.py --strategy mirrored --cpu-devices 4      # Try it on a CPU-only box.
+	TF_CONFIG='{...}' python train.py --strategy multiworker # One process per host.
+benchmarks/bench_scaling.py measures the scaling efficiency with local workers.
+
+--model picks the architecture (see models.py), e.g.
+	python train.py --model tiny --output models/tiny.h5
+
+--teacher distills a trained model into a smaller one, e.g.
+	python train.py --model tiny --teacher best_model.h5 --output models/tiny.h5
+The student learns from the teacher's soft predictions and the hard labels. The teacher's
+predictions are computed once and cached next to the dataset arrays (numpy backend).
 """
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import os
+import argparse
 import datetime
-import pathlib
-import random
+import json
+import math
+import tempfile
+import time
 import matplotlib.pyplot as plt
 
 import tensorflow as tf
 
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import Dense, Conv2D, Flatten, Dropout, MaxPooling2D
-from tensorflow.keras import regularizers
 # from tensorflow.python.client import device_lib
 
+import batch_augment
+import dataset_cache
 import image_dataset
+import models
+import tflite_export
 
 print(tf.version.VERSION)
 
@@ -29,16 +48,40 @@ AUTOTUNE = tf.data.experimental.AUTOTUNE
 # os.environ["CUDA_VISIBLE_DEVICES"]="0"
 # print(device_lib.list_local_devices())
 
-# Image size for training.
-IMG_HEIGHT = 120
-IMG_WIDTH  = 160
+# Architecture of models.py, which also decides the image size for training.
+MODEL = 'nvidia'
 
+# Batch size of each replica (device), the global batch grows with the number of replicas.
 BATCH_SIZE = 128
 
 # We use early stopping to avoid long and unnecessary training times,
 # so you could set a larger epoch value.
 EPOCHS     = 100
 
+# Folder of the dataset and how it is stored:
+# 'files' for the class folders written by collect_data.py,
+# 'tfrecord' for the shards written by dataset_packer.py (e.g. DATASET_PATH = './dataset_packed').
+# 'numpy' for the class folders decoded once into memory-mapped arrays.
+DATASET_PATH    = './dataset'
+DATASET_BACKEND = 'files'
+
+# Augment the training batches (brightness/contrast jitter, small shifts, flips with left/right swapped),
+# with a fixed seed for reproducible runs, None for a different augmentation every run.
+AUGMENT      = True
+AUGMENT_SEED = None
+
+# Proportions of the classes in the training batches, in label order, or 'balanced' for equal ones.
+# The rare turning images are repeated more often, instead of weighting the loss (see README).
+CLASS_PROPORTIONS = 'balanced'
+
+# Distillation: temperature softening the predictions of the teacher and the student,
+# and weight of the hard labels in the loss (the soft predictions get the rest).
+DISTILL_TEMPERATURE = 4.0
+DISTILL_HARD_WEIGHT = 0.1
+
+# Number of images to calibrate the quantization of the TFLite model.
+TFLITE_CALIBRATION_SAMPLES = 200
+
 # The path for checkpoint callback.
 checkpoint_path = "training/cp.ckpt"
 checkpoint_dir = os.path.dirname(checkpoint_path)
@@ -46,120 +89,309 @@ checkpoint_dir = os.path.dirname(checkpoint_path)
 # The path for tensorboard log files.
 log_dir = "logs/fit/" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
 
-# Get the image dataset.
-dataset = image_dataset.ImageDataset(img_path='./dataset', img_size=(120, 160)) # img_size: (h, w)
+def parse_args():
+	"""Parse the command line arguments."""
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--model', choices=models.MODEL_NAMES, default=MODEL, help='Architecture, see models.py.')
+	parser.add_argument('--output', default='best_model.h5',
+						help='Keras model to save, the int8 TFLite copy goes next to it (best_model_int8.tflite).')
+	parser.add_argument('--teacher', help='Keras model to distill into the --model one, e.g. best_model.h5.')
+	parser.add_argument('--strategy', choices=['default', 'mirrored', 'multiworker'], default='default',
+						help='tf.distribute strategy, multiworker reads the cluster from TF_CONFIG.')
+	parser.add_argument('--cpu-devices', type=int, default=0,
+						help='Split the CPU into this many logical devices, and mirror on them (--strategy mirrored only).')
+	parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Batch size of each replica.')
+	parser.add_argument('--epochs', type=int, default=EPOCHS, help='Maximum number of epochs.')
+	parser.add_argument('--steps-per-epoch', type=int, default=None, help='Steps per epoch, default: the whole training set.')
+	parser.add_argument('--benchmark', action='store_true',
+						help='Only measure the training throughput, without validation or saving anything.')
+	args = parser.parse_args()
+	if args.cpu_devices and args.strategy != 'mirrored':
+		parser.error('--cpu-devices needs --strategy mirrored')
+	return args
+
+def split_cpu(count):
+	"""Split the CPU into logical devices, before TensorFlow initializes them."""
+	cpus = tf.config.experimental.list_physical_devices('CPU')
+	tf.config.experimental.set_virtual_device_configuration(
+		cpus[0], [tf.config.experimental.VirtualDeviceConfiguration() for i in range(count)])
+
+def create_strategy(name, cpu_devices=0):
+	"""Create the tf.distribute strategy.
+
+	Args:
+		name: 'default', 'mirrored' or 'multiworker'.
+		cpu_devices: Number of logical CPU devices to mirror on, 0 for the GPUs.
+
+	Returns:
+		The strategy.
+	"""
+	if name == 'mirrored':
+		if cpu_devices:
+			# NCCL needs GPUs, reduce on one device instead.
+			return tf.distribute.MirroredStrategy(devices=['/cpu:%d' % i for i in range(cpu_devices)],
+												  cross_device_ops=tf.distribute.ReductionToOneDevice())
+		return tf.distribute.MirroredStrategy()
+	if name == 'multiworker':
+		if hasattr(tf.distribute, 'MultiWorkerMirroredStrategy'):
+			return tf.distribute.MultiWorkerMirroredStrategy()
+		return tf.distribute.experimental.MultiWorkerMirroredStrategy()
+	return tf.distribute.get_strategy()
+
+def worker_info():
+	"""Get this worker's place in the cluster of TF_CONFIG.
 
-# Divide 80% of the dataset as the training dataset and the rest as the validation dataset.
-dataset.create(train_set_ratio=0.8, val_set_ratio=0.2, batch_size=BATCH_SIZE)
+	Returns:
+		(number of workers, index of this worker, whether it is the chief).
+	"""
+	tf_config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+	cluster = tf_config.get('cluster', {})
+	task = tf_config.get('task', {})
+	chiefs = len(cluster.get('chief', []))
+	workers = chiefs + len(cluster.get('worker', []))
+	if task.get('type') == 'chief':
+		return workers, 0, True
+	index = chiefs + task.get('index', 0)
+	return max(1, workers), index, index == 0
+
+class ThroughputCallback(tf.keras.callbacks.Callback):
+	"""Callback measuring the training images per second of every epoch."""
+
+	def __init__(self, global_batch_size, steps_per_epoch):
+		"""Inits ThroughputCallback.
+
+		Args:
+			global_batch_size: Images per step, on all the replicas.
+			steps_per_epoch: Steps of each epoch.
+		"""
+		super(ThroughputCallback, self).__init__()
+		self._images_per_epoch = global_batch_size * steps_per_epoch
+		self._rates = []
+
+	def on_epoch_begin(self, epoch, logs=None):
+		self._start = time.perf_counter()
+
+	def on_epoch_end(self, epoch, logs=None):
+		self._rates.append(self._images_per_epoch / (time.perf_counter() - self._start))
+		print('Epoch %d: %.1f images/s' % (epoch + 1, self._rates[-1]))
+
+	@property
+	def images_per_sec(self):
+		"""Get the mean throughput, without the first epoch (warm-up and cache build) if there are more."""
+		rates = self._rates[1:] or self._rates
+		return sum(rates) / len(rates) if rates else 0.0
+
+def distillation_loss(y_true, y_pred):
+	"""Loss of a student on batches of create(soft_targets=...): the label, then the teacher's predictions.
+
+	The cross-entropy with the hard labels, plus the KL divergence between the teacher and the
+	student softened by DISTILL_TEMPERATURE, scaled by its square to keep the gradients comparable.
+	The models end with a softmax, their log-probabilities stand for the logits.
+	"""
+	labels = y_true[:, 0]
+	teacher_logits = tf.math.log(tf.clip_by_value(y_true[:, 1:], 1e-7, 1.0))
+	student_logits = tf.math.log(tf.clip_by_value(y_pred, 1e-7, 1.0))
 
-print('Image count: ', dataset.img_count)
+	hard = tf.keras.losses.sparse_categorical_crossentropy(labels, y_pred)
+	soft = tf.keras.losses.kl_divergence(tf.nn.softmax(teacher_logits / DISTILL_TEMPERATURE),
+										 tf.nn.softmax(student_logits / DISTILL_TEMPERATURE))
+	return DISTILL_HARD_WEIGHT * hard + (1 - DISTILL_HARD_WEIGHT) * DISTILL_TEMPERATURE ** 2 * soft
 
-# Get the training and validation dataset.
-train_ds = dataset.train_ds
-val_ds   = dataset.val_ds
+def distillation_accuracy(y_true, y_pred):
+	"""Accuracy on the hard labels of distillation batches."""
+	return tf.keras.metrics.sparse_categorical_accuracy(y_true[:, :1], y_pred)
 
-def create_model():
+def create_model(name, class_count, distill=False):
 	"""Create the model.
-	The model structure is based on NVIDIA 2016 <End to end learning for self-driving cars>.
-	
+
+	Args:
+		name: Architecture, one of models.MODEL_NAMES.
+		class_count: Number of classes to predict.
+		distill: Whether to compile it for distillation batches, see distillation_loss.
+
 	Returns:
 		A initialized model.
 	"""
-	model = Sequential([
-		Conv2D(filters=24, kernel_size=5, strides=2, padding='same', activation='relu', input_shape=(IMG_HEIGHT, IMG_WIDTH, 3)),
-		Conv2D(filters=36, kernel_size=5, strides=2, padding='same', activation='relu', kernel_regularizer=regularizers.l2(0.001)),
-		Conv2D(filters=48, kernel_size=5, strides=2, padding='same', activation='relu', kernel_regularizer=regularizers.l2(0.001)),
-		Conv2D(filters=64, kernel_size=3, padding='same', activation='relu', kernel_regularizer=regularizers.l2(0.001)),
-		Conv2D(filters=64, kernel_size=3, padding='same', activation='relu', kernel_regularizer=regularizers.l2(0.001)),
-		Flatten(),
-		Dense(units=250, activation='relu', kernel_regularizer=regularizers.l2(0.001)),
-		Dense(units=dataset.class_count, activation='softmax')
-        Dense(units=dataset.class_count, activation='softmax')
-	])
-
-	model.compile(
-		optimizer='adam',
-		loss='sparse_categorical_crossentropy',
-		metrics=['accuracy']
-	)
+	model = models.build_model(name, class_count)
+	compile_model(model, distill)
 	return model
 
-# Create a model instance.
-model = create_model()
-
-# Display the model's architecture.
-model.summary()
-
-# Create checkpoint callback.
-cp_callback = tf.keras.callbacks.ModelCheckpoint(
-	filepath=checkpoint_path,
-	monitor='val_loss',
-	save_best_only=True,	# Set it true to save the best model at the end of training.
-	save_weights_only=True,	# Only thee model's weights will be saved.
-	mode='auto',	# In auto mode, the direction is automatically inferred from the name of the monitored quantity.
-	verbose=1
-)
-
-# Create early stopping callback.
-early_stop = tf.keras.callbacks.EarlyStopping(
-    monitor='val_loss',
-    patience=15,	# The amount of epochs to check for improvement.
-    verbose=1,
-    restore_best_weights=True
-)
-
-# Create tensorboard callback.
-tensorboard_callback = tf.keras.callbacks.TensorBoard(log_dir=log_dir, histogram_freq=1)
-
-# Total number of steps (batches of samples) before declaring one epoch finished and starting the next epoch. 
-steps_per_epoch = tf.math.ceil(dataset.train_size/BATCH_SIZE).numpy()
-print('Steps per epoch: ', steps_per_epoch)
-
-# Use to solve unbalanced training data.
-# 0: move_forward image label;
-# 1: turn_left image label;
-# 2: turn_right image label.
-class_weight={0:0.2, 1:0.3, 2:0.5}
-
-# Trains the model for a fixed number of epochs (iterations on a dataset).
-history = model.fit(
-	train_ds,
-	steps_per_epoch=steps_per_epoch,
-	epochs=EPOCHS,
-	callbacks=[cp_callback, early_stop, tensorboard_callback],
-	validation_data=val_ds,
-	class_weight=class_weight,
-	validation_steps=tf.math.ceil(dataset.val_size/BATCH_SIZE).numpy()
-)
-
-# Save the best model weights.
-# Because 'restore_best_weights' is True in 'early_stop' callback,
-# the model will restore weights from the epoch with the best value of the monitored quantity,
-# therefore we just save the model at this time
-model.save('best_model.h5')
-
-print('Model training stoped at: ', early_stop.stopped_epoch)
-
-# Visualize the training results:
-print(history.history)
-acc      = history.history['accuracy']
-val_acc  = history.history['val_accuracy']
-loss     = history.history['loss']
-val_loss = history.history['val_loss']
-
-plt.figure(figsize=(8, 8))
-
-x_axis = range(len(acc))
-plt.subplot(1, 2, 1)
-plt.plot(x_axis, acc, label='Training Accuracy')
-plt.plot(x_axis, val_acc, label='Validation Accuracy')
-plt.legend(loc='lower right')
-plt.title('Training and Validation Accuracy')
-
-x_axis = range(len(loss))
-plt.subplot(1, 2, 2)
-plt.plot(x_axis, loss, label='Training Loss')
-plt.plot(x_axis, val_loss, label='Validation Loss')
-plt.legend(loc='upper right')
-plt.title('Training and Validation Loss')
-plt.show()
+def compile_model(model, distill=False):
+	"""Compile the model for plain or distillation batches."""
+	if distill:
+		# Still named accuracy, for the history and the callbacks.
+		model.compile(
+			optimizer='adam',
+			loss=distillation_loss,
+			metrics=[tf.keras.metrics.MeanMetricWrapper(distillation_accuracy, name='accuracy')]
+		)
+	else:
+		model.compile(
+			optimizer='adam',
+			loss='sparse_categorical_crossentropy',
+			metrics=['accuracy']
+		)
+
+def teacher_predictions(teacher_path):
+	"""Get the predictions of the teacher for every image of the dataset, in row order.
+
+	The teacher sees the images at its own input size. The predictions are cached with the
+	dataset arrays, and computed again only when the images or the teacher file change.
+	"""
+	teacher = tf.keras.models.load_model(teacher_path)
+	teacher_dataset = image_dataset.ImageDataset(img_path=DATASET_PATH, img_size=tuple(teacher.input_shape[1:3]),
+												 backend='numpy')
+	return teacher_dataset.predict_all(teacher, dataset_cache.file_signature(teacher_path))
+
+def plot_history(history):
+	"""Visualize the training results."""
+	print(history.history)
+	acc      = history.history['accuracy']
+	val_acc  = history.history['val_accuracy']
+	loss     = history.history['loss']
+	val_loss = history.history['val_loss']
+
+	plt.figure(figsize=(8, 8))
+
+	x_axis = range(len(acc))
+	plt.subplot(1, 2, 1)
+	plt.plot(x_axis, acc, label='Training Accuracy')
+	plt.plot(x_axis, val_acc, label='Validation Accuracy')
+	plt.legend(loc='lower right')
+	plt.title('Training and Validation Accuracy')
+
+	x_axis = range(len(loss))
+	plt.subplot(1, 2, 2)
+	plt.plot(x_axis, loss, label='Training Loss')
+	plt.plot(x_axis, val_loss, label='Validation Loss')
+	plt.legend(loc='upper right')
+	plt.title('Training and Validation Loss')
+	plt.show()
+
+def main():
+	"""Train, save and export the model."""
+	args = parse_args()
+
+	# Both must happen before TensorFlow initializes its devices.
+	if args.cpu_devices:
+		split_cpu(args.cpu_devices)
+	strategy = create_strategy(args.strategy, args.cpu_devices)
+
+	num_workers, worker_index, is_chief = worker_info() if args.strategy == 'multiworker' else (1, 0, True)
+
+	# Every replica trains on batch_size images per step.
+	# tf.distribute takes the batches of each worker's dataset as global batches and splits them
+	# over all the replicas, so every worker batches its own shard with the global batch size.
+	global_batch_size = args.batch_size * strategy.num_replicas_in_sync
+	print('Replicas: %d, workers: %d, global batch size: %d' % (
+		strategy.num_replicas_in_sync, num_workers, global_batch_size))
+
+	# Get the image dataset.
+	# Distillation needs the numpy backend, the soft targets are joined to the images by row.
+	backend = 'numpy' if args.teacher else DATASET_BACKEND
+	dataset = image_dataset.ImageDataset(img_path=DATASET_PATH, img_size=models.INPUT_SIZES[args.model], backend=backend) # img_size: (h, w)
+	soft_targets = teacher_predictions(args.teacher) if args.teacher else None
+
+	# Divide 80% of the dataset as the training dataset and the rest as the validation dataset.
+	# Each worker reads its own shard.
+	augmenter = batch_augment.BatchAugmenter(dataset.label_names, seed=AUGMENT_SEED) if AUGMENT else None
+	dataset.create(train_set_ratio=0.8, val_set_ratio=0.2, batch_size=global_batch_size, augmenter=augmenter,
+				   class_proportions=CLASS_PROPORTIONS, num_shards=num_workers, shard_index=worker_index,
+				   soft_targets=soft_targets)
+
+	print('Image count: ', dataset.img_count)
+	print('Training images per class: ', dict(zip(dataset.label_names, dataset.train_class_counts)))
+
+	# Get the training and validation dataset.
+	train_ds = dataset.train_ds
+	val_ds   = dataset.val_ds
+
+	# Total number of steps (batches of samples) before declaring one epoch finished and starting the next epoch.
+	steps_per_epoch  = args.steps_per_epoch or int(math.ceil(dataset.train_size * num_workers / global_batch_size))
+	validation_steps = int(math.ceil(dataset.val_size * num_workers / global_batch_size))
+	print('Steps per epoch: ', steps_per_epoch)
+	if num_workers > 1:
+		# The shards of the workers may differ by a few images, none should run out first.
+		val_ds = val_ds.repeat()
+
+	# Create a model instance, its variables are mirrored on every replica.
+	with strategy.scope():
+		model = create_model(args.model, dataset.class_count, distill=bool(args.teacher))
+
+	# Display the model's architecture.
+	model.summary()
+
+	throughput = ThroughputCallback(global_batch_size, steps_per_epoch)
+
+	if args.benchmark:
+		model.fit(train_ds, steps_per_epoch=steps_per_epoch, epochs=args.epochs, callbacks=[throughput], verbose=2)
+		if is_chief:
+			print('THROUGHPUT ' + json.dumps({'strategy': args.strategy, 'replicas': strategy.num_replicas_in_sync,
+											  'workers': num_workers, 'global_batch_size': global_batch_size,
+											  'images_per_sec': throughput.images_per_sec}))
+		return
+
+	# Create checkpoint callback.
+	# The other workers save too, but to a place of their own.
+	cp_callback = tf.keras.callbacks.ModelCheckpoint(
+		filepath=checkpoint_path if is_chief else os.path.join(tempfile.mkdtemp(), 'cp.ckpt'),
+		monitor='val_loss',
+		save_best_only=True,	# Set it true to save the best model at the end of training.
+		save_weights_only=True,	# Only thee model's weights will be saved.
+		mode='auto',	# In auto mode, the direction is automatically inferred from the name of the monitored quantity.
+		verbose=1
+	)
+
+	# Create early stopping callback.
+	early_stop = tf.keras.callbacks.EarlyStopping(
+	    monitor='val_loss',
+	    patience=15,	# The amount of epochs to check for improvement.
+	    verbose=1,
+	    restore_best_weights=True
+	)
+
+	callbacks = [cp_callback, early_stop, throughput]
+
+	# Create tensorboard callback.
+	if is_chief:
+		callbacks.append(tf.keras.callbacks.TensorBoard(log_dir=log_dir, histogram_freq=1))
+
+	# Trains the model for a fixed number of epochs (iterations on a dataset).
+	history = model.fit(
+		train_ds,
+		steps_per_epoch=steps_per_epoch,
+		epochs=args.epochs,
+		callbacks=callbacks,
+		validation_data=val_ds,
+		validation_steps=validation_steps
+	)
+
+	print('Model training stoped at: ', early_stop.stopped_epoch)
+	print('Training throughput: %.1f images/s' % throughput.images_per_sec)
+
+	# Only the chief saves and exports the model.
+	if not is_chief:
+		return
+
+	# Save the best model weights.
+	# Because 'restore_best_weights' is True in 'early_stop' callback,
+	# the model will restore weights from the epoch with the best value of the monitored quantity,
+	# therefore we just save the model at this time
+	output_dir = os.path.dirname(args.output)
+	if output_dir and not os.path.isdir(output_dir):
+		os.makedirs(output_dir)
+	if args.teacher:
+		# Saved with the plain loss, so it loads without the distillation functions.
+		with strategy.scope():
+			compile_model(model)
+	model.save(args.output)
+
+	# Export an int8 quantized copy for local inference on the Raspberry Pi,
+	# calibrated on a sample of the dataset.
+	tflite_export.export_tflite(model, dataset.sample_images(TFLITE_CALIBRATION_SAMPLES),
+								os.path.splitext(args.output)[0] + '_int8.tflite')
+
+	plot_history(history)
+
+if __name__ == '__main__':
+	main()